@@ -0,0 +1,36 @@
+-- Migración para bases de datos creadas antes de user_movie_rating_events (ver init.sql).
+-- Deltas de valoraciones para las estadísticas incrementales del servicio KNN (knn/knn_user_stats.py).
+-- Se puede ejecutar más de una vez. Mientras no se ejecute, el servicio agrega user_movies completo.
+BEGIN;
+
+CREATE TABLE IF NOT EXISTS user_movie_rating_events (
+    id BIGSERIAL PRIMARY KEY,
+    movie_id INTEGER NOT NULL,
+    rating_sum_delta INTEGER NOT NULL,
+    rating_count_delta INTEGER NOT NULL,
+    created_at TIMESTAMP WITH TIME ZONE DEFAULT clock_timestamp()
+);
+
+CREATE OR REPLACE FUNCTION log_user_movie_rating_change() RETURNS TRIGGER AS $$
+BEGIN
+    IF TG_OP = 'UPDATE' AND OLD.rating IS NOT DISTINCT FROM NEW.rating AND OLD.movie_id = NEW.movie_id THEN
+        RETURN NULL;
+    END IF;
+    IF TG_OP IN ('UPDATE', 'DELETE') AND OLD.rating IS NOT NULL THEN
+        INSERT INTO user_movie_rating_events (movie_id, rating_sum_delta, rating_count_delta)
+        VALUES (OLD.movie_id, -OLD.rating, -1);
+    END IF;
+    IF TG_OP IN ('INSERT', 'UPDATE') AND NEW.rating IS NOT NULL THEN
+        INSERT INTO user_movie_rating_events (movie_id, rating_sum_delta, rating_count_delta)
+        VALUES (NEW.movie_id, NEW.rating, 1);
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS user_movie_rating_changes ON user_movies;
+CREATE TRIGGER user_movie_rating_changes
+AFTER INSERT OR DELETE OR UPDATE OF rating, movie_id ON user_movies
+FOR EACH ROW EXECUTE FUNCTION log_user_movie_rating_change();
+
+COMMIT;
@@ -30,7 +30,7 @@ Write-Host "📁 Navegando a la carpeta knn..." -ForegroundColor Cyan
 Set-Location knn
 
 # Verificar que el modelo esté entrenado
-if (-not (Test-Path "knn_model.pkl")) {
+if (-not (Test-Path "knn_model/CURRENT") -and -not (Test-Path "knn_model/manifest.json") -and -not (Test-Path "knn_model.pkl")) {
     Write-Host "⚠️ Modelo KNN no encontrado, entrenando..." -ForegroundColor Yellow
     python train_knn_model.py
     
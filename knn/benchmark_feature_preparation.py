@@ -0,0 +1,127 @@
+#!/usr/bin/env python3
+"""
+Benchmark de la preparación de características KNN
+Compara la ruta anterior (Series.apply por película, fechas y medianas columna a columna)
+con la ruta vectorizada de EfficientKNNService sobre catálogos sintéticos.
+"""
+
+import sys
+import time
+import logging
+import argparse
+import numpy as np
+import pandas as pd
+from pathlib import Path
+
+# Agregar el directorio actual al path
+sys.path.append(str(Path(__file__).parent))
+
+from knn_service import EfficientKNNService
+
+logging.getLogger('knn_service').setLevel(logging.WARNING)
+
+
+def synthetic_catalog(n_movies: int, seed: int = 42):
+    """Columnas como las deja el cargador en streaming: tipadas y con géneros en CSR"""
+    rng = np.random.default_rng(seed)
+    genre_lengths = rng.integers(0, 6, n_movies)
+    genre_offsets = np.zeros(n_movies + 1, dtype=np.int64)
+    np.cumsum(genre_lengths, out=genre_offsets[1:])
+    genre_values = rng.integers(1, 40, int(genre_offsets[-1])).astype(np.int32)
+
+    release_dates = (np.datetime64('1950-01-01') + rng.integers(0, 27000, n_movies)).astype('datetime64[D]')
+    release_dates[rng.random(n_movies) < 0.05] = np.datetime64('NaT')
+    vote_average = rng.uniform(1, 10, n_movies)
+    vote_average[rng.random(n_movies) < 0.02] = np.nan
+
+    movies_df = pd.DataFrame({
+        'id': np.arange(n_movies, dtype=np.int64),
+        'vote_average': vote_average,
+        'vote_count': rng.integers(1, 20000, n_movies),
+        'release_date': release_dates,
+        'popularity': rng.exponential(20, n_movies),
+        'genre_ids': [genre_values[start:stop].tolist()
+                      for start, stop in zip(genre_offsets[:-1].tolist(), genre_offsets[1:].tolist())],
+        'avg_user_rating': 5.0,
+        'user_rating_count': 0
+    })
+    return movies_df, genre_offsets
+
+
+def legacy_prepare(movies_df: pd.DataFrame, feature_columns):
+    """Ruta anterior: fechas vía pandas, count_genres con apply y medianas por columna"""
+    current_year = pd.Timestamp.now().year
+    movies_df['years_since_release'] = current_year - pd.to_datetime(
+        movies_df['release_date'], errors='coerce'
+    ).dt.year.fillna(current_year)
+
+    def count_genres(genre_val):
+        try:
+            if pd.isna(genre_val) or genre_val is None:
+                return 1
+            if isinstance(genre_val, str):
+                return len([g.strip() for g in genre_val.split(',') if g.strip()])
+            if isinstance(genre_val, (list, tuple)):
+                return len(genre_val)
+            if hasattr(genre_val, 'tolist'):
+                return len(genre_val.tolist())
+            return 1
+        except Exception:
+            return 1
+
+    movies_df['genre_diversity'] = movies_df['genre_ids'].apply(count_genres)
+    for col in feature_columns:
+        if col in movies_df.columns:
+            movies_df[col] = movies_df[col].fillna(movies_df[col].median())
+    return movies_df
+
+
+def vectorized_prepare(service: EfficientKNNService, movies_df: pd.DataFrame, genre_offsets: np.ndarray):
+    """Ruta nueva: la misma que usa _prepare_features_from_db"""
+    service._add_derived_features(movies_df, genre_offsets)
+    service._impute_feature_medians(movies_df)
+    return movies_df
+
+
+def timed(fn) -> float:
+    start = time.perf_counter()
+    fn()
+    return time.perf_counter() - start
+
+
+def run_benchmark(n_movies: int, skip_legacy: bool):
+    service = EfficientKNNService(auto_load=False)
+    movies_df, genre_offsets = synthetic_catalog(n_movies)
+    print(f"\n📊 Catálogo sintético: {n_movies} películas")
+
+    vectorized_df = movies_df.copy()
+    vectorized_s = timed(lambda: vectorized_prepare(service, vectorized_df, genre_offsets))
+    print(f"   🔹 Vectorizado: {vectorized_s:.3f} s")
+
+    if skip_legacy:
+        return
+    legacy_df = movies_df.copy()
+    legacy_s = timed(lambda: legacy_prepare(legacy_df, service.feature_columns))
+    print(f"   🔹 Anterior:    {legacy_s:.3f} s (x{legacy_s / vectorized_s:.1f})")
+
+    # Verificar que ambas rutas producen las mismas características. genre_diversity se excluye:
+    # en la ruta anterior pd.isna(lista) lanzaba excepción y valía 1 en todas (FEATURE_VERSION 1)
+    columns = [col for col in service.feature_columns if col != 'genre_diversity']
+    same = np.allclose(legacy_df[columns].to_numpy(dtype=float), vectorized_df[columns].to_numpy(dtype=float))
+    print(f"   {'✅' if same else '❌'} Características idénticas (salvo genre_diversity): {same}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark de la preparación de características KNN")
+    parser.add_argument('--sizes', type=int, nargs='+', default=[10_000, 100_000, 1_000_000])
+    parser.add_argument('--skip-legacy', action='store_true', help="No medir la ruta anterior")
+    args = parser.parse_args()
+
+    print("🏁 Benchmark de preparación de características (anterior vs vectorizado)")
+    print("=" * 60)
+    for n_movies in args.sizes:
+        run_benchmark(n_movies, args.skip_legacy)
+
+
+if __name__ == "__main__":
+    main()
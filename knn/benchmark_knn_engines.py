@@ -0,0 +1,78 @@
+#!/usr/bin/env python3
+"""
+Benchmark de motores KNN: sklearn NearestNeighbors vs ExactCosineEngine
+Mide la latencia por consulta (individual y en lote) sobre un catálogo sintético
+y verifica que ambos motores devuelven los mismos vecinos.
+"""
+
+import sys
+import time
+import argparse
+import numpy as np
+from pathlib import Path
+from sklearn.neighbors import NearestNeighbors
+
+# Agregar el directorio actual al path
+sys.path.append(str(Path(__file__).parent))
+
+from knn_engines import ExactCosineEngine
+
+
+def time_per_query(fn, n_queries: int) -> float:
+    """Tiempo medio por consulta en milisegundos"""
+    start = time.perf_counter()
+    fn()
+    return (time.perf_counter() - start) * 1000 / n_queries
+
+
+def run_benchmark(n_movies: int, n_features: int, n_queries: int, top_k: int, seed: int = 42):
+    rng = np.random.default_rng(seed)
+    X = rng.standard_normal((n_movies, n_features))
+    query_rows = rng.choice(n_movies, size=n_queries, replace=False)
+    queries = X[query_rows]
+
+    sklearn_model = NearestNeighbors(n_neighbors=top_k, algorithm='auto', metric='cosine').fit(X)
+    engine = ExactCosineEngine(X)
+
+    print(f"\n📊 Catálogo: {n_movies} películas x {n_features} características, top_k={top_k}")
+
+    # Consultas individuales (como /similar)
+    sk_single = time_per_query(
+        lambda: [sklearn_model.kneighbors(queries[i:i+1], n_neighbors=top_k) for i in range(n_queries)], n_queries
+    )
+    ex_single = time_per_query(
+        lambda: [engine.kneighbors(queries[i:i+1], n_neighbors=top_k) for i in range(n_queries)], n_queries
+    )
+    print(f"   🔹 Individual  sklearn: {sk_single:.3f} ms/consulta | exact: {ex_single:.3f} ms/consulta "
+          f"(x{sk_single / ex_single:.1f})")
+
+    # Consultas en lote (como la tabla de vecinos)
+    sk_batch = time_per_query(lambda: sklearn_model.kneighbors(queries, n_neighbors=top_k), n_queries)
+    ex_batch = time_per_query(lambda: engine.kneighbors(queries, n_neighbors=top_k), n_queries)
+    print(f"   🔹 Lote        sklearn: {sk_batch:.3f} ms/consulta | exact: {ex_batch:.3f} ms/consulta "
+          f"(x{sk_batch / ex_batch:.1f})")
+
+    # Verificar que los resultados coinciden
+    sk_distances, sk_indices = sklearn_model.kneighbors(queries, n_neighbors=top_k)
+    ex_distances, ex_indices = engine.kneighbors(queries, n_neighbors=top_k)
+    same_indices = float((sk_indices == ex_indices).mean())
+    max_distance_diff = float(np.abs(sk_distances - ex_distances).max())
+    print(f"   ✅ Vecinos idénticos: {same_indices * 100:.2f}% | diferencia máx. de distancia: {max_distance_diff:.2e}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark de motores KNN")
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1_000, 10_000, 100_000])
+    parser.add_argument('--features', type=int, default=7)
+    parser.add_argument('--queries', type=int, default=200)
+    parser.add_argument('--top-k', type=int, default=10)
+    args = parser.parse_args()
+
+    print("🏁 Benchmark de motores KNN (sklearn vs exact)")
+    print("=" * 60)
+    for n_movies in args.sizes:
+        run_benchmark(n_movies, args.features, min(args.queries, n_movies), args.top_k)
+
+
+if __name__ == "__main__":
+    main()
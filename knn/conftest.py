@@ -0,0 +1,64 @@
+"""
+Fixtures de pytest para las pruebas del servicio KNN (python -m pytest desde knn/).
+
+Las pruebas trabajan sobre catálogos sintéticos entrenados en memoria: no necesitan
+PostgreSQL ni knn_model.pkl. test_knn_integration.py es un script manual contra la API
+en marcha (python test_knn_integration.py) y no se recoge.
+"""
+
+import sys
+from pathlib import Path
+
+import numpy as np
+import pytest
+
+sys.path.append(str(Path(__file__).parent))
+
+from benchmark_feature_preparation import synthetic_catalog
+from knn_service import EfficientKNNService
+
+collect_ignore = ["test_knn_integration.py"]
+
+
+def build_synthetic_service(n_movies: int = 300, seed: int = 7, first_id: int = 1000,
+                            **config) -> EfficientKNNService:
+    """Servicio entrenado sobre un catálogo sintético; config sobrescribe atributos (p. ej. ANN_THRESHOLD)"""
+    movies_df, _ = synthetic_catalog(n_movies, seed)
+    movies_df['id'] = movies_df['id'] + first_id
+    movies_df['title'] = [f"Película {movie_id}" for movie_id in movies_df['id']]
+    # Valoraciones de usuarios variadas para que todas las características tengan varianza
+    rng = np.random.default_rng(seed)
+    movies_df['avg_user_rating'] = rng.uniform(1, 10, n_movies)
+    movies_df['user_rating_count'] = rng.integers(0, 500, n_movies)
+
+    service = EfficientKNNService(auto_load=False)
+    for name, value in config.items():
+        setattr(service, name, value)
+    service.movies_df = movies_df
+    service._prepare_features_from_db()
+    service.train_knn_model()
+    assert service.is_model_loaded()
+    return service
+
+
+def catalog_movie(movie_id: int, **fields) -> dict:
+    """Película en el formato de POST /catalog/movies"""
+    movie = {
+        'id': movie_id, 'title': f"Nueva {movie_id}", 'genre_ids': [3, 7],
+        'vote_average': 7.1, 'vote_count': 1200, 'popularity': 25.0, 'release_date': '2015-06-01'
+    }
+    movie.update(fields)
+    return movie
+
+
+@pytest.fixture
+def knn_service() -> EfficientKNNService:
+    return build_synthetic_service()
+
+
+@pytest.fixture
+def saved_model(tmp_path) -> str:
+    """Artefacto sin pickle de un catálogo sintético, en un directorio temporal"""
+    model_path = str(tmp_path / "knn_model")
+    build_synthetic_service().save_knn_model(model_path)
+    return model_path
@@ -0,0 +1,204 @@
+"""
+Pool de conexiones PostgreSQL compartido por el servicio KNN, el evaluador y los scripts.
+
+Un único ThreadedConnectionPool por proceso, con tamaño acotado (KNN_DB_POOL_MIN/MAX).
+Al pedir una conexión se espera como mucho KNN_DB_POOL_TIMEOUT segundos a que quede una
+libre. Las conexiones que llevan más de KNN_DB_HEALTH_CHECK_SECONDS sin usarse se
+comprueban con SELECT 1 y, si están rotas, se descartan y se abre otra. El pool lleva
+métricas de espera (media, máximo, timeouts) para /health y /model-status.
+
+Uso:
+
+    pool = get_database_pool()
+    with pool.connection() as conn:
+        with conn.cursor() as cursor:
+            cursor.execute("SELECT 1")
+
+Al devolver la conexión se hace rollback para cerrar la transacción de lectura; quien
+escriba debe llamar a conn.commit() dentro del bloque.
+"""
+
+import os
+import time
+import logging
+import threading
+from contextlib import contextmanager
+from typing import Dict, Optional
+
+import psycopg2
+from psycopg2 import pool as pg_pool
+
+logger = logging.getLogger(__name__)
+
+
+def database_settings() -> Dict:
+    """Parámetros de conexión desde las variables de entorno (mismos valores por defecto de siempre)"""
+    return {
+        'host': os.getenv('DB_HOST', 'localhost'),
+        'database': os.getenv('DB_NAME', 'MovieMatch'),
+        'user': os.getenv('DB_USER', 'postgres'),
+        'password': os.getenv('DB_PASSWORD', 'admin'),
+        'port': os.getenv('DB_PORT', '5432')
+    }
+
+
+class PoolTimeoutError(psycopg2.OperationalError):
+    """No quedó ninguna conexión libre dentro del tiempo de espera"""
+
+
+class DatabasePool:
+    """ThreadedConnectionPool acotado con espera, health checks, reconexión y métricas"""
+
+    def __init__(self, min_connections: int = 1, max_connections: int = 10, timeout: float = 10.0,
+                 health_check_seconds: float = 30.0, **connection_kwargs):
+        self.min_connections = min_connections
+        self.max_connections = max_connections
+        self.timeout = timeout
+        self.health_check_seconds = health_check_seconds
+        self._pool = pg_pool.ThreadedConnectionPool(min_connections, max_connections, **connection_kwargs)
+        # getconn() de psycopg2 falla en vez de esperar si el pool está agotado: el semáforo
+        # hace que los hilos esperen su turno (con timeout)
+        self._slots = threading.BoundedSemaphore(max_connections)
+        self._last_used: Dict[int, float] = {}
+        self._metrics_lock = threading.Lock()
+        self._metrics = {
+            'acquisitions': 0,
+            'in_use': 0,
+            'wait_seconds_total': 0.0,
+            'wait_seconds_max': 0.0,
+            'timeouts': 0,
+            'reconnects': 0,
+            'health_check_failures': 0
+        }
+
+    @contextmanager
+    def connection(self):
+        """Prestar una conexión sana del pool y devolverla al salir"""
+        start = time.perf_counter()
+        if not self._slots.acquire(timeout=self.timeout):
+            with self._metrics_lock:
+                self._metrics['timeouts'] += 1
+            raise PoolTimeoutError(f"Sin conexiones libres tras {self.timeout}s (máximo {self.max_connections})")
+
+        conn = None
+        try:
+            conn = self._checkout()
+            waited = time.perf_counter() - start
+            with self._metrics_lock:
+                self._metrics['acquisitions'] += 1
+                self._metrics['in_use'] += 1
+                self._metrics['wait_seconds_total'] += waited
+                self._metrics['wait_seconds_max'] = max(self._metrics['wait_seconds_max'], waited)
+
+            yield conn
+        finally:
+            try:
+                if conn is not None:
+                    with self._metrics_lock:
+                        self._metrics['in_use'] -= 1
+                    self._checkin(conn)
+            finally:
+                self._slots.release()
+
+    def _checkout(self):
+        """getconn() con health check de las conexiones ociosas y reconexión si están rotas"""
+        # Tras un reinicio de PostgreSQL todas las conexiones ociosas pueden estar rotas
+        for _ in range(self.max_connections):
+            conn = self._pool.getconn()
+            idle = time.monotonic() - self._last_used.get(id(conn), 0.0)
+            if not conn.closed and idle < self.health_check_seconds:
+                return conn
+
+            try:
+                if conn.closed:
+                    raise psycopg2.InterfaceError("conexión cerrada")
+                with conn.cursor() as cursor:
+                    cursor.execute("SELECT 1")
+                conn.rollback()
+                return conn
+            except psycopg2.Error as e:
+                logger.warning(f"⚠️ Conexión del pool descartada ({e}), reconectando...")
+                self._pool.putconn(conn, close=True)
+                self._last_used.pop(id(conn), None)
+                with self._metrics_lock:
+                    self._metrics['health_check_failures'] += 1
+                    self._metrics['reconnects'] += 1
+        return self._pool.getconn()
+
+    def _checkin(self, conn):
+        """Cerrar la transacción y devolver la conexión; las rotas se cierran en vez de reutilizarse"""
+        broken = bool(conn.closed)
+        if not broken:
+            try:
+                conn.rollback()
+            except psycopg2.Error:
+                broken = True
+        if broken:
+            self._last_used.pop(id(conn), None)
+        else:
+            self._last_used[id(conn)] = time.monotonic()
+        self._pool.putconn(conn, close=broken)
+
+    def stats(self) -> Dict:
+        """Métricas del pool: tamaño, conexiones en uso y tiempo de espera"""
+        with self._metrics_lock:
+            metrics = dict(self._metrics)
+        acquisitions = metrics['acquisitions']
+        return {
+            'min_connections': self.min_connections,
+            'max_connections': self.max_connections,
+            'in_use': metrics['in_use'],
+            'acquisitions': acquisitions,
+            'wait_ms_avg': round(metrics['wait_seconds_total'] * 1000 / acquisitions, 3) if acquisitions else 0.0,
+            'wait_ms_max': round(metrics['wait_seconds_max'] * 1000, 3),
+            'timeouts': metrics['timeouts'],
+            'reconnects': metrics['reconnects'],
+            'health_check_failures': metrics['health_check_failures']
+        }
+
+    def close(self):
+        """Cerrar todas las conexiones del pool"""
+        self._pool.closeall()
+
+
+_database_pool: Optional[DatabasePool] = None
+_database_pool_lock = threading.Lock()
+
+
+def get_database_pool() -> Optional[DatabasePool]:
+    """Pool compartido del proceso (se crea en el primer uso); None si no se puede conectar"""
+    global _database_pool
+    if _database_pool is None:
+        with _database_pool_lock:
+            if _database_pool is None:
+                settings = database_settings()
+                try:
+                    logger.info(f"🔌 Creando pool de conexiones: {settings['host']}:{settings['port']}/{settings['database']}")
+                    _database_pool = DatabasePool(
+                        min_connections=int(os.getenv('KNN_DB_POOL_MIN', 1)),
+                        max_connections=int(os.getenv('KNN_DB_POOL_MAX', 10)),
+                        timeout=float(os.getenv('KNN_DB_POOL_TIMEOUT', 10)),
+                        health_check_seconds=float(os.getenv('KNN_DB_HEALTH_CHECK_SECONDS', 30)),
+                        **settings
+                    )
+                    logger.info("✅ Pool de conexiones a base de datos listo")
+                except Exception as e:
+                    logger.error(f"❌ Error creando el pool de conexiones: {e}")
+                    return None
+    return _database_pool
+
+
+def database_pool_stats() -> Optional[Dict]:
+    """Métricas del pool compartido sin crearlo (None si aún no se usó)"""
+    pool = _database_pool
+    return pool.stats() if pool is not None else None
+
+
+def close_database_pool():
+    """Cerrar el pool compartido (al apagar la API o al terminar un script)"""
+    global _database_pool
+    with _database_pool_lock:
+        if _database_pool is not None:
+            _database_pool.close()
+            _database_pool = None
+            logger.info("✅ Pool de conexiones cerrado")
@@ -17,7 +17,7 @@ if [ ! -f "knn_api.py" ]; then
 fi
 
 # Verificar que el modelo esté entrenado
-if [ ! -f "knn_model.pkl" ]; then
+if [ ! -f "knn_model/CURRENT" ] && [ ! -f "knn_model/manifest.json" ] && [ ! -f "knn_model.pkl" ]; then
     echo "⚠️ Modelo KNN no encontrado, entrenando..."
     python train_knn_model.py
 fi
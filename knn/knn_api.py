@@ -1,16 +1,25 @@
-from fastapi import FastAPI, HTTPException, Depends, Body
+from fastapi import FastAPI, HTTPException, Depends, Body, Header
 from fastapi.middleware.cors import CORSMiddleware
 from pydantic import BaseModel
 from typing import List, Dict, Optional
 import logging
 import os
 import sys
+import threading
+import time
 from pathlib import Path
 
 # Agregar el directorio actual al path
 sys.path.append(str(Path(__file__).parent))
 
 from knn_service import EfficientKNNService
+from knn_artifact import artifact_marker_path
+from knn_training_jobs import TrainingJobManager
+from db_pool import close_database_pool, database_pool_stats
+from knn_executor import KNNExecutor, MicroBatcher, endpoint_limiters
+from service_metrics import instrument_app
+from request_profiler import add_request_profiling
+from memory_report import TracemallocDiff, memory_report, object_report
 
 # Configurar logging
 logging.basicConfig(level=logging.INFO)
@@ -35,30 +44,292 @@ app.add_middleware(
 # Inicializar servicio KNN
 knn_service = None
 
+# Recarga en caliente: el servicio activo se reemplaza de forma atómica; las peticiones
+# en curso conservan su referencia al servicio anterior hasta terminar
+_reload_lock = threading.Lock()
+model_state = {
+    "model_version": None,
+    "model_path": None,
+    "loaded_at": None,
+    "load_seconds": None,
+    "reload_in_progress": False,
+    "last_reload_error": None,
+    "compaction_in_progress": False,
+    "last_compaction_error": None,
+}
+RELOAD_POLL_SECONDS = float(os.getenv("KNN_RELOAD_POLL_SECONDS", 0))  # 0 = no vigilar el artefacto
+ADMIN_TOKEN = os.getenv("KNN_ADMIN_TOKEN")
+COMPACTION_INTERVAL_SECONDS = float(os.getenv("KNN_COMPACTION_INTERVAL_SECONDS", 0))  # 0 = solo bajo demanda
+COMPACTION_DELTA_ROWS = int(os.getenv("KNN_COMPACTION_DELTA_ROWS", 0))  # Compactar al llegar el delta a N filas (0 = no)
+
+# Los handlers son async: el cómputo KNN va a un executor acotado, la BD a un pool de E/S
+# aparte y cada grupo de endpoints tiene su límite de concurrencia (ver knn_executor.py)
+knn_executor = KNNExecutor()
+limiters = endpoint_limiters(knn_executor.workers)
+
+# Micro-batching opcional: /similar y /recommendations/knn concurrentes se resuelven en lotes
+MICROBATCH_ENABLED = os.getenv("KNN_MICROBATCH_ENABLED", "false").lower() == "true"
+MICROBATCH_MAX_SIZE = int(os.getenv("KNN_MICROBATCH_MAX_SIZE", 32))
+MICROBATCH_MAX_DELAY_MS = float(os.getenv("KNN_MICROBATCH_MAX_DELAY_MS", 2))
+SIMILAR_BATCH_MAX_IDS = int(os.getenv("KNN_SIMILAR_BATCH_MAX_IDS", 500))  # Películas por llamada a /similar/batch
+
+async def _similar_batch(requests: List[tuple]) -> List[List[Dict]]:
+    """Lote de (movie_id, top_k) para /similar"""
+    service = get_knn_service()
+    generation = service.similar_cache_generation()
+    results = await knn_executor.compute(service, "find_similar_movies_batch", requests=requests)
+    if knn_executor.kind == "process":
+        for (movie_id, top_k), similar_movies in zip(requests, results):
+            service.store_similar_movies(movie_id, top_k, similar_movies, generation)
+    return results
+
+async def _recommendations_batch(requests: List[Dict]) -> List[list]:
+    """Lote de historiales para /recommendations/knn"""
+    return await knn_executor.compute(get_knn_service(), "get_user_recommendations_batch", requests=requests)
+
+batchers = {
+    "similar": MicroBatcher("similar", _similar_batch, MICROBATCH_MAX_SIZE, MICROBATCH_MAX_DELAY_MS / 1000),
+    "recommendations": MicroBatcher("recommendations", _recommendations_batch, MICROBATCH_MAX_SIZE,
+                                    MICROBATCH_MAX_DELAY_MS / 1000),
+} if MICROBATCH_ENABLED else {}
+
+# Métricas Prometheus en /metrics: latencia por endpoint, etapas del pipeline y estado de
+# executor, límites, caché y pool (ver service_metrics.py)
+metrics_registry = instrument_app(app, "knn")
+
+def _runtime_metrics() -> List[tuple]:
+    """Valores que ya llevan el executor, los límites, la caché y el pool, leídos al exportar"""
+    executor = knn_executor.stats()
+    cache = knn_service.similar_cache.stats() if knn_service is not None else {}
+    pool = database_pool_stats() or {}
+    return [
+        ("executor_in_flight", "gauge", "Tareas en curso en el executor",
+         [({"pool": "compute"}, executor["compute_in_flight"]), ({"pool": "io"}, executor["io_in_flight"])]),
+        ("endpoint_limit_in_flight", "gauge", "Peticiones dentro del límite de cada grupo",
+         [({"group": name}, limiter.in_flight) for name, limiter in limiters.items()]),
+        ("endpoint_limit_rejected_total", "counter", "Peticiones rechazadas con 503 por el límite",
+         [({"group": name}, limiter.rejected) for name, limiter in limiters.items()]),
+        ("similar_cache_hits_total", "counter", "Aciertos de la caché de /similar", [({}, cache.get("hits"))]),
+        ("similar_cache_misses_total", "counter", "Fallos de la caché de /similar", [({}, cache.get("misses"))]),
+        ("similar_cache_entries", "gauge", "Entradas en la caché de /similar", [({}, cache.get("entries"))]),
+        ("db_pool_in_use", "gauge", "Conexiones del pool en uso", [({}, pool.get("in_use"))]),
+        ("db_pool_timeouts_total", "counter", "Esperas del pool que agotaron el tiempo", [({}, pool.get("timeouts"))]),
+    ]
+
+metrics_registry.add_collector(_runtime_metrics)
+
+# Perfilado bajo demanda (X-Profile: 1 + X-Admin-Token) o por muestreo (ver request_profiler.py)
+add_request_profiling(app, "KNN", admin_token=ADMIN_TOKEN)
+
+def _record_loaded_service(service: EfficientKNNService, load_seconds: float):
+    """Actualizar la información del modelo activo"""
+    model_state.update({
+        "model_version": service.model_version,
+        "model_path": service.model_path,
+        "loaded_at": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "load_seconds": round(load_seconds, 3),
+    })
+
 def get_knn_service():
     """Dependency para obtener el servicio KNN"""
     global knn_service
     if knn_service is None:
-        try:
-            # Intentar cargar modelo existente
-            model_path = "knn_model.pkl"
-            data_path = "prepared_movies_for_knn.csv"
-            
-            if os.path.exists(model_path) and os.path.exists(data_path):
-                knn_service = EfficientKNNService(
-                    movies_data_path=data_path,
-                    model_path=model_path
-                )
-                logger.info("✅ Servicio KNN cargado desde archivos existentes")
-            else:
-                logger.warning("⚠️ Archivos de modelo no encontrados, creando servicio vacío")
-                knn_service = EfficientKNNService()
-        except Exception as e:
-            logger.error(f"❌ Error inicializando servicio KNN: {e}")
-            knn_service = EfficientKNNService()
+        with _reload_lock:
+            if knn_service is None:
+                start = time.perf_counter()
+                try:
+                    # Intentar cargar modelo existente (directorio knn_model/ o knn_model.pkl heredado)
+                    model_path = EfficientKNNService.default_model_path()
+                    
+                    if os.path.exists(model_path):
+                        service = EfficientKNNService(model_path=model_path)
+                        logger.info("✅ Servicio KNN cargado desde archivos existentes")
+                    else:
+                        logger.warning("⚠️ Archivos de modelo no encontrados, creando servicio vacío")
+                        service = EfficientKNNService()
+                except Exception as e:
+                    logger.error(f"❌ Error inicializando servicio KNN: {e}")
+                    service = EfficientKNNService()
+                _record_loaded_service(service, time.perf_counter() - start)
+                knn_service = service
     
     return knn_service
 
+def _validate_service(service: EfficientKNNService):
+    """Comprobar que un modelo recién cargado puede responder antes de activarlo"""
+    if not service.is_model_loaded():
+        raise ValueError("el modelo no se pudo cargar")
+    total_movies = len(service.movie_ids)
+    if service.live_movie_count == 0:
+        raise ValueError("el catálogo está vacío")
+    if service.neighbor_indices is not None and len(service.neighbor_indices) != total_movies:
+        raise ValueError("la tabla de vecinos no coincide con el catálogo")
+    live = service._live_mask()
+    probe_id = int(service.movie_ids[0 if live is None else int(live.argmax())])  # Primera película viva
+    if total_movies > 1 and not service.find_similar_movies(probe_id, top_k=1):
+        raise ValueError(f"la consulta de prueba para la película {probe_id} no devolvió resultados")
+
+def reload_knn_service(model_path: str = None) -> Dict:
+    """Cargar y validar un modelo nuevo y sustituir el activo de forma atómica"""
+    global knn_service
+    model_path = model_path or model_state["model_path"] or EfficientKNNService.default_model_path()
+    start = time.perf_counter()
+    try:
+        candidate = EfficientKNNService(model_path=model_path)
+        _validate_service(candidate)
+        candidate.warm_similar_cache()  # Antes del cambio: el modelo nuevo no empieza con la caché fría
+    except Exception as e:
+        model_state["last_reload_error"] = str(e)
+        logger.error(f"❌ Recarga del modelo KNN descartada: {e}")
+        raise
+    
+    with _reload_lock:
+        # Altas/bajas registradas mientras el candidato cargaba (los escritores esperan a este lock)
+        candidate.catch_up_catalog_log()
+        previous_version = knn_service.model_version if knn_service is not None else None
+        knn_service = candidate
+        _record_loaded_service(candidate, time.perf_counter() - start)
+        model_state["last_reload_error"] = None
+    
+    logger.info(f"🔄 Modelo KNN recargado: {previous_version} -> {candidate.model_version}")
+    return {"previous_version": previous_version, **model_state}
+
+def _reload_in_background(model_path: str = None) -> bool:
+    """Lanzar una recarga en un hilo; False si ya hay una en curso"""
+    with _reload_lock:
+        if model_state["reload_in_progress"]:
+            return False
+        model_state["reload_in_progress"] = True
+    
+    def run():
+        try:
+            reload_knn_service(model_path)
+        except Exception:
+            pass
+        finally:
+            model_state["reload_in_progress"] = False
+    
+    threading.Thread(target=run, name="knn-model-reload", daemon=True).start()
+    return True
+
+def _artifact_mtime(model_path: str) -> Optional[float]:
+    """Marca de tiempo del artefacto (su puntero CURRENT en directorios, el propio archivo en .pkl)"""
+    path = artifact_marker_path(model_path) if os.path.isdir(model_path) else model_path
+    return os.path.getmtime(path) if os.path.exists(path) else None
+
+def _watch_model_artifact():
+    """Vigilar el artefacto activo y recargarlo cuando cambie"""
+    last_mtime = _artifact_mtime(model_state["model_path"] or EfficientKNNService.default_model_path())
+    while True:
+        time.sleep(RELOAD_POLL_SECONDS)
+        model_path = model_state["model_path"] or EfficientKNNService.default_model_path()
+        mtime = _artifact_mtime(model_path)
+        if mtime is not None and mtime != last_mtime:
+            last_mtime = mtime
+            logger.info(f"📁 Cambio detectado en {model_path}, recargando modelo KNN...")
+            _reload_in_background(model_path)
+
+def require_admin(x_admin_token: Optional[str] = Header(None)):
+    """Dependency para endpoints de administración (cabecera X-Admin-Token = KNN_ADMIN_TOKEN)"""
+    if not ADMIN_TOKEN or x_admin_token != ADMIN_TOKEN:
+        raise HTTPException(status_code=403, detail="Acceso de administrador requerido")
+
+def compact_knn_service() -> Dict:
+    """
+    Reentrenar el catálogo vivo (sin tombstones) y sustituir el servicio activo.
+    
+    Las altas o bajas que lleguen durante el reentrenamiento se reaplican a la copia desde
+    el log del catálogo antes del cambio, con los escritores detenidos por _reload_lock. Sin
+    log (servicio sin artefacto en disco o KNN_CATALOG_LOG=false) la copia se descarta y la
+    siguiente compactación lo reintentará.
+    """
+    global knn_service
+    service = get_knn_service()
+    revision = service.catalog_revision
+    start = time.perf_counter()
+    try:
+        candidate = service.compacted_copy()
+        _validate_service(candidate)
+        candidate.warm_similar_cache()
+    except Exception as e:
+        model_state["last_compaction_error"] = str(e)
+        logger.error(f"❌ Compactación del catálogo KNN descartada: {e}")
+        raise
+    
+    with _reload_lock:
+        caught_up = candidate.catch_up_catalog_log() if knn_service is service else None
+        if knn_service is not service or (caught_up is None and service.catalog_revision != revision):
+            model_state["last_compaction_error"] = "el catálogo cambió durante la compactación"
+            logger.warning("⚠️ El catálogo cambió durante la compactación, se descarta el resultado")
+            return {"compacted": False, **model_state}
+        knn_service = candidate
+        _record_loaded_service(candidate, time.perf_counter() - start)
+        model_state["last_compaction_error"] = None
+    
+    logger.info(f"🧹 Catálogo KNN compactado: versión {candidate.model_version}")
+    return {"compacted": True, **model_state}
+
+def _apply_catalog_update(method: str, *args) -> Dict:
+    """
+    Aplicar un alta/baja al servicio activo con _reload_lock tomado.
+    
+    Así ninguna escritura cae en un servicio que una recarga o compactación está a punto
+    de sustituir: el cambio se hace después del cambio de servicio, o antes y entonces el
+    servicio nuevo lo recoge del log (catch_up_catalog_log).
+    """
+    with _reload_lock:
+        result = getattr(knn_service, method)(*args)
+        delta_rows = knn_service.delta_rows
+    # Las altas viven en un delta que encarece las lecturas a medida que crece: se funde compactando
+    if COMPACTION_DELTA_ROWS > 0 and delta_rows >= COMPACTION_DELTA_ROWS:
+        _compact_in_background()
+    return result
+
+def _compact_in_background() -> bool:
+    """Lanzar una compactación en un hilo; False si ya hay una en curso"""
+    with _reload_lock:
+        if model_state["compaction_in_progress"]:
+            return False
+        model_state["compaction_in_progress"] = True
+    
+    def run():
+        try:
+            compact_knn_service()
+        except Exception:
+            pass
+        finally:
+            model_state["compaction_in_progress"] = False
+    
+    threading.Thread(target=run, name="knn-catalog-compaction", daemon=True).start()
+    return True
+
+def _periodic_compaction():
+    """Compactar periódicamente si hubo altas o bajas incrementales desde la última vez"""
+    while True:
+        time.sleep(COMPACTION_INTERVAL_SECONDS)
+        service = get_knn_service()
+        if service.is_model_loaded() and service.catalog_revision > 0:
+            _compact_in_background()
+
+@app.on_event("startup")
+def start_model_watcher():
+    """Cargar el modelo al arrancar y, si está configurado, vigilar el artefacto y compactar el catálogo"""
+    service = get_knn_service()
+    if service.SIMILAR_CACHE_WARMUP > 0:
+        threading.Thread(target=service.warm_similar_cache, name="knn-cache-warmup", daemon=True).start()
+    if RELOAD_POLL_SECONDS > 0:
+        threading.Thread(target=_watch_model_artifact, name="knn-model-watcher", daemon=True).start()
+        logger.info(f"👀 Vigilando el artefacto KNN cada {RELOAD_POLL_SECONDS}s")
+    if COMPACTION_INTERVAL_SECONDS > 0:
+        threading.Thread(target=_periodic_compaction, name="knn-catalog-compactor", daemon=True).start()
+        logger.info(f"🧹 Compactación del catálogo KNN cada {COMPACTION_INTERVAL_SECONDS}s")
+
+@app.on_event("shutdown")
+def close_db_pool():
+    """Cerrar las conexiones del pool compartido y los executors al apagar la API"""
+    knn_executor.shutdown()
+    close_database_pool()
+
 # Modelos Pydantic
 class SocialRecommendation(BaseModel):
     movie_id: int
@@ -92,19 +363,44 @@ class UserKNNRecommendationsRequest(BaseModel):
     user_id: Optional[int] = None
     limit: int = 10
     user_watched_movies: Optional[list] = None
+    mode: Optional[str] = None  # 'seeds' (vecinos por película vista) o 'profile' (centroide del usuario)
 
 class SimilarMoviesKNNRequest(BaseModel):
     movie_id: int
     limit: int = 5
 
+class SimilarMoviesBatchRequest(BaseModel):
+    movie_ids: List[int]
+    limit: int = 5
+    limits: Optional[Dict[int, int]] = None  # Límite por película (si falta se usa 'limit')
+
+class ReloadRequest(BaseModel):
+    model_path: Optional[str] = None
+
+class CatalogMovie(BaseModel):
+    id: int
+    title: str
+    genre_ids: List[int] = []
+    vote_average: Optional[float] = None
+    vote_count: Optional[int] = None
+    popularity: Optional[float] = None
+    release_date: Optional[str] = None
+
+class CatalogUpsertRequest(BaseModel):
+    movies: List[CatalogMovie]
+
+class CatalogDeleteRequest(BaseModel):
+    movie_ids: List[int]
+
 class EvaluationRequest(BaseModel):
     user_id: int
     recommendations: List[Dict]
     top_k: int = 10
+    user_history: Optional[List[Dict]] = None  # [{movie_id, rating, watched}]; si se envía no se consulta la BD
 
 # Rutas de la API
 @app.get("/")
-def read_root():
+async def read_root():
     return {
         "message": "MovieMatch KNN API is running ✅",
         "version": "1.0.0",
@@ -112,7 +408,7 @@ def read_root():
     }
 
 @app.get("/health")
-def health_check():
+async def health_check():
     """Verificar estado del servicio KNN"""
     service = get_knn_service()
     status = service.get_model_status()
@@ -121,6 +417,13 @@ def health_check():
         "status": "healthy" if status['knn_loaded'] else "warning",
         "knn_service": status,
         "message": "KNN API funcionando correctamente" if status['knn_loaded'] else "Modelo KNN no cargado",
+        "model_version": model_state["model_version"],
+        "model_loaded_at": model_state["loaded_at"],
+        "model_load_seconds": model_state["load_seconds"],
+        "db_pool": database_pool_stats(),
+        "executor": knn_executor.stats(),
+        "limits": {name: limiter.stats() for name, limiter in limiters.items()},
+        "microbatching": {name: batcher.stats() for name, batcher in batchers.items()},
         "model_info": {
             "algorithm": "K-Nearest Neighbors",
             "total_movies": status.get('total_movies', 0),
@@ -132,19 +435,37 @@ def health_check():
     }
 
 @app.post("/recommendations/knn")
-def get_user_knn_recommendations(request: UserKNNRecommendationsRequest = Body(...)):
+async def get_user_knn_recommendations(request: UserKNNRecommendationsRequest = Body(...)):
     """Obtener recomendaciones KNN para un usuario o lista de películas vistas"""
+    async with limiters["recommendations"]:
+        return await _user_knn_recommendations(request)
+
+async def _user_knn_recommendations(request: UserKNNRecommendationsRequest) -> Dict:
     try:
         service = get_knn_service()
-        recs = service.get_user_recommendations(
-            user_id=request.user_id,
-            limit=request.limit,
-            user_watched_movies=request.user_watched_movies
-        )
+        
+        # El historial se lee en el pool de E/S y el cómputo recibe la lista ya hecha
+        watched = request.user_watched_movies
+        if not watched and request.user_id is not None and service.db_pool:
+            watched = await knn_executor.io(service._get_user_watched_movies, request.user_id)
+            if not watched:
+                logger.info(f"📝 Usuario {request.user_id} no tiene películas vistas, recomendando películas populares")
+        
+        if watched and "recommendations" in batchers:
+            recs = await batchers["recommendations"].submit(
+                {"user_watched_movies": watched, "limit": request.limit, "mode": request.mode}
+            )
+        elif watched:
+            recs = await knn_executor.compute(
+                service, "get_user_recommendations",
+                user_id=request.user_id, limit=request.limit, user_watched_movies=watched, mode=request.mode
+            )
+        else:
+            recs = await knn_executor.compute(service, "get_user_recommendations", limit=request.limit)
         return {
             "user_id": request.user_id,
             "recommendations": recs,
-            "total_movies": len(service.movies_df) if service.movies_df is not None else 0,
+            "total_movies": len(service.movie_ids) if service.movie_ids is not None else 0,
             "neighbors_used": service.KNN_NEIGHBORS,
             "features_used": len(service.feature_columns)
         }
@@ -153,18 +474,39 @@ def get_user_knn_recommendations(request: UserKNNRecommendationsRequest = Body(.
         raise HTTPException(status_code=500, detail=str(e))
 
 @app.post("/similar")
-def get_similar_movies_knn(request: SimilarMoviesKNNRequest):
+async def get_similar_movies_knn(request: SimilarMoviesKNNRequest):
     """Obtener películas similares usando KNN"""
+    # Camino rápido: los aciertos de caché se responden desde el loop, sin executor ni límite
+    service = get_knn_service()
+    cached = service.cached_similar_movies(request.movie_id, request.limit) if service.is_model_loaded() else None
+    if cached is not None:
+        return {
+            "movie_id": request.movie_id,
+            "similar_movies": cached,
+            "neighbors_used": service.KNN_NEIGHBORS
+        }
+    async with limiters["similar"]:
+        return await _similar_movies(request)
+
+async def _similar_movies(request: SimilarMoviesKNNRequest) -> Dict:
     try:
         service = get_knn_service()
         
-        if not service.knn_model:
+        if not service.is_model_loaded():
             raise HTTPException(status_code=503, detail="Modelo KNN no disponible")
         
-        similar_movies = service.find_similar_movies(
-            movie_id=request.movie_id,
-            top_k=request.limit
-        )
+        generation = service.similar_cache_generation()
+        if "similar" in batchers:
+            similar_movies = await batchers["similar"].submit((request.movie_id, request.limit))
+        else:
+            similar_movies = await knn_executor.compute(
+                service, "compute_similar_movies",
+                movie_id=request.movie_id,
+                top_k=request.limit
+            )
+        if knn_executor.kind == "process" and "similar" not in batchers:
+            # Calculado en otro proceso: guardarlo en la caché de este para el camino rápido
+            service.store_similar_movies(request.movie_id, request.limit, similar_movies, generation)
         
         return {
             "movie_id": request.movie_id,
@@ -176,22 +518,59 @@ def get_similar_movies_knn(request: SimilarMoviesKNNRequest):
         logger.error(f"Error obteniendo películas similares: {e}")
         raise HTTPException(status_code=500, detail=str(e))
 
-@app.post("/evaluate")
-def evaluate_recommendations(request: EvaluationRequest):
-    """Evaluar la calidad de las recomendaciones KNN"""
+@app.post("/similar/batch")
+async def get_similar_movies_batch(request: SimilarMoviesBatchRequest):
+    """Películas similares para muchas películas en una llamada (respuesta compacta por id)"""
+    movie_ids = list(dict.fromkeys(request.movie_ids))  # Sin duplicados, en el orden recibido
+    if len(movie_ids) > SIMILAR_BATCH_MAX_IDS:
+        raise HTTPException(status_code=400, detail=f"Máximo {SIMILAR_BATCH_MAX_IDS} películas por llamada")
+    limits = request.limits or {}
+    top_ks = [limits.get(movie_id, request.limit) for movie_id in movie_ids]
+    if any(top_k < 1 for top_k in top_ks):
+        raise HTTPException(status_code=400, detail="Los límites deben ser positivos")
+    
+    service = get_knn_service()
+    if not service.is_model_loaded():
+        raise HTTPException(status_code=503, detail="Modelo KNN no disponible")
+    
+    async with limiters["similar"]:
+        try:
+            response = await knn_executor.compute(
+                service, "similar_movies_bulk", movie_ids=movie_ids, top_ks=top_ks
+            )
+        except Exception as e:
+            logger.error(f"Error obteniendo películas similares en bloque: {e}")
+            raise HTTPException(status_code=500, detail=str(e))
+    
+    response["neighbors_used"] = service.KNN_NEIGHBORS
+    return response
+
+def _evaluate_with_catalog(request: EvaluationRequest) -> Dict:
+    """Evaluación síncrona (consulta del historial + métricas sobre el catálogo en memoria)"""
+    from knn_evaluation import KNNEvaluator
+    
+    # Métricas sobre el catálogo ya cargado; la BD solo hace falta para leer el historial
+    evaluator = KNNEvaluator(knn_service=get_knn_service(), connect=request.user_history is None)
     try:
-        from knn_evaluation import KNNEvaluator
-        
-        evaluator = KNNEvaluator()
-        
-        # Evaluar las recomendaciones
-        metrics = evaluator.evaluate_user_recommendations(
+        return evaluator.evaluate_user_recommendations(
             user_id=request.user_id,
             recommendations=request.recommendations,
-            top_k=request.top_k
+            top_k=request.top_k,
+            user_history=request.user_history
         )
-        
+    finally:
         evaluator.close()
+
+@app.post("/evaluate")
+async def evaluate_recommendations(request: EvaluationRequest):
+    """Evaluar la calidad de las recomendaciones KNN"""
+    async with limiters["evaluate"]:
+        return await _evaluate(request)
+
+async def _evaluate(request: EvaluationRequest) -> Dict:
+    try:
+        # Evaluar las recomendaciones
+        metrics = await knn_executor.io(_evaluate_with_catalog, request)
         
         if "error" in metrics:
             raise HTTPException(status_code=400, detail=metrics["error"])
@@ -225,8 +604,12 @@ def _get_quality_recommendation(metrics: Dict) -> str:
         return "⚠️ Calidad baja - Considera ajustar el modelo"
 
 @app.post("/expand-recommendations")
-def expand_social_recommendations(request: EfficientRecommendationRequest):
+async def expand_social_recommendations(request: EfficientRecommendationRequest):
     """Expandir recomendaciones sociales con KNN (Estrategia 1 & 2)"""
+    async with limiters["recommendations"]:
+        return await _expand_social_recommendations(request)
+
+async def _expand_social_recommendations(request: EfficientRecommendationRequest) -> Dict:
     try:
         service = get_knn_service()
         
@@ -249,7 +632,9 @@ def expand_social_recommendations(request: EfficientRecommendationRequest):
         }
         
         # Expandir recomendaciones
-        expanded_recs = service.expand_social_recommendations(social_recs)
+        expanded_recs = await knn_executor.compute(
+            service, "expand_social_recommendations", social_recommendations=social_recs
+        )
         
         return {
             "original_count": len(social_recs),
@@ -263,8 +648,12 @@ def expand_social_recommendations(request: EfficientRecommendationRequest):
         raise HTTPException(status_code=500, detail=str(e))
 
 @app.post("/efficient-recommendations")
-def get_efficient_recommendations(request: EfficientRecommendationRequest):
+async def get_efficient_recommendations(request: EfficientRecommendationRequest):
     """Obtener recomendaciones eficientes combinando las 3 estrategias"""
+    async with limiters["recommendations"]:
+        return await _efficient_recommendations(request)
+
+async def _efficient_recommendations(request: EfficientRecommendationRequest) -> Dict:
     try:
         service = get_knn_service()
         
@@ -287,7 +676,9 @@ def get_efficient_recommendations(request: EfficientRecommendationRequest):
         }
         
         # Obtener recomendaciones eficientes
-        final_recommendations = service.get_efficient_recommendations(social_recs, user_features)
+        final_recommendations = await knn_executor.compute(
+            service, "get_efficient_recommendations", social_recommendations=social_recs, user_features=user_features
+        )
         
         return {
             "original_count": len(social_recs),
@@ -305,37 +696,130 @@ def get_efficient_recommendations(request: EfficientRecommendationRequest):
         raise HTTPException(status_code=500, detail=str(e))
 
 @app.get("/model-status")
-def get_model_status():
+async def get_model_status():
     """Obtener estado detallado del modelo KNN"""
     service = get_knn_service()
-    return service.get_model_status()
+    return {**service.get_model_status(), "active_model": model_state}
+
+memory_tracer = TracemallocDiff()
 
-@app.post("/train-model")
-def train_model():
-    """Entrenar modelo KNN (endpoint para desarrollo)"""
+def _memory_report(trace: Optional[str], top: int) -> Dict:
+    """Memoria del proceso y de lo que retiene el servicio activo (la caché se cuenta con sus propios bytes)"""
+    service = get_knn_service()
+    resident = {
+        "knn_service": object_report(service, skip=("db_pool",), overrides={"similar_cache": service.similar_cache.bytes})
+    }
+    return memory_report(resident, memory_tracer, trace, top)
+
+@app.get("/debug/memory", dependencies=[Depends(require_admin)])
+async def debug_memory(trace: Optional[str] = None, top: int = 20):
+    """Tamaño de modelo, catálogo y cachés, RSS del proceso y (trace=start|diff|stop) diff de tracemalloc"""
+    if trace not in (None, "start", "diff", "stop"):
+        raise HTTPException(status_code=400, detail="trace debe ser start, diff o stop")
+    return await knn_executor.io(_memory_report, trace, top)
+
+@app.post("/admin/reload", dependencies=[Depends(require_admin)])
+async def reload_model(request: ReloadRequest = Body(ReloadRequest())):
+    """Recargar el modelo KNN en segundo plano sin reiniciar el proceso"""
+    if not _reload_in_background(request.model_path):
+        raise HTTPException(status_code=409, detail="Ya hay una recarga en curso")
+    return {
+        "message": "Recarga del modelo KNN iniciada",
+        "active_model": model_state
+    }
+
+@app.post("/catalog/movies", dependencies=[Depends(require_admin)])
+async def upsert_catalog_movies(request: CatalogUpsertRequest):
+    """
+    Alta o modificación incremental de películas en el índice KNN (sin reentrenar).
+    
+    El cambio se registra en el log del catálogo junto al artefacto (ver
+    knn_catalog_updates.append_catalog_log) y se reaplica en cada carga: sobrevive a
+    recargas, compactaciones y reinicios, y los procesos de cómputo lo ven al reciclarse.
+    Con varios workers de uvicorn solo lo aplica en caliente el worker que recibe la
+    petición; los demás lo ven en su próxima recarga del modelo.
+    """
+    service = get_knn_service()
+    if not service.is_model_loaded():
+        raise HTTPException(status_code=503, detail="Modelo KNN no disponible")
     try:
-        service = get_knn_service()
-        
-        if service.movies_df is None:
-            raise HTTPException(status_code=400, detail="No hay datos de películas para entrenar")
-        
-        service.train_knn_model()
-        service.save_knn_model("knn_model.pkl")
-        
-        status = service.get_model_status()
-        
-        return {
-            "message": "Modelo KNN entrenado exitosamente",
-            "model_status": status
-        }
-        
+        # Modifica el servicio de este proceso: pool de E/S, nunca el executor de procesos
+        async with limiters["catalog"]:
+            result = await knn_executor.io(_apply_catalog_update, "upsert_movies", [movie.dict() for movie in request.movies])
+    except HTTPException:
+        raise
     except Exception as e:
-        logger.error(f"Error entrenando modelo: {e}")
+        logger.error(f"Error actualizando el catálogo KNN: {e}")
         raise HTTPException(status_code=500, detail=str(e))
+    return {"message": "Catálogo KNN actualizado", **result}
+
+@app.post("/catalog/movies/delete", dependencies=[Depends(require_admin)])
+async def delete_catalog_movies(request: CatalogDeleteRequest):
+    """Marcar películas como borradas en el índice KNN (persistido igual que /catalog/movies)"""
+    service = get_knn_service()
+    if not service.is_model_loaded():
+        raise HTTPException(status_code=503, detail="Modelo KNN no disponible")
+    async with limiters["catalog"]:
+        result = await knn_executor.io(_apply_catalog_update, "delete_movies", request.movie_ids)
+    return {"message": "Películas marcadas como borradas", **result}
+
+@app.post("/catalog/sync-deleted", dependencies=[Depends(require_admin)])
+async def sync_deleted_catalog_movies():
+    """Aplicar como tombstones las películas de la tabla deleted_movies (persistido igual que /catalog/movies)"""
+    service = get_knn_service()
+    if not service.is_model_loaded():
+        raise HTTPException(status_code=503, detail="Modelo KNN no disponible")
+    async with limiters["catalog"]:
+        result = await knn_executor.io(_apply_catalog_update, "sync_deleted_movies")
+    return {"message": "Películas borradas sincronizadas", **result}
+
+@app.post("/catalog/compact", status_code=202, dependencies=[Depends(require_admin)])
+async def compact_catalog():
+    """Reentrenar el catálogo vivo en segundo plano descartando las filas borradas"""
+    if not _compact_in_background():
+        raise HTTPException(status_code=409, detail="Ya hay una compactación en curso")
+    return {"message": "Compactación del catálogo KNN iniciada", "active_model": model_state}
+
+def _training_output_path() -> str:
+    """Destino del entrenamiento: el artefacto activo, o knn_model/ si el activo es un .pkl heredado"""
+    model_path = model_state["model_path"] or EfficientKNNService.default_model_path()
+    return "knn_model" if model_path.endswith(".pkl") else model_path
+
+# Al terminar un entrenamiento, el artefacto nuevo se entrega al servicio activo
+training_jobs = TrainingJobManager(on_complete=lambda path: _reload_in_background(path))
+
+@app.post("/train-model", status_code=202)
+async def train_model():
+    """Entrenar modelo KNN en un proceso aparte (endpoint para desarrollo); devuelve el id del trabajo"""
+    try:
+        # Arrancar un proceso 'spawn' tarda: fuera del event loop
+        job = await knn_executor.io(training_jobs.submit, _training_output_path())
+    except RuntimeError as e:
+        raise HTTPException(status_code=409, detail=str(e))
+    
+    return {
+        "message": "Entrenamiento KNN iniciado",
+        "job_id": job["job_id"],
+        "status_url": f"/train-model/{job['job_id']}",
+        "job": job
+    }
+
+@app.get("/train-model/jobs")
+async def list_training_jobs():
+    """Listar los trabajos de entrenamiento recientes"""
+    return {"jobs": training_jobs.list()}
+
+@app.get("/train-model/{job_id}")
+async def get_training_job(job_id: str):
+    """Estado de un entrenamiento: fase (loading, features, fit, neighbor_table, save), tiempo y memoria pico"""
+    job = training_jobs.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail=f"Trabajo {job_id} no encontrado")
+    return job
 
 # Ejemplo de uso
 @app.get("/example")
-def get_example():
+async def get_example():
     """Ejemplo de cómo usar la API"""
     return {
         "example_request": {
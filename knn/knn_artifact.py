@@ -0,0 +1,245 @@
+"""
+Formato de artefacto del modelo KNN sin pickle y con memory-mapping.
+
+Un artefacto es un directorio con una subcarpeta por versión y un puntero a la publicada:
+
+    knn_model/
+        CURRENT                     nombre de la versión publicada (se sustituye con os.replace)
+        catalog_updates.jsonl       log de altas/bajas incrementales, común a todas las versiones
+        versions/<versión>/
+            manifest.json               versión, columnas, parámetros del scaler, lista de arrays
+            features.npy                matriz escalada (n_movies, n_features)
+            normalized.npy              copia L2-normalizada float32 usada por el motor exacto
+            neighbor_indices.npy        tabla de vecinos (n_movies, K_max) int32
+            neighbor_similarities.npy   similitudes de la tabla float32
+            movie_ids.npy               ids alineados con las filas
+            tombstoned.npy              filas borradas pendientes de compactar (opcional)
+            catalog/*.npy               metadatos columnares float32/int32 (votos, popularidad, géneros CSR,
+                                        títulos internados en un buffer con offsets)
+            ann_*.npy                   índice aproximado (opcional)
+
+Un lector resuelve CURRENT y abre esa versión, así que siempre encuentra un artefacto
+completo; la versión anterior se conserva para los lectores que ya la habían resuelto.
+Los directorios antiguos con manifest.json en la raíz se siguen leyendo.
+
+Los .npy se abren con np.load(mmap_mode='r'): el arranque no copia datos y varios
+workers de uvicorn comparten las mismas páginas físicas del page cache.
+"""
+
+import json
+import os
+import shutil
+import time
+import uuid
+import logging
+import numpy as np
+import pandas as pd
+from typing import Dict, Optional
+from sklearn.preprocessing import StandardScaler
+
+logger = logging.getLogger(__name__)
+
+ARTIFACT_FORMAT_VERSION = 1
+MANIFEST_FILE = 'manifest.json'
+CURRENT_FILE = 'CURRENT'
+VERSIONS_DIR = 'versions'
+CATALOG_DIR = 'catalog'
+
+# Columnas numéricas del catálogo que se guardan tal cual (además de las de características)
+CATALOG_NUMERIC_COLUMNS = ['vote_average', 'vote_count', 'popularity']
+
+def resolve_artifact_dir(path: str) -> Optional[str]:
+    """Directorio de la versión publicada (CURRENT), el propio path en el formato antiguo o None"""
+    if not path or not os.path.isdir(path):
+        return None
+    current_path = os.path.join(path, CURRENT_FILE)
+    if os.path.exists(current_path):
+        with open(current_path) as f:
+            return os.path.join(path, VERSIONS_DIR, f.read().strip())
+    return path if os.path.exists(os.path.join(path, MANIFEST_FILE)) else None
+
+
+def is_artifact_dir(path: str) -> bool:
+    """¿La ruta es un directorio de artefacto KNN?"""
+    return resolve_artifact_dir(path) is not None
+
+
+def artifact_marker_path(path: str) -> str:
+    """Archivo que cambia con cada publicación (CURRENT, o manifest.json en el formato antiguo)"""
+    current_path = os.path.join(path, CURRENT_FILE)
+    return current_path if os.path.exists(current_path) else os.path.join(path, MANIFEST_FILE)
+
+
+def read_manifest(artifact_dir: str) -> Dict:
+    """Leer el manifest de la versión publicada de un artefacto"""
+    with open(os.path.join(resolve_artifact_dir(artifact_dir), MANIFEST_FILE)) as f:
+        return json.load(f)
+
+
+def save_knn_artifact(service, artifact_dir: str) -> str:
+    """
+    Guardar el estado del servicio como una versión nueva del artefacto y publicarla.
+
+    La versión se escribe en un directorio temporal, se renombra a versions/<versión> y
+    solo entonces se apunta CURRENT a ella. Devuelve la versión generada.
+    """
+    artifact_dir = os.path.abspath(artifact_dir)
+    version = f"{time.strftime('%Y%m%d%H%M%S')}-{uuid.uuid4().hex[:8]}"
+    versions_dir = os.path.join(artifact_dir, VERSIONS_DIR)
+    tmp_dir = os.path.join(versions_dir, f".tmp-{version}")
+    os.makedirs(os.path.join(tmp_dir, CATALOG_DIR))
+
+    movies_df = service.catalog_frame()
+    arrays = {
+        'features': np.ascontiguousarray(service.feature_matrix),
+        'normalized': service.search_engine.normalized_rows()
+        if hasattr(service.search_engine, 'normalized_rows') else None,
+        'neighbor_indices': service.neighbor_indices,
+        'neighbor_similarities': service.neighbor_similarities,
+        'movie_ids': service.movie_ids,
+        'tombstoned': service.tombstoned,
+    }
+    if arrays['normalized'] is None:
+        from knn_engines import ExactCosineEngine
+        arrays['normalized'] = ExactCosineEngine._normalize(service.feature_matrix)
+    if service.ann_index is not None:
+        arrays.update({f"ann_{name}": value for name, value in service.ann_index.to_arrays().items()})
+
+    written_arrays = []
+    for name, value in arrays.items():
+        if value is not None:
+            np.save(os.path.join(tmp_dir, f"{name}.npy"), np.ascontiguousarray(value))
+            written_arrays.append(name)
+
+    # Metadatos columnares: solo lo que leen las rutas de consulta
+    catalog_columns = []
+    for column in CATALOG_NUMERIC_COLUMNS + list(service.feature_columns):
+        if column in movies_df.columns and column not in catalog_columns:
+            np.save(os.path.join(tmp_dir, CATALOG_DIR, f"{column}.npy"), movies_df[column].to_numpy())
+            catalog_columns.append(column)
+    np.save(os.path.join(tmp_dir, CATALOG_DIR, 'title_bytes.npy'), np.asarray(service.title_bytes))
+    np.save(os.path.join(tmp_dir, CATALOG_DIR, 'title_offsets.npy'), np.asarray(service.title_offsets))
+    has_genres = service.genre_offsets is not None
+    if has_genres:
+        np.save(os.path.join(tmp_dir, CATALOG_DIR, 'genre_offsets.npy'), np.asarray(service.genre_offsets))
+        np.save(os.path.join(tmp_dir, CATALOG_DIR, 'genre_values.npy'), np.asarray(service.genre_values))
+
+    scaler = service.scaler
+    manifest = {
+        'format_version': ARTIFACT_FORMAT_VERSION,
+        'version': version,
+        'created_at': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        'total_movies': int(len(movies_df)),
+        'feature_columns': list(service.feature_columns),
+        'feature_version': service.feature_version,
+        'catalog_snapshot_at': service.catalog_snapshot_at,
+        'neighbor_table_k': int(service.neighbor_indices.shape[1]) if service.neighbor_indices is not None else 0,
+        'arrays': written_arrays,
+        'catalog_columns': catalog_columns,
+        'has_genres': has_genres,
+        'scaler': {
+            'mean': scaler.mean_.tolist(),
+            'scale': scaler.scale_.tolist(),
+            'var': scaler.var_.tolist(),
+            'n_samples_seen': int(np.max(scaler.n_samples_seen_))
+        },
+        'ann_report': service.ann_report
+    }
+    with open(os.path.join(tmp_dir, MANIFEST_FILE), 'w') as f:
+        json.dump(manifest, f, indent=2)
+
+    os.rename(tmp_dir, os.path.join(versions_dir, version))
+    previous_dir = resolve_artifact_dir(artifact_dir)
+    _publish_version(artifact_dir, version)
+    _remove_old_versions(artifact_dir, {version, os.path.basename(previous_dir or '')})
+
+    logger.info(f"✅ Artefacto KNN {version} guardado en {artifact_dir}")
+    return version
+
+
+def _publish_version(artifact_dir: str, version: str):
+    """Apuntar CURRENT a la versión con un reemplazo atómico"""
+    tmp_path = os.path.join(artifact_dir, f"{CURRENT_FILE}.tmp-{os.getpid()}")
+    with open(tmp_path, 'w') as f:
+        f.write(version)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, os.path.join(artifact_dir, CURRENT_FILE))
+
+
+def _remove_old_versions(artifact_dir: str, keep: set):
+    """Borrar las versiones que no están en keep y los archivos del formato antiguo en la raíz"""
+    versions_dir = os.path.join(artifact_dir, VERSIONS_DIR)
+    for name in os.listdir(versions_dir):
+        if name not in keep and not name.startswith('.'):
+            shutil.rmtree(os.path.join(versions_dir, name), ignore_errors=True)
+
+    if os.path.exists(os.path.join(artifact_dir, MANIFEST_FILE)):
+        os.remove(os.path.join(artifact_dir, MANIFEST_FILE))
+        shutil.rmtree(os.path.join(artifact_dir, CATALOG_DIR), ignore_errors=True)
+        for name in os.listdir(artifact_dir):
+            if name.endswith('.npy'):
+                os.remove(os.path.join(artifact_dir, name))
+
+
+def load_knn_artifact(service, artifact_dir: str, mmap: bool = True) -> Dict:
+    """
+    Cargar la versión publicada de un artefacto en el servicio. Con mmap=True los arrays
+    quedan mapeados en solo lectura y no se copian a memoria privada del proceso.
+    """
+    from knn_engines import ExactCosineEngine, RandomProjectionLSHIndex
+
+    artifact_dir = resolve_artifact_dir(artifact_dir)
+    manifest = read_manifest(artifact_dir)
+    mmap_mode = 'r' if mmap else None
+
+    def load_array(name: str, subdir: str = '') -> Optional[np.ndarray]:
+        path = os.path.join(artifact_dir, subdir, f"{name}.npy")
+        return np.load(path, mmap_mode=mmap_mode) if os.path.exists(path) else None
+
+    # Scaler reconstruido desde sus parámetros
+    scaler = StandardScaler()
+    scaler.mean_ = np.asarray(manifest['scaler']['mean'])
+    scaler.scale_ = np.asarray(manifest['scaler']['scale'])
+    scaler.var_ = np.asarray(manifest['scaler']['var'])
+    scaler.n_samples_seen_ = manifest['scaler']['n_samples_seen']
+    scaler.n_features_in_ = len(scaler.mean_)
+
+    # Catálogo: columnas numéricas, títulos y géneros sobre los arrays mapeados, sin decodificar
+    catalog = {'id': load_array('movie_ids')}
+    for column in manifest['catalog_columns']:
+        catalog[column] = load_array(column, CATALOG_DIR)
+    service.title_bytes = load_array('title_bytes', CATALOG_DIR)
+    service.title_offsets = load_array('title_offsets', CATALOG_DIR)
+    if manifest.get('has_genres'):
+        service.genre_offsets = load_array('genre_offsets', CATALOG_DIR)
+        service.genre_values = load_array('genre_values', CATALOG_DIR)
+    else:
+        service.genre_offsets = service.genre_values = None
+
+    service.scaler = scaler
+    service.feature_columns = manifest['feature_columns']
+    service.feature_version = manifest.get('feature_version', 1)
+    service.catalog_snapshot_at = manifest.get('catalog_snapshot_at')
+    # Artefactos antiguos guardaban float64: se convierten (los nuevos ya vienen compactos y siguen mapeados)
+    service.movies_df = service._compact_catalog(pd.DataFrame(catalog, copy=False))
+    service.feature_matrix = load_array('features')
+    service._publish_neighbor_table(load_array('neighbor_indices'), load_array('neighbor_similarities'))
+    service.tombstoned = np.array(load_array('tombstoned')) if 'tombstoned' in manifest['arrays'] else None
+    service._build_id_index(service.movies_df['id'].to_numpy())
+
+    normalized = load_array('normalized')
+    if service.KNN_ENGINE == 'sklearn':
+        service._build_search_engine()
+    else:
+        service.search_engine = ExactCosineEngine(normalized_matrix=normalized,
+                                                  query_buffer_bytes=service.ENGINE_QUERY_BUFFER_BYTES)
+
+    if 'ann_params' in manifest['arrays']:
+        ann_arrays = {name: load_array(f"ann_{name}") for name in ('hyperplanes', 'sorted_codes', 'sorted_rows', 'params')}
+        service.ann_index = RandomProjectionLSHIndex.from_arrays(ann_arrays, normalized)
+    service.ann_report = manifest.get('ann_report')
+
+    logger.info(f"✅ Artefacto KNN {manifest['version']} cargado desde {artifact_dir} "
+                f"({'mmap' if mmap else 'en memoria'})")
+    return manifest
@@ -0,0 +1,111 @@
+"""
+Caché LRU en proceso para respuestas del servicio KNN (p. ej. /similar).
+
+Acotada por número de entradas y por bytes estimados; al superar cualquiera de los dos
+límites se expulsan las entradas usadas hace más tiempo. El servicio incluye la versión
+del modelo y la revisión del catálogo en la generación de la caché, así que una recarga
+o un alta/baja incremental la vacía sin tener que invalidar claves una a una. Las
+lecturas y escrituras que llegan con una generación ya superada (un cálculo que empezó
+antes del cambio) se ignoran en lugar de vaciar la caché otra vez.
+"""
+
+import sys
+import threading
+from collections import OrderedDict, deque
+from typing import Dict, Hashable, List, Optional
+
+
+def estimate_result_bytes(results: List[Dict]) -> int:
+    """Tamaño aproximado de una lista de dicts de respuesta (contenedores + valores)"""
+    size = sys.getsizeof(results)
+    for item in results:
+        size += sys.getsizeof(item) + sum(sys.getsizeof(value) for value in item.values())
+    return size
+
+
+class LRUResultCache:
+    """OrderedDict con expulsión LRU, límites de entradas/bytes y contadores de aciertos"""
+
+    def __init__(self, max_entries: int, max_bytes: int):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._entries: 'OrderedDict[Hashable, tuple]' = OrderedDict()  # clave -> (resultado, bytes)
+        self._lock = threading.Lock()
+        self._generation = None
+        self._retired_generations = deque(maxlen=64)  # Generaciones superadas, para reconocer resultados tardíos
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_entries > 0 and self.max_bytes > 0
+
+    def get(self, key: Hashable, generation: Hashable = None) -> Optional[List[Dict]]:
+        """Resultado cacheado (copias de los dicts) o None; una generación nueva vacía la caché"""
+        if not self.enabled:
+            return None
+        with self._lock:
+            if not self._check_generation(generation):
+                self.misses += 1
+                return None
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+        # Copias: quien recibe el resultado puede añadir campos (p. ej. 'score') sin tocar la caché
+        return [dict(item) for item in entry[0]]
+
+    def put(self, key: Hashable, results: List[Dict], generation: Hashable = None):
+        """Guardar un resultado y expulsar por LRU hasta volver a los límites"""
+        if not self.enabled:
+            return
+        size = estimate_result_bytes(results)
+        if size > self.max_bytes:
+            return
+        stored = [dict(item) for item in results]
+        with self._lock:
+            if not self._check_generation(generation):
+                return
+            previous = self._entries.pop(key, None)
+            if previous is not None:
+                self.bytes -= previous[1]
+            self._entries[key] = (stored, size)
+            self.bytes += size
+            while len(self._entries) > self.max_entries or self.bytes > self.max_bytes:
+                _, (_, evicted_size) = self._entries.popitem(last=False)
+                self.bytes -= evicted_size
+                self.evictions += 1
+
+    def _check_generation(self, generation: Hashable) -> bool:
+        """Pasar a una generación nueva vaciando la caché; False si la generación ya fue superada"""
+        if generation == self._generation:
+            return True
+        if generation in self._retired_generations:
+            return False
+        self._retired_generations.append(self._generation)
+        self._entries.clear()
+        self.bytes = 0
+        self._generation = generation
+        return True
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.bytes = 0
+
+    def stats(self) -> Dict:
+        lookups = self.hits + self.misses
+        return {
+            'entries': len(self._entries),
+            'bytes': self.bytes,
+            'max_entries': self.max_entries,
+            'max_bytes': self.max_bytes,
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': round(self.hits / lookups, 4) if lookups else 0.0,
+            'evictions': self.evictions
+        }
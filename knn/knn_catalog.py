@@ -0,0 +1,264 @@
+"""
+Almacenamiento del catálogo KNN en memoria y en el artefacto.
+
+Columnas numéricas con el dtype mínimo (CATALOG_DTYPES), títulos internados en un buffer
+UTF-8 con offsets y géneros en CSR. Con altas incrementales, cada array es un
+SegmentedArray: la base (a menudo memory-mapped) más un delta que se fusiona al compactar.
+"""
+
+from typing import Dict, List, Optional
+
+import numpy as np
+import pandas as pd
+
+# Catálogo compacto en memoria: solo columnas numéricas, con el dtype más pequeño que basta.
+# Títulos y géneros van aparte como buffer + offsets; overview, poster_path y release_date no se guardan
+CATALOG_DTYPES = {
+    'id': np.int64,
+    'vote_average': np.float32,
+    'vote_count': np.int32,
+    'popularity': np.float32,
+    'years_since_release': np.float32,
+    'genre_diversity': np.int32,
+    'avg_user_rating': np.float32,
+    'user_rating_count': np.int32,
+}
+
+# Decimales con los que llegan de TMDB las columnas float32 que se devuelven en las respuestas
+DISPLAY_DECIMALS = {'vote_average': 3, 'popularity': 4}
+
+
+class SegmentedArray:
+    """
+    Array de solo lectura: base + filas añadidas al final (tail) + filas de la base
+    sustituidas (overrides, ordenadas por posición).
+
+    Cada escritura devuelve un objeto nuevo que comparte la base, así que se publica con
+    una sola asignación. Admite lo que usan las rutas de consulta (len, shape, indexado por
+    entero, slice, posiciones, máscara y (filas, columnas)); np.asarray lo materializa.
+    """
+
+    def __init__(self, base: np.ndarray, tail: np.ndarray = None,
+                 override_positions: np.ndarray = None, override_rows: np.ndarray = None):
+        empty_rows = np.empty((0,) + base.shape[1:], dtype=base.dtype)
+        self.base = base
+        self._base = np.asarray(base)  # Vista ndarray (sin copia) de un np.memmap: indexar es más barato
+        self.tail = empty_rows if tail is None else tail
+        self.override_positions = np.empty(0, dtype=np.int64) if override_positions is None else override_positions
+        self.override_rows = empty_rows if override_rows is None else override_rows
+
+    @classmethod
+    def wrap(cls, array: np.ndarray) -> 'SegmentedArray':
+        return array if isinstance(array, cls) else cls(array)
+
+    def __len__(self) -> int:
+        return len(self.base) + len(self.tail)
+
+    @property
+    def shape(self) -> tuple:
+        return (len(self),) + self.base.shape[1:]
+
+    @property
+    def ndim(self) -> int:
+        return self.base.ndim
+
+    @property
+    def dtype(self) -> np.dtype:
+        return self.base.dtype
+
+    @property
+    def delta_rows(self) -> int:
+        """Filas fuera de la base: añadidas más sustituidas"""
+        return len(self.tail) + len(self.override_positions)
+
+    def append(self, rows) -> 'SegmentedArray':
+        """Copia con filas añadidas al final (copia solo el tail)"""
+        rows = np.asarray(rows, dtype=self.dtype).reshape((-1,) + self.base.shape[1:])
+        return SegmentedArray(self.base, np.concatenate([self.tail, rows]),
+                              self.override_positions, self.override_rows)
+
+    def with_rows(self, positions, rows) -> 'SegmentedArray':
+        """Copia con las filas de positions (sin repetir) sustituidas; la última escritura gana"""
+        positions = np.asarray(positions, dtype=np.int64)
+        rows = np.broadcast_to(np.asarray(rows, dtype=self.dtype), (len(positions),) + self.base.shape[1:])
+        n_base = len(self.base)
+        in_tail = positions >= n_base
+
+        tail = self.tail
+        if in_tail.any():
+            tail = tail.copy()
+            tail[positions[in_tail] - n_base] = rows[in_tail]
+
+        override_positions, override_rows = self.override_positions, self.override_rows
+        if not in_tail.all():
+            keep = ~np.isin(override_positions, positions)
+            override_positions = np.concatenate([override_positions[keep], positions[~in_tail]])
+            override_rows = np.concatenate([override_rows[keep], rows[~in_tail]])
+            order = np.argsort(override_positions, kind='stable')
+            override_positions, override_rows = override_positions[order], override_rows[order]
+        return SegmentedArray(self.base, tail, override_positions, override_rows)
+
+    def _row(self, position: int) -> np.ndarray:
+        """Una fila (camino rápido de las consultas de una sola película)"""
+        if position < 0:
+            position += len(self)
+        n_base = len(self._base)
+        if position >= n_base:
+            return self.tail[position - n_base]
+        if len(self.override_positions):
+            slot = int(np.searchsorted(self.override_positions, position))
+            if slot < len(self.override_positions) and self.override_positions[slot] == position:
+                return self.override_rows[slot]
+        return self._base[position]
+
+    def _take(self, positions: np.ndarray) -> np.ndarray:
+        """Filas en posiciones (cualquier forma, negativas incluidas)"""
+        flat = positions.ravel()
+        if len(flat) == 0:
+            return self._base[flat.astype(np.int64)].reshape(positions.shape + self.base.shape[1:])
+        if flat.min() < 0:
+            flat = np.where(flat < 0, flat + len(self), flat)
+        n_base = len(self._base)
+        if flat.max() < n_base:
+            taken = self._base[flat]
+        else:
+            in_base = flat < n_base
+            taken = np.empty((len(flat),) + self.base.shape[1:], dtype=self.dtype)
+            taken[in_base] = self._base[flat[in_base]]
+            taken[~in_base] = self.tail[flat[~in_base] - n_base]
+
+        if len(self.override_positions):
+            slots = np.minimum(np.searchsorted(self.override_positions, flat), len(self.override_positions) - 1)
+            hits = self.override_positions[slots] == flat
+            if hits.any():
+                taken[hits] = self.override_rows[slots[hits]]
+        return taken.reshape(positions.shape + self.base.shape[1:])
+
+    def __getitem__(self, key):
+        if isinstance(key, tuple):
+            rows, rest = key[0], key[1:]
+            if isinstance(rows, slice) or np.ndim(rows) > 0:
+                return self[rows][(slice(None),) + rest]
+            return self[rows][rest]
+        if isinstance(key, slice):
+            return self._take(np.arange(*key.indices(len(self))))
+        if np.ndim(key) == 0:
+            return self._row(int(key))
+        key = np.asarray(key)
+        return self._take(np.flatnonzero(key) if key.dtype == bool else key)
+
+    def __array__(self, dtype=None, copy=None) -> np.ndarray:
+        array = np.concatenate([self.base, self.tail])
+        array[self.override_positions] = self.override_rows
+        return array if dtype is None else array.astype(dtype, copy=False)
+
+    def tolist(self) -> list:
+        return np.asarray(self).tolist()
+
+
+def materialize(array):
+    """Array plano para guardar o reentrenar; lo que no es SegmentedArray se devuelve tal cual"""
+    return np.asarray(array) if isinstance(array, SegmentedArray) else array
+
+
+def append_ragged(offsets: np.ndarray, values: np.ndarray,
+                  new_offsets: np.ndarray, new_values: np.ndarray) -> Dict[str, SegmentedArray]:
+    """Añadir filas al final de un array ragged (títulos, géneros CSR) sin copiar sus buffers"""
+    offsets, values = SegmentedArray.wrap(offsets), SegmentedArray.wrap(values)
+    return {
+        'offsets': offsets.append(np.asarray(new_offsets[1:]) + offsets[-1]),
+        'values': values.append(new_values)
+    }
+
+
+def encode_strings(values) -> Dict[str, np.ndarray]:
+    """Internar strings en un único buffer UTF-8 con offsets"""
+    encoded = [('' if v is None else str(v)).encode('utf-8') for v in values]
+    offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+    np.cumsum([len(b) for b in encoded], out=offsets[1:])
+    buffer = np.frombuffer(b''.join(encoded), dtype=np.uint8)
+    return {'bytes': buffer, 'offsets': offsets}
+
+
+def decode_strings(buffer: np.ndarray, offsets: np.ndarray, positions=None) -> List[str]:
+    """Strings de las filas indicadas (todas si positions es None) de un buffer + offsets"""
+    positions = np.arange(len(offsets) - 1) if positions is None else positions
+    rows = take_ragged(offsets, buffer, positions)
+    data, bounds = rows['values'].tobytes(), rows['offsets'].tolist()
+    return [data[start:stop].decode('utf-8') for start, stop in zip(bounds[:-1], bounds[1:])]
+
+
+def take_ragged(offsets: np.ndarray, values: np.ndarray, positions) -> Dict[str, np.ndarray]:
+    """Filas de un array ragged (títulos, géneros CSR) en el orden de positions, como offsets + valores"""
+    positions = np.asarray(positions, dtype=np.int64)
+    starts = offsets[positions]
+    lengths = offsets[positions + 1] - starts
+    new_offsets = np.zeros(len(positions) + 1, dtype=np.int64)
+    np.cumsum(lengths, out=new_offsets[1:])
+    # Elemento j de la fila i: starts[i] + j
+    index = np.repeat(starts - new_offsets[:-1], lengths) + np.arange(new_offsets[-1])
+    return {'offsets': new_offsets, 'values': np.asarray(values[index])}
+
+
+def encode_genres(genre_column) -> Dict[str, np.ndarray]:
+    """Géneros como CSR: offsets (n+1) + valores concatenados"""
+    lists = [list(g) if isinstance(g, (list, tuple, np.ndarray)) else [] for g in genre_column]
+    offsets = np.zeros(len(lists) + 1, dtype=np.int64)
+    np.cumsum([len(g) for g in lists], out=offsets[1:])
+    values = np.fromiter((v for g in lists for v in g), dtype=np.int32, count=int(offsets[-1]))
+    return {'offsets': offsets, 'values': values}
+
+
+def compact_catalog(service, movies_df: pd.DataFrame) -> pd.DataFrame:
+    """
+    Títulos y géneros a buffers del servicio (si vienen como columnas) y el resto a CATALOG_DTYPES;
+    overview, poster_path, release_date y las listas de géneros se descartan.
+    """
+    if 'title' in movies_df.columns:
+        titles = encode_strings(movies_df['title'].tolist())
+        service.title_bytes, service.title_offsets = titles['bytes'], titles['offsets']
+    if 'genre_ids' in movies_df.columns:
+        genres = encode_genres(movies_df['genre_ids'])
+        service.genre_offsets, service.genre_values = genres['offsets'], genres['values']
+    elif service.genre_offsets is None or len(service.genre_offsets) != len(movies_df) + 1:
+        service.genre_offsets = np.zeros(len(movies_df) + 1, dtype=np.int64)
+        service.genre_values = np.empty(0, dtype=np.int32)
+
+    # astype(copy=False) conserva sin copiar las columnas que ya tienen su dtype (p. ej. mmap)
+    service._catalog_tail = None
+    columns = {
+        column: movies_df[column].to_numpy().astype(dtype, copy=False)
+        for column, dtype in CATALOG_DTYPES.items() if column in movies_df.columns
+    }
+    return pd.DataFrame(columns, copy=False)
+
+
+def catalog_column(service, column: str) -> np.ndarray:
+    """Columna base + altas; se cachea mientras movies_df y las altas sean los mismos objetos"""
+    movies_df, tail = service.movies_df, service._catalog_tail
+    cached = service._catalog_arrays
+    if cached is None or cached[0] is not movies_df or cached[1] is not tail:
+        cached = service._catalog_arrays = (movies_df, tail, {})
+    array = cached[2].get(column)
+    if array is None:
+        array = movies_df[column].to_numpy()
+        if tail is not None:
+            array = SegmentedArray(array, tail[column].to_numpy())
+        cached[2][column] = array
+    return array
+
+
+def catalog_frame(service) -> Optional[pd.DataFrame]:
+    """Catálogo completo como DataFrame; con altas es una copia"""
+    movies_df, tail = service.movies_df, service._catalog_tail
+    if movies_df is None or tail is None:
+        return movies_df
+    return pd.concat([movies_df, tail], ignore_index=True)
+
+
+def display_column(service, column: str, positions: np.ndarray) -> np.ndarray:
+    """Columna float32 en float64 redondeada a sus decimales de origen (7.6, no 7.599999904632568)"""
+    if len(positions) == 0:
+        return np.empty(0)
+    values = catalog_column(service, column)[positions].astype(np.float64)
+    return np.round(values, DISPLAY_DECIMALS[column])
@@ -0,0 +1,351 @@
+"""
+Altas y bajas incrementales del catálogo KNN, su log en disco y la compactación.
+
+Las filas añadidas y las filas parcheadas de la tabla de vecinos viven en un delta
+(SegmentedArray) encima de los arrays base, que pueden estar memory-mapped y nunca se
+copian: una escritura cuesta lo que ocupa el delta, no lo que ocupa el catálogo.
+compacted_copy() reentrena solo las filas vivas y vuelve a dejar arrays planos.
+"""
+
+import json
+import logging
+import os
+import time
+from typing import Dict, List, Optional
+
+import numpy as np
+import pandas as pd
+from sklearn.neighbors import NearestNeighbors
+
+from knn_catalog import SegmentedArray, append_ragged, encode_genres, encode_strings, take_ragged
+from knn_engines import ExactCosineEngine
+
+logger = logging.getLogger(__name__)
+
+CATALOG_LOG_FILE = 'catalog_updates.jsonl'
+
+
+def _tombstones(service) -> SegmentedArray:
+    """Tombstones actuales; sin ninguno, una base de ceros que no ocupa memoria"""
+    if service.tombstoned is None:
+        return SegmentedArray(np.broadcast_to(np.False_, (len(service.movie_ids),)))
+    return SegmentedArray.wrap(service.tombstoned)
+
+
+def _publish_id_delta(service):
+    """Índice id -> posición de las filas añadidas vivas (las bajas de la base se filtran con tombstoned)"""
+    movie_ids = SegmentedArray.wrap(service.movie_ids)
+    positions = np.arange(len(movie_ids.base), len(movie_ids))
+    positions = positions[~service.tombstoned[positions]]
+    ids = movie_ids[positions]
+    order = np.argsort(ids, kind='stable')
+    service._id_delta = (ids[order], positions[order])
+
+
+def _feature_medians(service) -> Dict[str, float]:
+    """Medianas del catálogo base para rellenar huecos, calculadas una vez por catálogo"""
+    cached = service._feature_medians
+    if cached is None or cached[0] is not service.movies_df:
+        medians = {col: float(service.movies_df[col].median()) for col in service.feature_columns}
+        cached = service._feature_medians = (service.movies_df, medians)
+    return cached[1]
+
+
+def prepare_incremental_rows(service, movies: List[Dict]) -> pd.DataFrame:
+    """Filas nuevas con las mismas columnas derivadas que el entrenamiento (sin reajustar el scaler)"""
+    new_df = pd.DataFrame(movies)
+    for column in ('title', 'genre_ids', 'release_date'):
+        if column not in new_df.columns:
+            new_df[column] = None
+    service._add_derived_features(new_df)
+
+    # Películas recién creadas no tienen valoraciones todavía
+    if 'avg_user_rating' not in new_df.columns:
+        new_df['avg_user_rating'] = 5.0
+    if 'user_rating_count' not in new_df.columns:
+        new_df['user_rating_count'] = 0
+    new_df['avg_user_rating'] = new_df['avg_user_rating'].astype(float).fillna(5.0)
+    new_df['user_rating_count'] = new_df['user_rating_count'].fillna(0).astype(int)
+
+    # Resto de huecos: mediana del catálogo, como en _prepare_features_from_db
+    medians = _feature_medians(service)
+    for col in service.feature_columns:
+        if col not in new_df.columns:
+            new_df[col] = np.nan
+        new_df[col] = pd.to_numeric(new_df[col], errors='coerce').fillna(medians[col])
+    new_df['id'] = new_df['id'].astype(np.int64)
+    return new_df
+
+
+def upsert_movies(service, movies: List[Dict]) -> Dict:
+    """
+    Alta o modificación de películas sin reentrenar: las filas nuevas van al delta y, si la
+    película ya existía, su fila antigua queda marcada como borrada.
+    """
+    if not service.is_model_loaded():
+        logger.warning("⚠️ Modelo KNN no disponible para actualizar el catálogo")
+        return {'upserted': 0, 'replaced': 0}
+    if not movies:
+        return {'upserted': 0, 'replaced': 0, 'catalog_revision': service.catalog_revision}
+
+    with service._update_lock:
+        new_df = prepare_incremental_rows(service, movies).drop_duplicates('id', keep='last')
+        append_catalog_log(service, 'upsert', {'movies': movies})
+        new_features = service.scaler.transform(new_df[service.feature_columns].to_numpy(dtype=float))
+
+        old_positions = service.lookup_positions(new_df['id'].to_numpy())
+        replaced_positions = old_positions[old_positions >= 0]
+        first_new = len(service.movie_ids)
+        new_positions = np.arange(first_new, first_new + len(new_df))
+
+        # Orden de publicación: catálogo y tombstones antes que el motor y la tabla,
+        # para que un lector concurrente nunca reciba posiciones que aún no puede hidratar.
+        # En los buffers ragged, valores antes que offsets: los offsets viejos siguen siendo válidos
+        new_titles = encode_strings(new_df['title'].tolist())
+        new_genres = encode_genres(new_df['genre_ids'])
+        titles = append_ragged(service.title_offsets, service.title_bytes, new_titles['offsets'], new_titles['bytes'])
+        genres = append_ragged(service.genre_offsets, service.genre_values, new_genres['offsets'], new_genres['values'])
+        service.title_bytes, service.title_offsets = titles['values'], titles['offsets']
+        service.genre_values, service.genre_offsets = genres['values'], genres['offsets']
+        new_rows = new_df.reindex(columns=service.movies_df.columns).astype(service.movies_df.dtypes.to_dict())
+        tail = service._catalog_tail
+        service._catalog_tail = new_rows.reset_index(drop=True) if tail is None \
+            else pd.concat([tail, new_rows], ignore_index=True)
+        service.tombstoned = _tombstones(service).append(np.zeros(len(new_df), dtype=bool)) \
+            .with_rows(replaced_positions, True)
+        service.n_tombstoned += len(replaced_positions)
+        service.movie_ids = SegmentedArray.wrap(service.movie_ids).append(new_df['id'].to_numpy())
+        service.feature_matrix = SegmentedArray.wrap(service.feature_matrix).append(new_features)
+        append_to_search_engines(service, new_features)
+        patch_neighbor_table(service, new_positions, replaced_positions)
+        _publish_id_delta(service)
+        service.catalog_revision += 1
+
+    logger.info(f"✅ Catálogo KNN actualizado: {len(new_df)} películas "
+                f"({len(replaced_positions)} reemplazadas), revisión {service.catalog_revision}")
+    return {
+        'upserted': int(len(new_df)),
+        'replaced': int(len(replaced_positions)),
+        'catalog_revision': service.catalog_revision
+    }
+
+
+def delete_movies(service, movie_ids: List[int]) -> Dict:
+    """Marcar películas como borradas y reparar las filas de la tabla que apuntaban a ellas"""
+    if not service.is_model_loaded():
+        logger.warning("⚠️ Modelo KNN no disponible para actualizar el catálogo")
+        return {'deleted': 0}
+
+    with service._update_lock:
+        positions = service.lookup_positions(movie_ids)
+        positions = np.unique(positions[positions >= 0])
+        if len(positions) == 0:
+            return {'deleted': 0, 'catalog_revision': service.catalog_revision}
+        append_catalog_log(service, 'delete', {'movie_ids': service.movie_ids[positions].tolist()})
+
+        service.tombstoned = _tombstones(service).with_rows(positions, True)
+        service.n_tombstoned += len(positions)
+        _publish_id_delta(service)
+        patch_neighbor_table(service, np.empty(0, dtype=np.int64), positions)
+        service.catalog_revision += 1
+
+    logger.info(f"🗑️ {len(positions)} películas marcadas como borradas, revisión {service.catalog_revision}")
+    return {'deleted': int(len(positions)), 'catalog_revision': service.catalog_revision}
+
+
+def append_to_search_engines(service, new_features: np.ndarray):
+    """Añadir filas al motor exacto y al índice aproximado sin reconstruirlos"""
+    if isinstance(service.search_engine, ExactCosineEngine):
+        service.search_engine.append(new_features)
+    else:
+        # sklearn no admite altas: se reajusta sobre la matriz completa
+        service.knn_model = NearestNeighbors(algorithm='auto', metric='cosine').fit(materialize(service.feature_matrix))
+        service.search_engine = service.knn_model
+    if service.ann_index is not None:
+        service.ann_index.append(new_features)
+
+
+def patch_neighbor_table(service, new_positions: np.ndarray, removed_positions: np.ndarray):
+    """
+    Parchear la tabla de vecinos tras un alta/baja en lugar de recalcularla entera.
+
+    1. Filas nuevas: consulta de vecinos normal, añadida al final.
+    2. Filas existentes: similitud contra las filas nuevas por bloques; solo se sustituyen
+       las filas en las que alguna nueva supera al peor vecino.
+    3. Filas que apuntaban a películas borradas: se vuelven a consultar.
+    """
+    table = service._neighbor_table
+    if table is None:
+        return
+
+    indices, similarities = SegmentedArray.wrap(table[0]), SegmentedArray.wrap(table[1])
+    k_max = indices.shape[1]
+    chunk_size = max(1, service.INCREMENTAL_CHUNK_SIZE)
+    tombstoned = service.tombstoned
+
+    if len(new_positions):
+        new_indices, new_similarities = service._query_live_neighbors(
+            service.feature_matrix[new_positions], k_max, exclude_rows=new_positions
+        )
+
+        normalized_new = ExactCosineEngine._normalize(service.feature_matrix[new_positions])
+        patched_rows, patched_indices, patched_similarities = [], [], []
+        for start in range(0, len(indices), chunk_size):
+            rows = np.arange(start, min(start + chunk_size, len(indices)))
+            if tombstoned is not None:
+                rows = rows[~tombstoned[rows]]
+            if len(rows) == 0:
+                continue
+
+            cosine = ExactCosineEngine._normalize(service.feature_matrix[rows]) @ normalized_new.T
+            candidate_similarities = 1.0 / (1.0 + np.clip(1.0 - cosine, 0.0, 2.0))
+            affected = candidate_similarities.max(axis=1) > similarities[rows, -1]
+            if not affected.any():
+                continue
+
+            rows, candidate_similarities = rows[affected], candidate_similarities[affected]
+            merged_indices = np.hstack([
+                indices[rows], np.broadcast_to(new_positions, candidate_similarities.shape)
+            ])
+            merged_similarities = np.hstack([similarities[rows], candidate_similarities])
+            order = np.argsort(-merged_similarities, axis=1, kind='stable')[:, :k_max]
+            patched_rows.append(rows)
+            patched_indices.append(np.take_along_axis(merged_indices, order, axis=1))
+            patched_similarities.append(np.take_along_axis(merged_similarities, order, axis=1))
+
+        if patched_rows:
+            rows = np.concatenate(patched_rows)
+            indices = indices.with_rows(rows, np.concatenate(patched_indices))
+            similarities = similarities.with_rows(rows, np.concatenate(patched_similarities))
+        indices, similarities = indices.append(new_indices), similarities.append(new_similarities)
+
+    if len(removed_positions):
+        stale = [
+            start + np.flatnonzero(np.isin(indices[start:start + chunk_size], removed_positions).any(axis=1))
+            for start in range(0, len(indices), chunk_size)
+        ]
+        stale = np.concatenate(stale) if stale else np.empty(0, dtype=np.int64)
+        if tombstoned is not None:
+            stale = stale[~tombstoned[stale]]
+        if len(stale):
+            requeried = [
+                service._query_live_neighbors(service.feature_matrix[rows], k_max, exclude_rows=rows)
+                for rows in (stale[start:start + chunk_size] for start in range(0, len(stale), chunk_size))
+            ]
+            indices = indices.with_rows(stale, np.concatenate([rows for rows, _ in requeried]))
+            similarities = similarities.with_rows(stale, np.concatenate([sims for _, sims in requeried]))
+
+    service._publish_neighbor_table(indices, similarities)
+
+
+def catalog_log_path(model_path: str) -> str:
+    """Log de altas/bajas: en la raíz del directorio de artefacto (fuera de versions/) o junto al .pkl"""
+    if os.path.isdir(model_path):
+        return os.path.join(model_path, CATALOG_LOG_FILE)
+    return f"{os.path.splitext(model_path)[0]}_{CATALOG_LOG_FILE}"
+
+
+def append_catalog_log(service, op: str, payload: Dict):
+    """
+    Registrar una alta/baja antes de aplicarla (con _update_lock tomado). Cada entrada lleva
+    la versión del artefacto base y su hora; si no se puede escribir, el cambio no se aplica.
+    """
+    if not service.CATALOG_LOG_ENABLED or not service.model_path or service._replaying_catalog_log:
+        return
+    entry = {'base_version': service.base_model_version, 'at': time.time(), 'op': op, **payload}
+    with open(catalog_log_path(service.model_path), 'ab') as f:
+        f.write((json.dumps(entry, default=str) + '\n').encode('utf-8'))
+        f.flush()
+        os.fsync(f.fileno())
+        service._catalog_log_offset = f.tell()
+
+
+def catalog_entry_applies(service, entry: Dict) -> bool:
+    """
+    Entradas escritas sobre este artefacto, o posteriores a la lectura de la BD con la que se
+    entrenó: un reentrenamiento no pierde las altas/bajas que llegaron mientras entrenaba.
+    """
+    if entry.get('base_version') == service.base_model_version:
+        return True
+    return service.catalog_snapshot_at is not None and entry.get('at', 0) >= service.catalog_snapshot_at
+
+
+def replay_catalog_log(service, model_path: str, offset: int = 0) -> int:
+    """Reaplicar las altas/bajas registradas para el artefacto cargado, desde offset"""
+    log_path = catalog_log_path(model_path)
+    if not service.CATALOG_LOG_ENABLED or not os.path.exists(log_path):
+        return 0
+
+    applied = skipped = 0
+    service._replaying_catalog_log = True
+    try:
+        with open(log_path, 'rb') as f:
+            f.seek(offset)
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    continue  # Línea truncada por una escritura interrumpida
+                if not catalog_entry_applies(service, entry):
+                    skipped += 1
+                    continue
+                if entry['op'] == 'upsert':
+                    service.upsert_movies(entry['movies'])
+                elif entry['op'] == 'delete':
+                    service.delete_movies(entry['movie_ids'])
+                applied += 1
+            service._catalog_log_offset = f.tell()
+    finally:
+        service._replaying_catalog_log = False
+    if applied or skipped:
+        logger.info(f"🔄 Log del catálogo reaplicado: {applied} cambios "
+                    f"({skipped} de otras versiones ignorados), revisión {service.catalog_revision}")
+    return applied
+
+
+def compacted_copy(service):
+    """
+    Servicio nuevo reentrenado solo con las filas vivas (compactación completa). No modifica
+    el servicio: quien lo llama publica la copia cuando está lista, igual que una recarga.
+    """
+    # Instantánea coherente del catálogo vivo: las altas/bajas esperan solo a la copia, no al reentrenamiento
+    with service._update_lock:
+        live = service._live_mask()
+        catalog = service.catalog_frame()
+        positions = np.arange(len(catalog)) if live is None else np.flatnonzero(live)
+        movies_df = catalog.iloc[positions]
+        titles = take_ragged(service.title_offsets, service.title_bytes, positions)
+        genres = take_ragged(service.genre_offsets, service.genre_values, positions)
+        log_offset = service._catalog_log_offset
+
+    compacted = type(service)(auto_load=False)
+    compacted.db_pool = service.db_pool
+    compacted.feature_columns = list(service.feature_columns)
+    compacted.feature_version = service.feature_version  # Filas ya codificadas como el modelo original
+    compacted.catalog_snapshot_at = service.catalog_snapshot_at
+    compacted.movies_df = movies_df.reset_index(drop=True)
+    compacted.title_bytes, compacted.title_offsets = titles['values'], titles['offsets']
+    compacted.genre_values, compacted.genre_offsets = genres['values'], genres['offsets']
+    compacted.train_knn_model()
+    if not compacted.is_model_loaded():
+        raise RuntimeError("No se pudo reentrenar el catálogo compactado")
+    if service.ann_index is not None and compacted.ann_index is None:
+        compacted.build_ann_index()
+    compacted.model_version = f"{service.model_version}-compacted-{service.catalog_revision}"
+    compacted.model_path = service.model_path
+    compacted.base_model_version = service.base_model_version  # El log sigue aplicándose al artefacto en disco
+    compacted._catalog_log_offset = log_offset  # catch_up_catalog_log() aplica lo que llegue después
+
+    logger.info(f"✅ Catálogo compactado: {len(movies_df)} películas vivas "
+                f"({len(catalog) - len(movies_df)} borradas descartadas)")
+    return compacted
+
+
+def catch_up_catalog_log(service) -> Optional[int]:
+    """
+    Aplicar las entradas del log escritas después de que el servicio lo leyera (recargas y
+    compactaciones, con los escritores detenidos). None si no hay log con el que ponerse al día.
+    """
+    if not service.CATALOG_LOG_ENABLED or not service.model_path:
+        return None
+    return replay_catalog_log(service, service.model_path, service._catalog_log_offset)
@@ -0,0 +1,282 @@
+"""
+Motores de búsqueda de vecinos para el servicio KNN.
+
+Todos exponen el mismo contrato que sklearn NearestNeighbors.kneighbors:
+kneighbors(queries, n_neighbors) -> (distances, indices), con distancia coseno.
+"""
+
+import time
+import numpy as np
+from typing import Dict, Tuple
+
+
+def _gather_rows(base: np.ndarray, tail: np.ndarray, rows: np.ndarray) -> np.ndarray:
+    """Filas de base + tail (altas incrementales) sin concatenar la base"""
+    if not len(tail):
+        return base[rows]
+    in_base = rows < len(base)
+    gathered = np.empty((len(rows), base.shape[1]), dtype=base.dtype)
+    gathered[in_base] = base[rows[in_base]]
+    gathered[~in_base] = tail[rows[~in_base] - len(base)]
+    return gathered
+
+
+class ExactCosineEngine:
+    """
+    Búsqueda exacta por coseno: producto por BLAS contra una copia L2-normalizada float32
+    y np.argpartition para el top-K. Las altas van a normalized_tail hasta compactar y los
+    lotes se parten para que similitudes + argpartition quepan en query_buffer_bytes.
+    """
+
+    BYTES_PER_CELL = np.dtype(np.float32).itemsize + np.dtype(np.int64).itemsize
+
+    def __init__(self, feature_matrix: np.ndarray = None, query_buffer_bytes: int = 64 * 1024 * 1024,
+                 normalized_matrix: np.ndarray = None):
+        # normalized_matrix permite reutilizar una matriz ya normalizada (p. ej. memory-mapped)
+        self.normalized_matrix = normalized_matrix if normalized_matrix is not None \
+            else self._normalize(feature_matrix)
+        self.normalized_tail = np.empty((0, self.normalized_matrix.shape[1]), dtype=np.float32)
+        self.query_buffer_bytes = query_buffer_bytes
+
+    @property
+    def query_chunk_size(self) -> int:
+        """Consultas por bloque según el presupuesto de memoria y el tamaño actual del catálogo"""
+        return max(1, self.query_buffer_bytes // (max(1, len(self)) * self.BYTES_PER_CELL))
+
+    @staticmethod
+    def _normalize(matrix: np.ndarray) -> np.ndarray:
+        """Normalizar filas a norma L2 unitaria (las filas nulas se quedan en cero, como en sklearn)"""
+        matrix = np.ascontiguousarray(matrix, dtype=np.float32)
+        norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+        norms[norms == 0] = 1.0
+        return np.ascontiguousarray(matrix / norms, dtype=np.float32)
+
+    def __len__(self) -> int:
+        return len(self.normalized_matrix) + len(self.normalized_tail)
+
+    def append(self, feature_rows: np.ndarray):
+        """Añadir filas al final del catálogo (actualizaciones incrementales)"""
+        self.normalized_tail = np.concatenate([self.normalized_tail, self._normalize(feature_rows)])
+
+    def normalized_rows(self) -> np.ndarray:
+        """Matriz normalizada completa (base + altas), para guardar el artefacto"""
+        if not len(self.normalized_tail):
+            return self.normalized_matrix
+        return np.concatenate([self.normalized_matrix, self.normalized_tail])
+
+    def _similarities(self, queries: np.ndarray, tail: np.ndarray) -> np.ndarray:
+        """Similitudes (m, n) contra la base y las filas añadidas, en un único buffer"""
+        if not len(tail):
+            return queries @ self.normalized_matrix.T
+        n_base = len(self.normalized_matrix)
+        similarities = np.empty((len(queries), n_base + len(tail)), dtype=np.float32)
+        np.matmul(queries, self.normalized_matrix.T, out=similarities[:, :n_base])
+        np.matmul(queries, tail.T, out=similarities[:, n_base:])
+        return similarities
+
+    def kneighbors(self, queries: np.ndarray, n_neighbors: int) -> Tuple[np.ndarray, np.ndarray]:
+        """Vecinos exactos para una consulta (1, d) o un lote (m, d)"""
+        queries = self._normalize(np.atleast_2d(queries))
+        tail = self.normalized_tail  # Una sola lectura: un alta concurrente no cambia el tamaño a mitad
+        n_neighbors = min(n_neighbors, len(self.normalized_matrix) + len(tail))
+
+        distances = np.empty((len(queries), n_neighbors), dtype=np.float32)
+        indices = np.empty((len(queries), n_neighbors), dtype=np.int64)
+        chunk_size = self.query_chunk_size
+        for start in range(0, len(queries), chunk_size):
+            stop = min(start + chunk_size, len(queries))
+            similarities = self._similarities(queries[start:stop], tail)
+            top_similarities, top_indices = self._top_k(similarities, n_neighbors)
+            distances[start:stop] = np.clip(1.0 - top_similarities, 0.0, 2.0)
+            indices[start:stop] = top_indices
+
+        return distances, indices
+
+    @staticmethod
+    def _top_k(similarities: np.ndarray, k: int) -> Tuple[np.ndarray, np.ndarray]:
+        """Top-K por fila, empates por índice ascendente. Niega similarities en el sitio"""
+        negated = np.negative(similarities, out=similarities)
+        if k < negated.shape[1]:
+            candidates = np.argpartition(negated, k - 1, axis=1)[:, :k]
+            candidates.sort(axis=1)
+        else:
+            candidates = np.broadcast_to(np.arange(negated.shape[1]), negated.shape).copy()
+
+        negated_candidates = np.take_along_axis(negated, candidates, axis=1)
+        order = np.argsort(negated_candidates, axis=1, kind='stable')
+        return (
+            -np.take_along_axis(negated_candidates, order, axis=1),
+            np.take_along_axis(candidates, order, axis=1)
+        )
+
+
+class RandomProjectionLSHIndex:
+    """
+    Índice aproximado por LSH de hiperplanos aleatorios (coseno) en varias tablas.
+
+    Cada tabla asigna a cada película un código de n_bits según el signo de su proyección
+    sobre hiperplanos aleatorios. Una consulta reúne los candidatos de su cubeta en cada
+    tabla (más n_probes cubetas vecinas, volteando los bits con menor margen) y los
+    reordena con coseno exacto. Más tablas/probes = más recall; más bits = cubetas más
+    pequeñas y menor latencia.
+
+    Las altas incrementales no se hashean: quedan en normalized_tail y toda consulta las
+    evalúa por fuerza bruta hasta que la compactación reconstruye el índice.
+    """
+
+    HASH_CHUNK_SIZE = 65536
+
+    def __init__(self, feature_matrix: np.ndarray, n_tables: int = 8, n_bits: int = 12,
+                 n_probes: int = 2, seed: int = 42, hyperplanes: np.ndarray = None):
+        self.normalized_matrix = ExactCosineEngine._normalize(feature_matrix)
+        self.normalized_tail = np.empty((0, self.normalized_matrix.shape[1]), dtype=np.float32)
+        self.n_tables = n_tables
+        self.n_bits = n_bits
+        self.n_probes = min(n_probes, n_bits)
+        self.seed = seed
+
+        if hyperplanes is None:
+            rng = np.random.default_rng(seed)
+            n_features = self.normalized_matrix.shape[1]
+            hyperplanes = rng.standard_normal((n_tables, n_features, n_bits)).astype(np.float32)
+        self.hyperplanes = hyperplanes
+        self._bit_values = np.left_shift(np.int64(1), np.arange(n_bits, dtype=np.int64))
+        self._index_tables()
+
+    def __len__(self) -> int:
+        return len(self.normalized_matrix) + len(self.normalized_tail)
+
+    def _project(self, vectors: np.ndarray) -> np.ndarray:
+        """Proyecciones (m, n_tables, n_bits) de vectores normalizados"""
+        return np.einsum('md,tdb->mtb', vectors, self.hyperplanes)
+
+    def _codes(self, projections: np.ndarray) -> np.ndarray:
+        """Códigos enteros (m, n_tables) a partir del signo de las proyecciones"""
+        return (projections > 0).astype(np.int64) @ self._bit_values
+
+    def _index_tables(self):
+        """Ordenar las filas por código en cada tabla para buscar cubetas con searchsorted"""
+        n_movies = len(self.normalized_matrix)
+        codes = np.empty((n_movies, self.n_tables), dtype=np.int64)
+        for start in range(0, n_movies, self.HASH_CHUNK_SIZE):
+            stop = min(start + self.HASH_CHUNK_SIZE, n_movies)
+            codes[start:stop] = self._codes(self._project(self.normalized_matrix[start:stop]))
+
+        self.sorted_rows = np.argsort(codes, axis=0, kind='stable').T.astype(np.int32)
+        self.sorted_codes = np.take_along_axis(codes, self.sorted_rows.T.astype(np.int64), axis=0).T.copy()
+
+    def append(self, feature_rows: np.ndarray):
+        """Añadir filas sin tocar las tablas ordenadas (ver normalized_tail)"""
+        self.normalized_tail = np.concatenate([self.normalized_tail, ExactCosineEngine._normalize(feature_rows)])
+
+    def _merged_tables(self, tail: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """Tablas ordenadas con las filas añadidas insertadas en su cubeta (al guardar)"""
+        if not len(tail):
+            return self.sorted_codes, self.sorted_rows
+        first_row = len(self.normalized_matrix)
+        codes = self._codes(self._project(tail))
+        row_ids = np.arange(first_row, first_row + len(tail), dtype=np.int32)
+
+        sorted_codes, sorted_rows = [], []
+        for table in range(self.n_tables):
+            slots = np.searchsorted(self.sorted_codes[table], codes[:, table], side='right')
+            sorted_codes.append(np.insert(self.sorted_codes[table], slots, codes[:, table]))
+            sorted_rows.append(np.insert(self.sorted_rows[table], slots, row_ids))
+        return np.stack(sorted_codes), np.stack(sorted_rows).astype(np.int32)
+
+    def _candidates(self, projections: np.ndarray, n_tail: int = 0) -> np.ndarray:
+        """Filas candidatas para una consulta: su cubeta y n_probes cubetas vecinas por tabla, más las altas"""
+        code = self._codes(projections[None])[0]
+        buckets = []
+        for table in range(self.n_tables):
+            probe_codes = [code[table]]
+            if self.n_probes > 0:
+                # Multi-probe: voltear los bits cuya proyección está más cerca del hiperplano
+                weakest_bits = np.argsort(np.abs(projections[table]))[:self.n_probes]
+                probe_codes.extend(code[table] ^ self._bit_values[weakest_bits])
+            sorted_codes = self.sorted_codes[table]
+            for probe_code in probe_codes:
+                lo = np.searchsorted(sorted_codes, probe_code, side='left')
+                hi = np.searchsorted(sorted_codes, probe_code, side='right')
+                if hi > lo:
+                    buckets.append(self.sorted_rows[table, lo:hi])
+        tail_rows = np.arange(len(self.normalized_matrix), len(self.normalized_matrix) + n_tail, dtype=np.int64)
+        if not buckets:
+            return tail_rows
+        return np.concatenate([np.unique(np.concatenate(buckets)).astype(np.int64), tail_rows])
+
+    def kneighbors(self, queries: np.ndarray, n_neighbors: int) -> Tuple[np.ndarray, np.ndarray]:
+        """Vecinos aproximados; si una consulta reúne menos de K candidatos se busca en todo el catálogo"""
+        queries = ExactCosineEngine._normalize(np.atleast_2d(queries))
+        tail = self.normalized_tail
+        n_rows = len(self.normalized_matrix) + len(tail)
+        n_neighbors = min(n_neighbors, n_rows)
+        projections = self._project(queries)
+
+        distances = np.empty((len(queries), n_neighbors), dtype=np.float32)
+        indices = np.empty((len(queries), n_neighbors), dtype=np.int64)
+        for i, query in enumerate(queries):
+            candidates = self._candidates(projections[i], len(tail))
+            if len(candidates) < n_neighbors:
+                candidates = np.arange(n_rows)
+            similarities = (_gather_rows(self.normalized_matrix, tail, candidates) @ query)[None]
+            top_similarities, top_positions = ExactCosineEngine._top_k(similarities, n_neighbors)
+            distances[i] = np.clip(1.0 - top_similarities[0], 0.0, 2.0)
+            indices[i] = candidates[top_positions[0]]
+
+        return distances, indices
+
+    def to_arrays(self) -> Dict[str, np.ndarray]:
+        """Arrays que definen el índice (sin la matriz de características, que vive en el modelo)"""
+        sorted_codes, sorted_rows = self._merged_tables(self.normalized_tail)
+        return {
+            'hyperplanes': self.hyperplanes,
+            'sorted_codes': sorted_codes,
+            'sorted_rows': sorted_rows,
+            'params': np.array([self.n_tables, self.n_bits, self.n_probes, self.seed], dtype=np.int64)
+        }
+
+    @classmethod
+    def from_arrays(cls, arrays: Dict[str, np.ndarray], normalized_matrix: np.ndarray) -> 'RandomProjectionLSHIndex':
+        """Reconstruir el índice sobre la matriz normalizada del modelo sin volver a hashear"""
+        n_tables, n_bits, n_probes, seed = (int(v) for v in arrays['params'])
+        index = cls.__new__(cls)
+        index.normalized_matrix = normalized_matrix
+        index.normalized_tail = np.empty((0, normalized_matrix.shape[1]), dtype=np.float32)
+        index.n_tables, index.n_bits, index.n_probes, index.seed = n_tables, n_bits, n_probes, seed
+        index.hyperplanes = arrays['hyperplanes']
+        index._bit_values = np.left_shift(np.int64(1), np.arange(n_bits, dtype=np.int64))
+        index.sorted_codes = arrays['sorted_codes']
+        index.sorted_rows = arrays['sorted_rows']
+        return index
+
+    def save(self, path: str):
+        """Serializar el índice en un .npz"""
+        np.savez(path, **self.to_arrays())
+
+    @classmethod
+    def load(cls, path: str, feature_matrix: np.ndarray) -> 'RandomProjectionLSHIndex':
+        """Cargar un índice serializado sobre la matriz de características del modelo"""
+        with np.load(path) as data:
+            arrays = {name: data[name] for name in data.files}
+        return cls.from_arrays(arrays, ExactCosineEngine._normalize(feature_matrix))
+
+
+def recall_at_k(approximate_engine, exact_engine, queries: np.ndarray, k: int) -> Dict:
+    """Recall@K de un motor aproximado contra el exacto, con la latencia media de ambos"""
+    start = time.perf_counter()
+    _, exact_indices = exact_engine.kneighbors(queries, n_neighbors=k)
+    exact_ms = (time.perf_counter() - start) * 1000 / len(queries)
+
+    start = time.perf_counter()
+    _, approx_indices = approximate_engine.kneighbors(queries, n_neighbors=k)
+    approx_ms = (time.perf_counter() - start) * 1000 / len(queries)
+
+    hits = [len(np.intersect1d(a, e)) for a, e in zip(approx_indices, exact_indices)]
+    return {
+        'k': k,
+        'queries': len(queries),
+        'recall_at_k': round(float(np.mean(hits)) / exact_indices.shape[1], 4),
+        'exact_ms_per_query': round(exact_ms, 4),
+        'approximate_ms_per_query': round(approx_ms, 4)
+    }
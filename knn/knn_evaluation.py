@@ -1,16 +1,20 @@
 #!/usr/bin/env python3
 """
 Script para evaluar la calidad de las recomendaciones KNN
+
+Las métricas de diversidad, novedad y cobertura se calculan sobre el catálogo en memoria
+del servicio KNN (EfficientKNNService.evaluation_catalog). Del usuario solo hace falta su
+historial, que se lee en una única consulta o se recibe ya hecho (sin tocar la BD).
 """
 
 import pandas as pd
 import numpy as np
 from sklearn.metrics import precision_score, recall_score, f1_score
-import psycopg2
-from psycopg2.extras import RealDictCursor
 import logging
-from typing import List, Dict, Tuple
+from typing import List, Dict, Tuple, Optional
 import os
+from db_pool import get_database_pool
+from knn_catalog import take_ragged
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
@@ -18,32 +22,24 @@ logger = logging.getLogger(__name__)
 class KNNEvaluator:
     """Evaluador de calidad para recomendaciones KNN"""
     
-    def __init__(self):
-        self.db_connection = None
-        self.connect_database()
+    def __init__(self, knn_service, connect: bool = True):
+        self.knn_service = knn_service  # Servicio KNN cuyo catálogo en memoria se usa para las métricas
+        self.db_pool = None
+        if connect:
+            self.connect_database()
     
     def connect_database(self):
-        """Conectar a la base de datos"""
-        try:
-            db_host = os.getenv('DB_HOST', 'localhost')
-            db_name = os.getenv('DB_NAME', 'MovieMatch')
-            db_user = os.getenv('DB_USER', 'postgres')
-            db_password = os.getenv('DB_PASSWORD', 'admin')
-            db_port = os.getenv('DB_PORT', '5432')
-            
-            self.db_connection = psycopg2.connect(
-                host=db_host,
-                database=db_name,
-                user=db_user,
-                password=db_password,
-                port=db_port
-            )
-            logger.info("✅ Conexión a BD establecida para evaluación")
-        except Exception as e:
-            logger.error(f"❌ Error conectando a BD: {e}")
+        """Usar el pool de conexiones compartido (sin abrir una conexión TCP por evaluación)"""
+        self.db_pool = get_database_pool()
+        if self.db_pool is None:
+            logger.error("❌ Error conectando a BD: pool no disponible")
+    
+    def _get_catalog(self) -> Optional[Dict]:
+        """Catálogo en memoria del servicio KNN (popularidad, géneros CSR, tamaño)"""
+        return self.knn_service.evaluation_catalog()
     
     def evaluate_user_recommendations(self, user_id: int, recommendations: List[Dict], 
-                                    top_k: int = 10) -> Dict:
+                                    top_k: int = 10, user_history: Optional[List[Dict]] = None) -> Dict:
         """
         Evaluar recomendaciones para un usuario específico
         
@@ -52,24 +48,32 @@ class KNNEvaluator:
         - Recall@K: De todas las películas que le gustan, ¿cuántas están en las K recomendadas?
         - Diversity: ¿Qué tan diversas son las recomendaciones?
         - Novelty: ¿Qué tan novedosas son las recomendaciones?
+        
+        user_history: [{'movie_id', 'rating', 'watched'}, ...]; si se pasa no se consulta la BD
         """
         
-        if not self.db_connection:
+        if user_history is None and not self.db_pool:
             return {"error": "No hay conexión a la base de datos"}
         
         try:
-            # 1. Obtener películas que realmente le gustan al usuario (rating >= 4)
-            user_liked_movies = self._get_user_liked_movies(user_id)
+            catalog = self._get_catalog()
+            if catalog is None:
+                return {"error": "Catálogo KNN no disponible"}
+            
+            # 1. Historial del usuario en una sola consulta (o el recibido)
+            if user_history is None:
+                user_history = self._get_user_history(user_id)
             
-            # 2. Obtener películas que el usuario ha visto
-            user_watched_movies = self._get_user_watched_movies(user_id)
+            # 2. Películas que le gustan (rating >= 4) y películas vistas
+            user_liked_movies, user_watched_movies = self._split_user_history(user_history)
+            liked_set = set(user_liked_movies)
             
             # 3. Calcular métricas
             metrics = {}
             
             # Precision@K
-            recommended_movie_ids = [rec['movie_id'] for rec in recommendations[:top_k]]
-            liked_recommended = [mid for mid in recommended_movie_ids if mid in user_liked_movies]
+            recommended_movie_ids = [int(rec['movie_id']) for rec in recommendations[:top_k]]
+            liked_recommended = [mid for mid in recommended_movie_ids if mid in liked_set]
             precision_at_k = len(liked_recommended) / len(recommended_movie_ids) if recommended_movie_ids else 0
             
             # Recall@K
@@ -78,14 +82,17 @@ class KNNEvaluator:
             # F1-Score@K
             f1_at_k = 2 * (precision_at_k * recall_at_k) / (precision_at_k + recall_at_k) if (precision_at_k + recall_at_k) > 0 else 0
             
+            # Posiciones en el catálogo de las recomendadas (-1 = no está en el catálogo)
+            positions = self.knn_service.lookup_positions(recommended_movie_ids)
+            
             # Diversity (basada en géneros)
-            diversity_score = self._calculate_diversity(recommendations[:top_k])
+            diversity_score = self._calculate_diversity(positions, catalog)
             
             # Novelty (basada en popularidad)
-            novelty_score = self._calculate_novelty(recommendations[:top_k])
+            novelty_score = self._calculate_novelty(positions, catalog)
             
             # Coverage (qué porcentaje de películas disponibles se recomiendan)
-            coverage_score = self._calculate_coverage(recommendations[:top_k])
+            coverage_score = self._calculate_coverage(recommended_movie_ids, catalog)
             
             metrics = {
                 "user_id": user_id,
@@ -110,184 +117,109 @@ class KNNEvaluator:
             logger.error(f"❌ Error evaluando recomendaciones: {e}")
             return {"error": str(e)}
     
-    def _get_user_liked_movies(self, user_id: int) -> List[int]:
-        """Obtener películas que le gustan al usuario (rating >= 4)"""
+    def _get_user_history(self, user_id: int) -> List[Dict]:
+        """Historial del usuario (valoraciones y vistas) en una sola consulta"""
         try:
-            with self.db_connection.cursor() as cursor:
+            with self.db_pool.connection() as conn, conn.cursor() as cursor:
                 cursor.execute("""
-                    SELECT movie_id 
+                    SELECT movie_id, rating, watched
                     FROM user_movies 
-                    WHERE user_id = %s AND rating >= 4
-                    ORDER BY rating DESC
+                    WHERE user_id = %s AND (rating IS NOT NULL OR watched = true)
+                    ORDER BY rating DESC NULLS LAST, created_at DESC
                 """, (user_id,))
                 
                 results = cursor.fetchall()
-                return [row[0] for row in results]
+                return [{'movie_id': row[0], 'rating': row[1], 'watched': row[2]} for row in results]
         except Exception as e:
-            logger.error(f"❌ Error obteniendo películas que le gustan: {e}")
+            logger.error(f"❌ Error obteniendo historial del usuario: {e}")
             return []
     
-    def _get_user_watched_movies(self, user_id: int) -> List[int]:
-        """Obtener películas que el usuario ha visto"""
-        try:
-            with self.db_connection.cursor() as cursor:
-                cursor.execute("""
-                    SELECT movie_id 
-                    FROM user_movies 
-                    WHERE user_id = %s AND watched = true
-                    ORDER BY created_at DESC
-                """, (user_id,))
-                
-                results = cursor.fetchall()
-                return [row[0] for row in results]
-        except Exception as e:
-            logger.error(f"❌ Error obteniendo películas vistas: {e}")
-            return []
+    @staticmethod
+    def _split_user_history(user_history: List[Dict]) -> Tuple[List[int], List[int]]:
+        """Películas que le gustan (rating >= 4, mejor valoradas primero) y películas vistas"""
+        rated = [h for h in user_history if h.get('rating') is not None and h['rating'] >= 4]
+        rated.sort(key=lambda h: h['rating'], reverse=True)
+        liked = [int(h['movie_id']) for h in rated]
+        watched = [int(h['movie_id']) for h in user_history if h.get('watched', True)]
+        return liked, watched
     
-    def _calculate_diversity(self, recommendations: List[Dict]) -> float:
+    def _calculate_diversity(self, positions: np.ndarray, catalog: Dict) -> float:
         """Calcular diversidad basada en géneros únicos"""
-        try:
-            with self.db_connection.cursor(cursor_factory=RealDictCursor) as cursor:
-                movie_ids = [rec['movie_id'] for rec in recommendations]
-                if not movie_ids:
-                    return 0.0
-                
-                cursor.execute("""
-                    SELECT genre_ids 
-                    FROM movies 
-                    WHERE id = ANY(%s)
-                """, (movie_ids,))
-                
-                results = cursor.fetchall()
-                
-                # Contar géneros únicos
-                all_genres = set()
-                for row in results:
-                    genre_ids = row['genre_ids']
-                    if isinstance(genre_ids, (list, tuple)):
-                        all_genres.update(genre_ids)
-                    elif isinstance(genre_ids, str):
-                        genre_list = [int(g.strip()) for g in genre_ids.split(',') if g.strip().isdigit()]
-                        all_genres.update(genre_list)
-                
-                # Normalizar por el número de recomendaciones
-                diversity = len(all_genres) / (len(recommendations) * 3)  # Asumiendo 3 géneros por película
-                return min(diversity, 1.0)
-                
-        except Exception as e:
-            logger.error(f"❌ Error calculando diversidad: {e}")
+        if len(positions) == 0:
             return 0.0
+        
+        # Géneros de las películas encontradas (cada película una vez, como el WHERE id = ANY anterior)
+        found = np.unique(positions[positions >= 0])
+        genres = take_ragged(catalog['genre_offsets'], catalog['genre_values'], found)
+        unique_genres = len(np.unique(genres['values']))
+        
+        # Normalizar por el número de recomendaciones
+        diversity = unique_genres / (len(positions) * 3)  # Asumiendo 3 géneros por película
+        return min(diversity, 1.0)
     
-    def _calculate_novelty(self, recommendations: List[Dict]) -> float:
+    def _calculate_novelty(self, positions: np.ndarray, catalog: Dict) -> float:
         """Calcular novedad basada en popularidad (menos popular = más novedoso)"""
-        try:
-            with self.db_connection.cursor(cursor_factory=RealDictCursor) as cursor:
-                movie_ids = [rec['movie_id'] for rec in recommendations]
-                if not movie_ids:
-                    return 0.0
-                
-                cursor.execute("""
-                    SELECT popularity 
-                    FROM movies 
-                    WHERE id = ANY(%s)
-                """, (movie_ids,))
-                
-                results = cursor.fetchall()
-                popularities = [row['popularity'] for row in results if row['popularity'] is not None]
-                
-                if not popularities:
-                    return 0.0
-                
-                # Normalizar popularidad (menos popular = más novedoso)
-                avg_popularity = np.mean(popularities)
-                max_popularity = 1000  # Valor máximo típico de popularidad
-                novelty = 1.0 - (avg_popularity / max_popularity)
-                
-                return max(0.0, min(1.0, novelty))
-                
-        except Exception as e:
-            logger.error(f"❌ Error calculando novedad: {e}")
+        # Cada película cuenta una vez aunque se recomiende repetida
+        popularities = catalog['popularity'][np.unique(positions[positions >= 0])]
+        popularities = popularities[~np.isnan(popularities)]
+        if len(popularities) == 0:
             return 0.0
+        
+        # Normalizar popularidad (menos popular = más novedoso)
+        avg_popularity = np.mean(popularities)
+        max_popularity = 1000  # Valor máximo típico de popularidad
+        novelty = 1.0 - (avg_popularity / max_popularity)
+        
+        return float(max(0.0, min(1.0, novelty)))
     
-    def _calculate_coverage(self, recommendations: List[Dict]) -> float:
+    def _calculate_coverage(self, recommended_movie_ids: List[int], catalog: Dict) -> float:
         """Calcular cobertura (qué porcentaje del catálogo se recomienda)"""
-        try:
-            with self.db_connection.cursor() as cursor:
-                # Total de películas disponibles
-                cursor.execute("SELECT COUNT(*) FROM movies")
-                total_movies = cursor.fetchone()[0]
-                
-                # Películas recomendadas únicas
-                recommended_movie_ids = [rec['movie_id'] for rec in recommendations]
-                unique_recommended = len(set(recommended_movie_ids))
-                
-                coverage = unique_recommended / total_movies if total_movies > 0 else 0.0
-                return coverage
-                
-        except Exception as e:
-            logger.error(f"❌ Error calculando cobertura: {e}")
-            return 0.0
+        total_movies = catalog['catalog_size']
+        unique_recommended = len(set(recommended_movie_ids))
+        return unique_recommended / total_movies if total_movies > 0 else 0.0
     
-    def evaluate_model_performance(self) -> Dict:
-        """Evaluar el rendimiento general del modelo KNN"""
+    def evaluate_model_performance(self, top_k: int = 10, workers: int = 1) -> Dict:
+        """
+        Evaluar el rendimiento general del modelo KNN con un hold-out temporal sobre todos
+        los usuarios (ver knn_offline_evaluation.py). El informe completo va en 'report'.
+        """
+        if not self.db_pool:
+            return {"error": "No hay conexión a la base de datos"}
+        
         try:
-            # Obtener usuarios con suficientes datos
-            with self.db_connection.cursor() as cursor:
-                cursor.execute("""
-                    SELECT user_id, COUNT(*) as movie_count
-                    FROM user_movies 
-                    WHERE rating >= 4
-                    GROUP BY user_id 
-                    HAVING COUNT(*) >= 5
-                    ORDER BY movie_count DESC
-                    LIMIT 10
-                """)
-                
-                users = cursor.fetchall()
+            from knn_offline_evaluation import load_interactions, run_offline_evaluation
             
-            if not users:
-                return {"error": "No hay usuarios con suficientes datos para evaluar"}
+            self._get_catalog()
+            interactions = load_interactions(self.db_pool)
+            report = run_offline_evaluation(self.knn_service, interactions, top_k=top_k, workers=workers)
             
-            # Evaluar cada usuario
-            all_metrics = []
-            for user_id, movie_count in users:
-                # Aquí necesitarías obtener las recomendaciones reales del modelo
-                # Por ahora, simulamos métricas
-                metrics = {
-                    "user_id": user_id,
-                    "movie_count": movie_count,
-                    "precision_at_k": np.random.uniform(20, 80),  # Simulado
-                    "recall_at_k": np.random.uniform(15, 70),     # Simulado
-                    "f1_score_at_k": np.random.uniform(18, 75),   # Simulado
-                    "diversity_score": np.random.uniform(30, 90), # Simulado
-                    "novelty_score": np.random.uniform(20, 80),   # Simulado
-                }
-                all_metrics.append(metrics)
+            if report['data']['users_evaluated'] == 0:
+                return {"error": "No hay usuarios con suficientes datos para evaluar"}
             
-            # Calcular métricas promedio
-            avg_metrics = {
-                "avg_precision": round(np.mean([m['precision_at_k'] for m in all_metrics]), 2),
-                "avg_recall": round(np.mean([m['recall_at_k'] for m in all_metrics]), 2),
-                "avg_f1": round(np.mean([m['f1_score_at_k'] for m in all_metrics]), 2),
-                "avg_diversity": round(np.mean([m['diversity_score'] for m in all_metrics]), 2),
-                "avg_novelty": round(np.mean([m['novelty_score'] for m in all_metrics]), 2),
-                "total_users_evaluated": len(all_metrics)
+            metrics = report['metrics']
+            return {
+                "avg_precision": round(metrics['precision_at_k'] * 100, 2),
+                "avg_recall": round(metrics['recall_at_k'] * 100, 2),
+                "avg_f1": round(metrics['f1_at_k'] * 100, 2),
+                "avg_ndcg": round(metrics['ndcg_at_k'] * 100, 2),
+                "hit_rate": round(metrics['hit_rate'] * 100, 2),
+                "catalog_coverage": round(metrics['catalog_coverage'] * 100, 2),
+                "total_users_evaluated": report['data']['users_evaluated'],
+                "report": report
             }
             
-            return avg_metrics
-            
         except Exception as e:
             logger.error(f"❌ Error evaluando rendimiento del modelo: {e}")
             return {"error": str(e)}
     
     def close(self):
-        """Cerrar conexión a la base de datos"""
-        if self.db_connection:
-            self.db_connection.close()
+        """Soltar el pool compartido (las conexiones vuelven al pool, no se cierran)"""
+        self.db_pool = None
 
 def main():
     """Función principal para probar el evaluador"""
-    evaluator = KNNEvaluator()
+    from knn_service import EfficientKNNService
+    evaluator = KNNEvaluator(EfficientKNNService())
     
     print("🎯 Evaluador de Calidad KNN")
     print("=" * 50)
@@ -300,8 +232,9 @@ def main():
         print(f"✅ Precisión promedio: {model_metrics['avg_precision']}%")
         print(f"✅ Recall promedio: {model_metrics['avg_recall']}%")
         print(f"✅ F1-Score promedio: {model_metrics['avg_f1']}%")
-        print(f"✅ Diversidad promedio: {model_metrics['avg_diversity']}%")
-        print(f"✅ Novedad promedio: {model_metrics['avg_novelty']}%")
+        print(f"✅ NDCG promedio: {model_metrics['avg_ndcg']}%")
+        print(f"✅ Hit rate: {model_metrics['hit_rate']}%")
+        print(f"✅ Cobertura del catálogo: {model_metrics['catalog_coverage']}%")
         print(f"📈 Usuarios evaluados: {model_metrics['total_users_evaluated']}")
     else:
         print(f"❌ Error: {model_metrics['error']}")
@@ -0,0 +1,233 @@
+"""
+Ejecución acotada del trabajo de la API KNN fuera del event loop.
+
+- Cómputo (numpy/sklearn): un executor dedicado de tamaño fijo (KNN_EXECUTOR_WORKERS),
+  de hilos o de procesos según KNN_EXECUTOR_KIND. En modo 'process' cada proceso carga
+  el artefacto activo desde disco una vez (reaplicando el log de altas/bajas del catálogo)
+  y se recicla solo cuando cambia la versión del modelo; las altas/bajas posteriores las
+  leen del log antes de la siguiente llamada (con KNN_CATALOG_LOG=false no las ven).
+- E/S (consultas psycopg2 y operaciones que modifican el servicio del proceso): un pool
+  de hilos aparte (KNN_IO_WORKERS), para que una BD lenta no ocupe huecos de cómputo.
+- Límites por endpoint: semáforos asyncio con espera máxima (KNN_LIMIT_QUEUE_TIMEOUT_SECONDS);
+  si no hay hueco a tiempo se responde 503 en vez de encolar sin límite.
+- Micro-batching (opcional, KNN_MICROBATCH_ENABLED): las peticiones concurrentes se juntan
+  durante unos milisegundos o hasta N elementos y se resuelven con una sola llamada por lotes.
+
+Los endpoints baratos (/health, /model-status) no pasan por aquí y responden desde el loop.
+"""
+
+import asyncio
+import logging
+import multiprocessing
+import os
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from functools import partial
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+
+from fastapi import HTTPException
+
+logger = logging.getLogger(__name__)
+
+_worker_service = None
+
+
+def _init_process_worker(model_path: str):
+    """Inicializador de los procesos de cómputo: cargar el modelo una sola vez"""
+    global _worker_service
+    from knn_service import EfficientKNNService
+    _worker_service = EfficientKNNService(model_path=model_path)
+
+
+def _call_worker_service(method: str, kwargs: Dict, catalog_log_offset: int = 0):
+    """Llamar a un método del servicio del proceso, poniéndolo antes al día con el log del catálogo"""
+    if _worker_service.catalog_log_offset < catalog_log_offset:
+        _worker_service.catch_up_catalog_log()
+    return getattr(_worker_service, method)(**kwargs)
+
+
+class KNNExecutor:
+    """Executor de cómputo (hilos o procesos) + pool de hilos de E/S, con contadores"""
+
+    def __init__(self, kind: str = None, workers: int = None, io_workers: int = None):
+        self.kind = kind or os.getenv('KNN_EXECUTOR_KIND', 'thread')  # 'thread' o 'process'
+        self.workers = workers or int(os.getenv('KNN_EXECUTOR_WORKERS', os.cpu_count() or 1))
+        self.io_workers = io_workers or int(os.getenv('KNN_IO_WORKERS', os.getenv('KNN_DB_POOL_MAX', 10)))
+        self._threads = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='knn-compute')
+        self._io = ThreadPoolExecutor(max_workers=self.io_workers, thread_name_prefix='knn-io')
+        self._processes = None
+        self._process_model = None  # (model_path, model_version) cargado en los procesos
+        self._process_lock = threading.Lock()
+        self._metrics = {'compute_calls': 0, 'compute_in_flight': 0, 'io_calls': 0, 'io_in_flight': 0}
+
+    def _process_pool(self, service) -> Optional[ProcessPoolExecutor]:
+        """Pool de procesos para el modelo activo (se recrea si cambia la versión)"""
+        if not service.model_path:
+            return None
+        # Las altas/bajas no recrean el pool: cada llamada lleva el offset del log (ver compute)
+        model = (service.model_path, service.model_version)
+        with self._process_lock:
+            if self._processes is None or self._process_model != model:
+                if self._processes is not None:
+                    self._processes.shutdown(wait=False)
+                    logger.info(f"🔄 Reciclando procesos de cómputo para el modelo {service.model_version}")
+                self._processes = ProcessPoolExecutor(
+                    max_workers=self.workers, mp_context=multiprocessing.get_context('spawn'),
+                    initializer=_init_process_worker, initargs=(service.model_path,)
+                )
+                self._process_model = model
+            return self._processes
+
+    async def compute(self, service, method: str, **kwargs):
+        """Ejecutar service.<method>(**kwargs) en el executor de cómputo"""
+        loop = asyncio.get_running_loop()
+        processes = self._process_pool(service) if self.kind == 'process' else None
+        self._metrics['compute_calls'] += 1
+        self._metrics['compute_in_flight'] += 1
+        try:
+            if processes is not None:
+                return await loop.run_in_executor(processes, _call_worker_service, method, kwargs,
+                                                  service.catalog_log_offset)
+            return await loop.run_in_executor(self._threads, partial(getattr(service, method), **kwargs))
+        finally:
+            self._metrics['compute_in_flight'] -= 1
+
+    async def io(self, fn, *args, **kwargs):
+        """Ejecutar fn en el pool de E/S (BD y cambios sobre el servicio de este proceso)"""
+        loop = asyncio.get_running_loop()
+        self._metrics['io_calls'] += 1
+        self._metrics['io_in_flight'] += 1
+        try:
+            return await loop.run_in_executor(self._io, partial(fn, *args, **kwargs))
+        finally:
+            self._metrics['io_in_flight'] -= 1
+
+    def stats(self) -> Dict:
+        return {'kind': self.kind, 'workers': self.workers, 'io_workers': self.io_workers, **self._metrics}
+
+    def shutdown(self):
+        self._threads.shutdown(wait=False)
+        self._io.shutdown(wait=False)
+        if self._processes is not None:
+            self._processes.shutdown(wait=False)
+
+
+class EndpointLimiter:
+    """Máximo de peticiones concurrentes de un grupo de endpoints, con espera acotada"""
+
+    def __init__(self, name: str, limit: int, queue_timeout: float):
+        self.name = name
+        self.limit = limit
+        self.queue_timeout = queue_timeout
+        self._semaphore = None  # Se crea dentro del event loop que lo usa
+        self.in_flight = 0
+        self.rejected = 0
+
+    async def __aenter__(self):
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.limit)
+        try:
+            await asyncio.wait_for(self._semaphore.acquire(), timeout=self.queue_timeout)
+        except asyncio.TimeoutError:
+            self.rejected += 1
+            raise HTTPException(status_code=503, detail=f"Servidor ocupado ({self.name}), inténtalo de nuevo")
+        self.in_flight += 1
+        return self
+
+    async def __aexit__(self, *exc_info):
+        self.in_flight -= 1
+        self._semaphore.release()
+
+    def stats(self) -> Dict:
+        return {'limit': self.limit, 'in_flight': self.in_flight, 'rejected': self.rejected}
+
+
+class MicroBatcher:
+    """
+    Junta peticiones concurrentes durante max_delay segundos o hasta max_size elementos,
+    las resuelve con una sola llamada run_batch(items) -> resultados (mismo orden) y
+    devuelve a cada llamante el suyo. Mide el tamaño de los lotes y la espera añadida.
+    """
+
+    def __init__(self, name: str, run_batch: Callable[[List[Any]], Awaitable[List[Any]]],
+                 max_size: int, max_delay: float):
+        self.name = name
+        self.run_batch = run_batch
+        self.max_size = max_size
+        self.max_delay = max_delay
+        self._pending: List[tuple] = []  # (elemento, future, instante de llegada)
+        self._timer = None
+        self._metrics = {'batches': 0, 'items': 0, 'max_batch_size': 0, 'full_batches': 0,
+                         'queue_delay_seconds_total': 0.0, 'queue_delay_seconds_max': 0.0}
+
+    async def submit(self, item: Any) -> Any:
+        """Encolar un elemento y esperar su resultado"""
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._pending.append((item, future, time.perf_counter()))
+        if len(self._pending) >= self.max_size:
+            self._metrics['full_batches'] += 1
+            self._flush()
+        elif self._timer is None:
+            self._timer = loop.call_later(self.max_delay, self._flush)
+        return await future
+
+    def _flush(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        batch, self._pending = self._pending, []
+        if batch:
+            asyncio.ensure_future(self._run(batch))
+
+    async def _run(self, batch: List[tuple]):
+        now = time.perf_counter()
+        delays = [now - enqueued for _, _, enqueued in batch]
+        metrics = self._metrics
+        metrics['batches'] += 1
+        metrics['items'] += len(batch)
+        metrics['max_batch_size'] = max(metrics['max_batch_size'], len(batch))
+        metrics['queue_delay_seconds_total'] += sum(delays)
+        metrics['queue_delay_seconds_max'] = max(metrics['queue_delay_seconds_max'], max(delays))
+        
+        try:
+            results = await self.run_batch([item for item, _, _ in batch])
+        except Exception as e:
+            for _, future, _ in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        for (_, future, _), result in zip(batch, results):
+            if not future.done():  # El llamante pudo cancelar (desconexión del cliente)
+                future.set_result(result)
+
+    def stats(self) -> Dict:
+        metrics = self._metrics
+        batches, items = metrics['batches'], metrics['items']
+        return {
+            'max_size': self.max_size,
+            'max_delay_ms': round(self.max_delay * 1000, 3),
+            'batches': batches,
+            'items': items,
+            'avg_batch_size': round(items / batches, 2) if batches else 0.0,
+            'max_batch_size': metrics['max_batch_size'],
+            'full_batches': metrics['full_batches'],
+            'queue_delay_ms_avg': round(metrics['queue_delay_seconds_total'] * 1000 / items, 3) if items else 0.0,
+            'queue_delay_ms_max': round(metrics['queue_delay_seconds_max'] * 1000, 3)
+        }
+
+
+def endpoint_limiters(workers: int) -> Dict[str, EndpointLimiter]:
+    """Límites por grupo de endpoints (KNN_LIMIT_<GRUPO>); por defecto proporcionales al executor"""
+    queue_timeout = float(os.getenv('KNN_LIMIT_QUEUE_TIMEOUT_SECONDS', 5))
+    defaults = {
+        'recommendations': workers * 2,  # /recommendations/knn, /expand-recommendations, /efficient-recommendations
+        'similar': workers * 8,  # /similar: un slice de la tabla de vecinos
+        'evaluate': max(1, workers // 2),
+        'catalog': 2  # Escrituras del catálogo (ya serializadas por el servicio)
+    }
+    return {
+        name: EndpointLimiter(name, int(os.getenv(f'KNN_LIMIT_{name.upper()}', default)), queue_timeout)
+        for name, default in defaults.items()
+    }
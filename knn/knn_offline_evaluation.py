@@ -0,0 +1,381 @@
+#!/usr/bin/env python3
+"""
+Evaluación offline del modelo KNN sobre el historial real de user_movies.
+
+1. Se lee la tabla user_movies completa una sola vez (cursor de servidor en streaming),
+   o se reutiliza un volcado .npz para comparar modelos sobre los mismos datos.
+2. Hold-out temporal por usuario: la fracción más reciente de sus interacciones es el
+   conjunto de prueba y las películas con rating >= 4 de esa fracción son las relevantes.
+3. Las recomendaciones de cada lote de usuarios salen de una sola llamada a
+   EfficientKNNService.recommend_positions_batch.
+4. Precision@K, recall@K, F1@K, NDCG@K, hit-rate y cobertura del catálogo se calculan
+   con operaciones de conjuntos vectorizadas (np.isin sobre claves usuario/película).
+5. Los usuarios se reparten en fragmentos entre un pool de procesos; cada proceso carga
+   el modelo una vez (con un artefacto mmap las páginas se comparten).
+
+El resultado es un informe JSON estable (claves ordenadas) para hacer diff entre versiones:
+
+    python knn_offline_evaluation.py --output report.json --workers 4
+    python knn_offline_evaluation.py --interactions user_movies.npz --baseline report.json
+"""
+
+import os
+import sys
+import json
+import time
+import logging
+import argparse
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import Dict, List, Optional
+
+import numpy as np
+
+# Agregar el directorio actual al path
+sys.path.append(str(Path(__file__).parent))
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+LIKED_RATING = 4  # Mismo umbral que KNNEvaluator
+METRIC_NAMES = ['precision_at_k', 'recall_at_k', 'f1_at_k', 'ndcg_at_k', 'hit_rate']
+
+INTERACTIONS_QUERY = """
+    SELECT user_id, movie_id, rating, created_at
+    FROM user_movies
+    WHERE rating IS NOT NULL OR watched = true
+"""
+
+
+def load_interactions(db_pool, itersize: int = 50000) -> Dict[str, np.ndarray]:
+    """Leer user_movies completa en una sola pasada y devolverla como arrays"""
+    chunks = []
+    with db_pool.connection() as conn, conn.cursor(name='knn_offline_interactions') as cursor:
+        cursor.itersize = itersize
+        cursor.execute(INTERACTIONS_QUERY)
+        while True:
+            rows = cursor.fetchmany(itersize)
+            if not rows:
+                break
+            user_ids, movie_ids, ratings, created_at = zip(*rows)
+            chunks.append({
+                'user_ids': np.asarray(user_ids, dtype=np.int64),
+                'movie_ids': np.asarray(movie_ids, dtype=np.int64),
+                'ratings': np.array([np.nan if r is None else r for r in ratings], dtype=np.float64),
+                'created_at': np.array(created_at, dtype='datetime64[us]')
+            })
+
+    if not chunks:
+        return {name: np.empty(0, dtype=dtype) for name, dtype in
+                (('user_ids', np.int64), ('movie_ids', np.int64), ('ratings', np.float64),
+                 ('created_at', 'datetime64[us]'))}
+    return {name: np.concatenate([chunk[name] for chunk in chunks]) for name in chunks[0]}
+
+
+def save_interactions(interactions: Dict[str, np.ndarray], path: str):
+    """Volcar las interacciones para repetir la evaluación con otro modelo"""
+    np.savez(path, **interactions)
+
+
+def read_interactions(path: str) -> Dict[str, np.ndarray]:
+    with np.load(path) as data:
+        return {name: data[name] for name in data.files}
+
+
+def temporal_split(interactions: Dict[str, np.ndarray], holdout_fraction: float = 0.2,
+                   min_interactions: int = 5) -> Dict[str, np.ndarray]:
+    """
+    Hold-out temporal por usuario, sin bucles por usuario.
+
+    Devuelve en CSR (offsets por usuario) el historial de entrenamiento con sus pesos
+    (rating / 5, 1 sin rating, como _normalize_user_history) y las películas relevantes
+    de prueba. Solo se evalúan usuarios con al menos una película relevante en prueba.
+    """
+    order = np.lexsort((interactions['created_at'], interactions['user_ids']))
+    user_ids = interactions['user_ids'][order]
+    movie_ids = interactions['movie_ids'][order]
+    ratings = interactions['ratings'][order]
+
+    users, starts, counts = np.unique(user_ids, return_index=True, return_counts=True)
+    n_test = np.maximum(1, (counts * holdout_fraction).astype(np.int64))
+    rank_in_user = np.arange(len(user_ids)) - np.repeat(starts, counts)
+    is_test = rank_in_user >= np.repeat(counts - n_test, counts)
+    eligible = np.repeat(counts >= min_interactions, counts)
+
+    train = eligible & ~is_test
+    relevant = eligible & is_test & (ratings >= LIKED_RATING)
+
+    # Usuarios evaluables: con historial suficiente y algo relevante que acertar
+    relevant_per_user = np.bincount(np.searchsorted(users, user_ids[relevant]), minlength=len(users))
+    evaluated = relevant_per_user > 0
+    keep_rows = np.repeat(evaluated, counts)
+    train, relevant = train & keep_rows, relevant & keep_rows
+
+    def to_csr(mask: np.ndarray) -> np.ndarray:
+        per_user = np.bincount(np.searchsorted(users, user_ids[mask]), minlength=len(users))[evaluated]
+        offsets = np.zeros(len(per_user) + 1, dtype=np.int64)
+        np.cumsum(per_user, out=offsets[1:])
+        return offsets
+
+    train_weights = np.where(np.isnan(ratings[train]), 1.0, ratings[train] / 5.0)
+    return {
+        'user_ids': users[evaluated],
+        'train_offsets': to_csr(train),
+        'train_movie_ids': movie_ids[train],
+        'train_weights': train_weights,
+        'test_offsets': to_csr(relevant),
+        'test_movie_ids': movie_ids[relevant],
+        'users_total': np.int64(len(users)),
+        'users_below_min_interactions': np.int64((counts < min_interactions).sum()),
+        'users_without_relevant_test': np.int64(((counts >= min_interactions) & ~evaluated).sum())
+    }
+
+
+def ranking_metrics(recommended_ids: np.ndarray, test_offsets: np.ndarray, test_movie_ids: np.ndarray,
+                    top_k: int) -> Dict[str, np.ndarray]:
+    """Métricas por usuario para una matriz (usuarios, K) de ids recomendados (-1 = hueco)"""
+    n_users = recommended_ids.shape[0]
+    n_relevant = np.diff(test_offsets)
+
+    # Clave usuario << 32 | película: un solo np.isin marca todos los aciertos del lote
+    relevant_keys = (np.repeat(np.arange(n_users, dtype=np.int64), n_relevant) << 32) | test_movie_ids
+    recommended_keys = (np.arange(n_users, dtype=np.int64)[:, None] << 32) | np.maximum(recommended_ids, 0)
+    hits = np.isin(recommended_keys, relevant_keys) & (recommended_ids >= 0)
+
+    n_hits = hits.sum(axis=1)
+    precision = n_hits / top_k
+    recall = n_hits / np.maximum(n_relevant, 1)
+    f1 = np.divide(2 * precision * recall, precision + recall,
+                   out=np.zeros(n_users), where=(precision + recall) > 0)
+
+    discounts = 1.0 / np.log2(np.arange(2, top_k + 2))
+    ideal = np.cumsum(discounts)[np.minimum(n_relevant, top_k) - 1]
+    ndcg = (hits @ discounts) / ideal
+
+    return {
+        'precision_at_k': precision,
+        'recall_at_k': recall,
+        'f1_at_k': f1,
+        'ndcg_at_k': ndcg,
+        'hit_rate': (n_hits > 0).astype(np.float64)
+    }
+
+
+_worker_service = None
+
+
+def _init_worker(model_path: str):
+    """Inicializador del pool: cada proceso carga el modelo una sola vez"""
+    global _worker_service
+    logging.getLogger('knn_service').setLevel(logging.WARNING)
+    from knn_service import EfficientKNNService
+    _worker_service = EfficientKNNService(model_path=model_path)
+
+
+def _evaluate_shard_in_worker(shard: Dict[str, np.ndarray], top_k: int, batch_size: int,
+                              mode: Optional[str]) -> Dict:
+    return evaluate_shard(_worker_service, shard, top_k, batch_size, mode)
+
+
+def evaluate_shard(service, shard: Dict[str, np.ndarray], top_k: int, batch_size: int,
+                   mode: Optional[str] = None) -> Dict:
+    """Recomendar y puntuar un fragmento de usuarios por lotes; devuelve sumas de métricas"""
+    sums = {name: 0.0 for name in METRIC_NAMES}
+    recommended_positions = []
+    train_offsets, test_offsets = shard['train_offsets'], shard['test_offsets']
+    n_users = len(train_offsets) - 1
+
+    for start in range(0, n_users, batch_size):
+        stop = min(start + batch_size, n_users)
+        train_slice = slice(train_offsets[start], train_offsets[stop])
+        test_slice = slice(test_offsets[start], test_offsets[stop])
+
+        # Historial de entrenamiento -> posiciones (las películas fuera del catálogo se descartan)
+        positions = service.lookup_positions(shard['train_movie_ids'][train_slice])
+        known = positions >= 0
+        owners = np.repeat(np.arange(stop - start), np.diff(train_offsets[start:stop + 1]))[known]
+        history_offsets = np.zeros(stop - start + 1, dtype=np.int64)
+        np.cumsum(np.bincount(owners, minlength=stop - start), out=history_offsets[1:])
+
+        recommended = service.recommend_positions_batch(
+            history_offsets, positions[known], shard['train_weights'][train_slice][known], top_k, mode=mode
+        )
+        recommended_ids = np.where(recommended >= 0, service.movie_ids[np.maximum(recommended, 0)], -1)
+        metrics = ranking_metrics(recommended_ids, test_offsets[start:stop + 1] - test_offsets[start],
+                                  shard['test_movie_ids'][test_slice], top_k)
+        for name in METRIC_NAMES:
+            sums[name] += float(metrics[name].sum())
+        recommended_positions.append(np.unique(recommended[recommended >= 0]))
+
+    return {
+        'users': n_users,
+        'sums': sums,
+        'recommended_positions': np.unique(np.concatenate(recommended_positions)) if recommended_positions
+        else np.empty(0, dtype=np.int64)
+    }
+
+
+def _shard_split(split: Dict[str, np.ndarray], n_shards: int) -> List[Dict[str, np.ndarray]]:
+    """Cortar el CSR de usuarios en fragmentos contiguos con offsets rebasados"""
+    n_users = len(split['user_ids'])
+    bounds = np.linspace(0, n_users, max(1, min(n_shards, n_users)) + 1).astype(np.int64)
+    shards = []
+    for start, stop in zip(bounds[:-1].tolist(), bounds[1:].tolist()):
+        train_offsets = split['train_offsets'][start:stop + 1]
+        test_offsets = split['test_offsets'][start:stop + 1]
+        shards.append({
+            'train_offsets': train_offsets - train_offsets[0],
+            'train_movie_ids': split['train_movie_ids'][train_offsets[0]:train_offsets[-1]],
+            'train_weights': split['train_weights'][train_offsets[0]:train_offsets[-1]],
+            'test_offsets': test_offsets - test_offsets[0],
+            'test_movie_ids': split['test_movie_ids'][test_offsets[0]:test_offsets[-1]]
+        })
+    return shards
+
+
+def run_offline_evaluation(service, interactions: Dict[str, np.ndarray], top_k: int = 10,
+                           holdout_fraction: float = 0.2, min_interactions: int = 5,
+                           workers: int = 1, batch_size: int = 2048, mode: Optional[str] = None) -> Dict:
+    """
+    Evaluación offline completa. Con workers > 1 los fragmentos se reparten en procesos
+    que cargan el modelo desde service.model_path; si no hay ruta se evalúa en este proceso.
+    """
+    started = time.perf_counter()
+    split = temporal_split(interactions, holdout_fraction, min_interactions)
+    split_seconds = time.perf_counter() - started
+
+    n_users = len(split['user_ids'])
+    if workers > 1 and not service.model_path:
+        logger.warning("⚠️ El modelo no tiene ruta en disco, evaluando en un solo proceso")
+        workers = 1
+
+    scoring_started = time.perf_counter()
+    if workers > 1 and n_users > 0:
+        # Varios fragmentos por proceso para repartir bien usuarios con historiales desiguales
+        shards = _shard_split(split, workers * 4)
+        context = multiprocessing.get_context('spawn')
+        with ProcessPoolExecutor(max_workers=workers, mp_context=context,
+                                 initializer=_init_worker, initargs=(service.model_path,)) as executor:
+            results = list(executor.map(_evaluate_shard_in_worker, shards,
+                                        [top_k] * len(shards), [batch_size] * len(shards), [mode] * len(shards)))
+    else:
+        results = [evaluate_shard(service, shard, top_k, batch_size, mode) for shard in _shard_split(split, 1)]
+    scoring_seconds = time.perf_counter() - scoring_started
+
+    evaluated = sum(result['users'] for result in results)
+    metrics = {
+        name: round(sum(result['sums'][name] for result in results) / evaluated, 6) if evaluated else 0.0
+        for name in METRIC_NAMES
+    }
+    recommended = np.unique(np.concatenate([result['recommended_positions'] for result in results])) \
+        if results else np.empty(0, dtype=np.int64)
+    catalog_size = service.live_movie_count
+    metrics['catalog_coverage'] = round(len(recommended) / catalog_size, 6) if catalog_size else 0.0
+
+    return {
+        'model_version': service.model_version,
+        'model_path': service.model_path,
+        'catalog_revision': service.catalog_revision,
+        'catalog_size': catalog_size,
+        'generated_at': datetime.now(timezone.utc).strftime('%Y-%m-%dT%H:%M:%S%z'),
+        'config': {
+            'top_k': top_k,
+            'holdout_fraction': holdout_fraction,
+            'min_interactions': min_interactions,
+            'liked_rating': LIKED_RATING,
+            'mode': mode or service.USER_RECOMMENDATION_MODE,
+            'score_aggregation': service.USER_SCORE_AGGREGATION,
+            'seed_neighbors': service.USER_SEED_NEIGHBORS,
+            'workers': workers,
+            'batch_size': batch_size
+        },
+        'data': {
+            'interactions': int(len(interactions['user_ids'])),
+            'users_total': int(split['users_total']),
+            'users_evaluated': evaluated,
+            'users_below_min_interactions': int(split['users_below_min_interactions']),
+            'users_without_relevant_test': int(split['users_without_relevant_test']),
+            'train_interactions': int(len(split['train_movie_ids'])),
+            'relevant_test_interactions': int(len(split['test_movie_ids']))
+        },
+        'metrics': metrics,
+        'timings_seconds': {
+            'split': round(split_seconds, 3),
+            'recommend_and_score': round(scoring_seconds, 3),
+            'total': round(time.perf_counter() - started, 3)
+        }
+    }
+
+
+def compare_reports(report: Dict, baseline: Dict) -> Dict[str, float]:
+    """Diferencia de cada métrica respecto a un informe anterior"""
+    return {
+        name: round(value - baseline.get('metrics', {}).get(name, 0.0), 6)
+        for name, value in report['metrics'].items()
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Evaluación offline del modelo KNN (hold-out temporal)")
+    parser.add_argument('--model', default=None, help="Modelo a evaluar (por defecto el del servicio)")
+    parser.add_argument('--interactions', default=None,
+                        help="Volcado .npz de user_movies; si no existe se lee la BD y se guarda ahí")
+    parser.add_argument('--output', default='knn_offline_report.json')
+    parser.add_argument('--baseline', default=None, help="Informe anterior con el que comparar")
+    parser.add_argument('--top-k', type=int, default=10)
+    parser.add_argument('--holdout-fraction', type=float, default=0.2)
+    parser.add_argument('--min-interactions', type=int, default=5)
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1)
+    parser.add_argument('--batch-size', type=int, default=2048)
+    parser.add_argument('--mode', choices=['seeds', 'profile'], default=None)
+    args = parser.parse_args()
+
+    from knn_service import EfficientKNNService
+
+    print("🎯 Evaluación offline KNN")
+    print("=" * 50)
+
+    service = EfficientKNNService(model_path=args.model)
+    if not service.is_model_loaded():
+        print("❌ No hay modelo KNN cargado")
+        sys.exit(1)
+
+    if args.interactions and os.path.exists(args.interactions):
+        interactions = read_interactions(args.interactions)
+    else:
+        from db_pool import get_database_pool, close_database_pool
+        db_pool = get_database_pool()
+        if db_pool is None:
+            print("❌ No se pudo conectar a la base de datos")
+            sys.exit(1)
+        try:
+            interactions = load_interactions(db_pool)
+        finally:
+            close_database_pool()
+        if args.interactions:
+            save_interactions(interactions, args.interactions)
+    print(f"📊 Interacciones: {len(interactions['user_ids'])}")
+
+    report = run_offline_evaluation(
+        service, interactions, top_k=args.top_k, holdout_fraction=args.holdout_fraction,
+        min_interactions=args.min_interactions, workers=args.workers, batch_size=args.batch_size, mode=args.mode
+    )
+    if args.baseline:
+        with open(args.baseline) as f:
+            report['delta_vs_baseline'] = compare_reports(report, json.load(f))
+
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=2, sort_keys=True)
+
+    print(f"✅ Usuarios evaluados: {report['data']['users_evaluated']} "
+          f"en {report['timings_seconds']['total']} s")
+    for name, value in report['metrics'].items():
+        delta = report.get('delta_vs_baseline', {}).get(name)
+        print(f"   {name}: {value:.4f}" + (f" ({delta:+.4f})" if delta is not None else ""))
+    print(f"💾 Informe guardado en {args.output}")
+
+
+if __name__ == "__main__":
+    main()
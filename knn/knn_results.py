@@ -0,0 +1,70 @@
+"""
+Resultados intermedios del servicio KNN como estructura de arrays.
+
+Las rutas de recomendación (historial, relleno con populares, expansión social y ranking)
+se pasan un RecommendationBatch: arrays numpy alineados de posiciones de fila, ids,
+similitudes, scores, fuentes y semilla de origen. Filtrar, deduplicar u ordenar es
+indexar esos arrays; los dicts de respuesta se construyen una sola vez, al final del
+método público del servicio al que llama la API.
+"""
+
+from typing import List
+
+import numpy as np
+
+# Fuente de cada fila (columna 'sources', int8)
+SOURCE_KNN = 0  # Vecino de las películas vistas o del perfil del usuario
+SOURCE_POPULAR = 1  # Relleno con películas populares
+SOURCE_SOCIAL = 2  # Recomendación social de entrada (fuera del catálogo: posición -1)
+SOURCE_KNN_EXPANSION = 3  # Vecino de una recomendación social
+SOURCE_NAMES = ('knn', 'popular', 'social', 'knn_expansion')
+
+
+class RecommendationBatch:
+    """Columnas alineadas de un lote de resultados: una fila por película"""
+
+    __slots__ = ('positions', 'movie_ids', 'similarities', 'scores', 'sources', 'seeds')
+
+    def __init__(self, positions, movie_ids, similarities, scores=None, sources=SOURCE_KNN, seeds=None):
+        self.positions = np.asarray(positions, dtype=np.int64)  # Fila del catálogo (-1 si no es del catálogo)
+        n_rows = len(self.positions)
+        self.movie_ids = np.asarray(movie_ids, dtype=np.int64)
+        self.similarities = np.asarray(similarities, dtype=np.float64)
+        # NaN = la fila no lleva score (p. ej. relleno con populares)
+        self.scores = np.full(n_rows, np.nan) if scores is None else np.asarray(scores, dtype=np.float64)
+        self.sources = (np.full(n_rows, sources, dtype=np.int8) if np.isscalar(sources)
+                        else np.asarray(sources, dtype=np.int8))
+        # Índice de la entrada que originó la fila (recomendación social expandida); -1 si no aplica
+        self.seeds = np.full(n_rows, -1, dtype=np.int64) if seeds is None else np.asarray(seeds, dtype=np.int64)
+
+    @classmethod
+    def empty(cls) -> 'RecommendationBatch':
+        return cls(np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64), np.empty(0))
+
+    @classmethod
+    def _from_columns(cls, columns) -> 'RecommendationBatch':
+        """Lote a partir de columnas ya tipadas (sin las conversiones de __init__)"""
+        batch = cls.__new__(cls)
+        for name, column in zip(cls.__slots__, columns):
+            setattr(batch, name, column)
+        return batch
+
+    @classmethod
+    def concat(cls, batches: List['RecommendationBatch']) -> 'RecommendationBatch':
+        return cls._from_columns(np.concatenate([getattr(batch, name) for batch in batches]) for name in cls.__slots__)
+
+    def __len__(self) -> int:
+        return len(self.positions)
+
+    def take(self, index) -> 'RecommendationBatch':
+        """Filas seleccionadas (máscara o índices), en el orden de index"""
+        return self._from_columns(getattr(self, name)[index] for name in self.__slots__)
+
+    def first_per_movie(self) -> 'RecommendationBatch':
+        """Primera aparición de cada película, conservando el orden del lote"""
+        _, first = np.unique(self.movie_ids, return_index=True)
+        return self.take(np.sort(first))
+
+    def top_by_score(self, limit: int) -> 'RecommendationBatch':
+        """Las `limit` filas de mayor score; los empates conservan el orden del lote (como sorted)"""
+        return self.take(np.argsort(-self.scores, kind='stable')[:limit])
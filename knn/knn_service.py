@@ -9,11 +9,28 @@ from typing import List, Dict, Tuple, Optional
 import os
 import psycopg2
 from psycopg2.extras import RealDictCursor
+from db_pool import get_database_pool
+from knn_engines import ExactCosineEngine, RandomProjectionLSHIndex, recall_at_k
+from knn_artifact import is_artifact_dir, save_knn_artifact, load_knn_artifact
+import knn_catalog
+from knn_catalog import SegmentedArray, materialize, encode_genres, decode_strings, take_ragged
+import knn_catalog_updates as catalog_updates
+from knn_user_stats import UserStatsAccumulator
+from knn_cache import LRUResultCache
+from knn_results import RecommendationBatch, SOURCE_POPULAR, SOURCE_SOCIAL, SOURCE_KNN_EXPANSION
+from service_metrics import stage, timed_stage
+import json
+import threading
+import time
 
 # Configurar logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# Codificación de las características. 1: genre_diversity valía 1 en todas las películas (count_genres
+# fallaba con las listas de PostgreSQL); 2: número de géneros, mínimo 1
+FEATURE_VERSION = 2
+
 class EfficientKNNService:
     """
     Servicio KNN eficiente que implementa las 3 estrategias para evitar sobrecargar el sistema:
@@ -24,15 +41,18 @@ class EfficientKNNService:
     AHORA USA DATOS PRE-ENTRENADOS COMO EL MODELO RANDOMFOREST
     """
     
-    def __init__(self, model_path: str = None):
+    def __init__(self, model_path: str = None, auto_load: bool = True):
         self.movies_df = None
         self.knn_model = None
+        self.model_version = None  # Versión del artefacto cargado (manifest o mtime del .pkl)
+        self.model_path = None
         self.scaler = StandardScaler()
-        self.db_connection = None
+        self.db_pool = None  # Pool compartido del proceso (db_pool.py)
         self.feature_columns = [
             'vote_average', 'vote_count', 'popularity', 'years_since_release',
             'genre_diversity', 'avg_user_rating', 'user_rating_count'
         ]
+        self.feature_version = FEATURE_VERSION  # La del modelo cargado: las altas se codifican igual
         
         # Configuraciones para controlar el uso de recursos
         self.MAX_KNN_MOVIES = 20  # Máximo de películas para aplicar KNN
@@ -40,6 +60,90 @@ class EfficientKNNService:
         self.FINAL_TOP_K = 10  # Top-K final para el usuario
         self.KNN_NEIGHBORS = 3  # Número de vecinos para KNN
         
+        # Tabla de vecinos precalculada: (n_movies, K_max) índices + similitudes float32
+        self.NEIGHBOR_TABLE_K = int(os.getenv('KNN_NEIGHBOR_TABLE_K', 50))  # K_max servible con un slice
+        self.NEIGHBOR_TABLE_CHUNK_SIZE = int(os.getenv('KNN_NEIGHBOR_TABLE_CHUNK_SIZE', 2048))  # Filas por bloque
+        self.feature_matrix = None  # Características escaladas usadas para entrenar
+        
+        # Motor de consulta: 'exact' (coseno BLAS float32), 'sklearn' (NearestNeighbors.kneighbors)
+        # o 'ann' (índice aproximado con cualquier tamaño de catálogo; el exacto queda de respaldo)
+        self.KNN_ENGINE = os.getenv('KNN_ENGINE', 'exact')
+        # Memoria por bloque de consultas del motor exacto (similitudes + argpartition)
+        self.ENGINE_QUERY_BUFFER_BYTES = int(float(os.getenv('KNN_ENGINE_QUERY_BUFFER_MB', 64)) * 1024 * 1024)
+        self.search_engine = None
+        self.MMAP_ARTIFACTS = os.getenv('KNN_MMAP_ARTIFACTS', 'true').lower() == 'true'  # np.load(mmap_mode='r')
+        
+        # Índice aproximado (LSH multi-tabla) para catálogos grandes
+        self.ANN_THRESHOLD = int(os.getenv('KNN_ANN_THRESHOLD', 200000))  # Películas a partir de las que se usa
+        self.ANN_TABLES = int(os.getenv('KNN_ANN_TABLES', 8))  # Más tablas = más recall
+        self.ANN_BITS = int(os.getenv('KNN_ANN_BITS', 16))  # Más bits = cubetas más pequeñas, menos latencia
+        self.ANN_PROBES = int(os.getenv('KNN_ANN_PROBES', 2))  # Cubetas vecinas exploradas por tabla
+        self.ann_index = None
+        self.ann_report = None
+        # Tabla de vecinos (índices, similitudes): se publica como una tupla en una sola asignación
+        # y los lectores la leen una vez por llamada, así nunca combinan índices y similitudes de versiones distintas
+        self._neighbor_table = None
+        
+        # Recomendaciones por usuario: vecinos leídos por película vista y agregación de scores
+        self.USER_SEED_NEIGHBORS = int(os.getenv('KNN_USER_SEED_NEIGHBORS', 20))
+        self.USER_SCORE_AGGREGATION = os.getenv('KNN_USER_SCORE_AGGREGATION', 'sum')  # 'sum' o 'max'
+        self.USER_RECOMMENDATION_MODE = os.getenv('KNN_USER_RECOMMENDATION_MODE', 'seeds')  # 'seeds' o 'profile'
+        
+        # Índice persistente id -> posición de fila (evita escanear movies_df por id)
+        self.movie_ids = None  # np.int64, alineado con las filas de movies_df
+        # (ids ordenados, posiciones, dict id -> posición), publicado de una vez igual que la tabla:
+        # ids + posiciones para lotes con np.searchsorted, el dict para búsquedas escalares O(1)
+        self._id_index = None
+        self._id_delta = None  # (ids ordenados, posiciones) de las altas; None = sin escrituras desde el índice
+        
+        # Actualizaciones incrementales del catálogo (knn_catalog_updates.py): altas y filas parcheadas en
+        # un delta (SegmentedArray) sobre los arrays base, y filas borradas marcadas (tombstones) hasta compactar
+        self.tombstoned = None  # bool por fila; None = ninguna fila borrada
+        self.n_tombstoned = 0
+        self._catalog_tail = None  # Filas de catálogo de las altas (DataFrame con las columnas de movies_df)
+        self._feature_medians = None  # (movies_df, {columna: mediana}) para rellenar las altas
+        self.catalog_revision = 0  # Se incrementa en cada alta/baja incremental
+        self.INCREMENTAL_CHUNK_SIZE = int(os.getenv('KNN_INCREMENTAL_CHUNK_SIZE', 65536))  # Filas por bloque al parchear
+        self._update_lock = threading.Lock()  # Serializa escritores; los lectores no bloquean
+        # Log de altas/bajas junto al artefacto: se reaplica al cargar, así recargas, reinicios y
+        # procesos de cómputo ven el mismo catálogo hasta que un entrenamiento nuevo lo incorpore
+        self.CATALOG_LOG_ENABLED = os.getenv('KNN_CATALOG_LOG', 'true').lower() == 'true'
+        self.base_model_version = None  # Versión del artefacto en disco sobre la que se aplica el log
+        self.catalog_snapshot_at = None  # Cuándo se leyó el catálogo de la BD (time.time()): el log posterior aplica
+        self._replaying_catalog_log = False
+        self._catalog_log_offset = 0  # Bytes del log ya reflejados en este servicio
+        
+        # Carga desde BD en streaming: cursor de servidor que trae LOAD_ITERSIZE filas por viaje
+        self.LOAD_ITERSIZE = int(os.getenv('KNN_LOAD_ITERSIZE', 20000))
+        # Catálogo compacto: movies_df solo guarda columnas numéricas (CATALOG_DTYPES); títulos y
+        # géneros van en buffers + offsets alineados con sus filas (ver knn_catalog.py)
+        self.genre_offsets = None  # Géneros en CSR: offsets (n+1) int64
+        self.genre_values = None  # ... y valores concatenados int32
+        self.title_offsets = None  # Títulos internados: offsets (n+1) int64
+        self.title_bytes = None  # ... sobre un único buffer UTF-8 uint8
+        self._evaluation_catalog = None  # Arrays para métricas de evaluación, por versión del catálogo
+        self._catalog_arrays = None  # (movies_df, {columna: array}) para hidratar sin pasar por pandas
+        
+        # Estadísticas de usuarios incrementales: acumulador suma/recuento por película con marca de agua
+        self.USER_STATS_PATH = os.getenv('KNN_USER_STATS_PATH')  # None = junto al artefacto (ver _user_stats_path)
+        self.USER_STATS_LAG_SECONDS = float(os.getenv('KNN_USER_STATS_LAG_SECONDS', 60))  # Margen para commits tardíos
+        self.USER_STATS_FULL_REFRESH = os.getenv('KNN_USER_STATS_FULL_REFRESH', 'false').lower() == 'true'
+        
+        # Caché LRU de find_similar_movies: clave (movie_id, top_k); la versión del modelo y la
+        # revisión del catálogo forman la generación, así que recargas y altas/bajas la vacían
+        self.SIMILAR_CACHE_ENTRIES = int(os.getenv('KNN_SIMILAR_CACHE_ENTRIES', 10000))  # 0 = desactivada
+        self.SIMILAR_CACHE_MB = float(os.getenv('KNN_SIMILAR_CACHE_MB', 64))
+        self.SIMILAR_CACHE_WARMUP = int(os.getenv('KNN_SIMILAR_CACHE_WARMUP', 0))  # Populares precargadas (0 = no)
+        self.SIMILAR_CACHE_WARMUP_TOP_K = [int(k) for k in os.getenv('KNN_SIMILAR_CACHE_WARMUP_TOP_K', '5').split(',')]
+        self.similar_cache = LRUResultCache(self.SIMILAR_CACHE_ENTRIES, int(self.SIMILAR_CACHE_MB * 1024 * 1024))
+        
+        # Callback opcional progress_callback(phase) para seguir un entrenamiento (ver knn_training_jobs.py)
+        self.progress_callback = None
+        
+        # auto_load=False crea un servicio vacío (p. ej. para entrenar en un proceso aparte)
+        if not auto_load:
+            return
+        
         # Solo conectar a la base de datos si estamos en desarrollo
         if os.getenv('ENVIRONMENT') == 'development':
             if model_path and os.path.exists(model_path):
@@ -55,50 +159,84 @@ class EfficientKNNService:
                 logger.info(f"📁 Cargando modelo KNN desde: {model_path}")
                 self.load_knn_model(model_path)
             else:
-                default_model_path = "knn_model.pkl"
+                default_model_path = self.default_model_path()
                 if os.path.exists(default_model_path):
                     logger.info(f"📁 Cargando modelo KNN por defecto: {default_model_path}")
                     self.load_knn_model(default_model_path)
                 else:
                     logger.warning("⚠️ Archivos de modelo no encontrados, creando servicio vacío")
     
+    @property
+    def neighbor_indices(self) -> Optional[np.ndarray]:
+        table = self._neighbor_table
+        return None if table is None else table[0]
+    
+    @property
+    def neighbor_similarities(self) -> Optional[np.ndarray]:
+        table = self._neighbor_table
+        return None if table is None else table[1]
+    
+    def _publish_neighbor_table(self, indices: Optional[np.ndarray], similarities: Optional[np.ndarray]):
+        """Sustituir la tabla de vecinos en una sola asignación (ver _neighbor_table)"""
+        self._neighbor_table = None if indices is None else (indices, similarities)
+    
+    @property
+    def id_to_position(self) -> Dict[int, int]:
+        id_index = self._id_index
+        if id_index is None:
+            return {}
+        if self._id_delta is None:
+            return id_index[2]
+        live = np.flatnonzero(~np.asarray(self.tombstoned))  # Con altas/bajas: se recalcula (O(catálogo))
+        return dict(zip(self.movie_ids[live].tolist(), live.tolist()))
+    
+    @property
+    def live_movie_count(self) -> int:
+        return 0 if self.movie_ids is None else len(self.movie_ids) - self.n_tombstoned
+    
+    @staticmethod
+    def default_model_path() -> str:
+        """Artefacto por defecto: KNN_MODEL_PATH, o el directorio knn_model/ si existe, o knn_model.pkl"""
+        configured = os.getenv('KNN_MODEL_PATH')
+        if configured:
+            return configured
+        return "knn_model" if is_artifact_dir("knn_model") else "knn_model.pkl"
+    
+    def is_model_loaded(self) -> bool:
+        """Hay un motor de búsqueda y un catálogo listos para responder consultas"""
+        return self.search_engine is not None and self.movies_df is not None
+    
+    def _report_progress(self, phase: str):
+        """Notificar la fase actual de entrenamiento si hay un callback registrado"""
+        if self.progress_callback is not None:
+            self.progress_callback(phase)
+    
     def connect_database(self):
-        """Conectar a la base de datos PostgreSQL"""
-        try:
-            # Usar variables de entorno o valores por defecto
-            db_host = os.getenv('DB_HOST', 'localhost')
-            db_name = os.getenv('DB_NAME', 'MovieMatch')
-            db_user = os.getenv('DB_USER', 'postgres')
-            db_password = os.getenv('DB_PASSWORD', 'admin')
-            db_port = os.getenv('DB_PORT', '5432')
-            
-            logger.info(f"🔌 Conectando a BD: {db_host}:{db_port}/{db_name}")
-            
-            self.db_connection = psycopg2.connect(
-                host=db_host,
-                database=db_name,
-                user=db_user,
-                password=db_password,
-                port=db_port
-            )
-            logger.info("✅ Conexión a base de datos establecida")
-            
-        except Exception as e:
-            logger.error(f"❌ Error conectando a la base de datos: {e}")
+        """Conectar a la base de datos PostgreSQL a través del pool compartido (ver db_pool.py)"""
+        self.db_pool = get_database_pool()
+        if self.db_pool is None:
             logger.error("💡 Asegúrate de que PostgreSQL esté corriendo y las credenciales sean correctas")
-            self.db_connection = None
     
     def load_movies_from_database(self):
-        """Cargar datos de películas directamente desde la base de datos"""
-        if not self.db_connection:
+        """
+        Cargar datos de películas directamente desde la base de datos.
+        
+        Usa un cursor de servidor (con nombre) que trae LOAD_ITERSIZE tuplas por viaje y solo
+        las columnas que necesitan las características; cada bloque se convierte a columnas
+        numpy tipadas, de modo que el pico de memoria es el catálogo final más un bloque.
+        """
+        if not self.db_pool:
             logger.error("❌ No hay conexión a la base de datos")
             return
         
         try:
             logger.info("📊 Cargando películas desde la base de datos...")
+            self._report_progress('loading')
+            self.catalog_snapshot_at = time.time()
             
-            with self.db_connection.cursor(cursor_factory=RealDictCursor) as cursor:
-                # Obtener todas las películas con sus características
+            with self.db_pool.connection() as conn, conn.cursor(name='knn_movies_stream') as cursor:
+                cursor.itersize = self.LOAD_ITERSIZE
+                # Obtener las películas con las columnas que usan las características
                 cursor.execute("""
                     SELECT 
                         m.id,
@@ -107,82 +245,241 @@ class EfficientKNNService:
                         m.vote_average,
                         m.vote_count,
                         m.release_date,
-                        m.popularity,
-                        m.overview,
-                        m.poster_path
+                        m.popularity
                     FROM movies m
                     WHERE m.vote_average IS NOT NULL
                     AND m.vote_count IS NOT NULL
                     ORDER BY m.vote_count DESC
                 """)
                 
-                movies = cursor.fetchall()
-                logger.info(f"✅ {len(movies)} películas cargadas desde la BD")
-                
-                # Convertir a DataFrame
-                self.movies_df = pd.DataFrame(movies)
-                
-                # Preparar características para KNN
-                self._prepare_features_from_db()
+                chunks = []
+                while True:
+                    rows = cursor.fetchmany(self.LOAD_ITERSIZE)
+                    if not rows:
+                        break
+                    chunks.append(self._movie_rows_to_columns(rows))
+            
+            columns = self._concat_movie_chunks(chunks)
+            self.genre_offsets = columns.pop('genre_offsets')
+            self.genre_values = columns.pop('genre_values')
+            logger.info(f"✅ {len(columns['id'])} películas cargadas desde la BD")
+            
+            # Convertir a DataFrame (columnas numpy ya tipadas, sin copiarlas); los géneros se quedan en CSR
+            self.movies_df = pd.DataFrame(columns, copy=False)
+            
+            # Preparar características para KNN
+            self._prepare_features_from_db()
                 
         except Exception as e:
             logger.error(f"❌ Error cargando películas desde BD: {e}")
             self.movies_df = None
     
+    @staticmethod
+    def _movie_rows_to_columns(rows: List[tuple]) -> Dict[str, np.ndarray]:
+        """Convertir un bloque de tuplas (id, title, genre_ids, vote_average, vote_count, release_date, popularity) en columnas tipadas"""
+        ids, titles, genre_ids, vote_averages, vote_counts, release_dates, popularities = zip(*rows)
+        genre_lengths = np.fromiter((len(g) if g else 0 for g in genre_ids), dtype=np.int64, count=len(rows))
+        return {
+            'id': np.fromiter(ids, dtype=np.int64, count=len(rows)),
+            'title': np.array(titles, dtype=object),
+            'vote_average': np.array(vote_averages, dtype=np.float64),  # Decimal/None -> float/NaN
+            'vote_count': np.array(vote_counts, dtype=np.float64),
+            'release_date': np.array(release_dates, dtype='datetime64[D]'),  # None -> NaT
+            'popularity': np.array(popularities, dtype=np.float64),
+            'genre_lengths': genre_lengths,
+            'genre_values': np.fromiter(
+                (genre for genres in genre_ids if genres for genre in genres),
+                dtype=np.int32, count=int(genre_lengths.sum())
+            )
+        }
+    
+    @staticmethod
+    def _concat_movie_chunks(chunks: List[Dict[str, np.ndarray]]) -> Dict[str, np.ndarray]:
+        """Unir los bloques del cursor en columnas finales (géneros como CSR offsets + valores)"""
+        names = ['id', 'title', 'vote_average', 'vote_count', 'release_date', 'popularity', 'genre_values']
+        empty = {'id': np.int64, 'title': object, 'vote_average': np.float64, 'vote_count': np.float64,
+                 'release_date': 'datetime64[D]', 'popularity': np.float64, 'genre_values': np.int32}
+        columns = {
+            name: np.concatenate([chunk[name] for chunk in chunks]) if chunks else np.empty(0, dtype=empty[name])
+            for name in names
+        }
+        genre_lengths = np.concatenate([chunk['genre_lengths'] for chunk in chunks]) if chunks \
+            else np.empty(0, dtype=np.int64)
+        columns['genre_offsets'] = np.zeros(len(genre_lengths) + 1, dtype=np.int64)
+        np.cumsum(genre_lengths, out=columns['genre_offsets'][1:])
+        columns['vote_count'] = columns['vote_count'].astype(np.int64)  # La consulta excluye NULLs
+        return columns
+    
     def _prepare_features_from_db(self):
         """Preparar características para el modelo KNN desde datos de BD"""
         if self.movies_df is None or len(self.movies_df) == 0:
             return
         
         logger.info("🔧 Preparando características desde datos de BD...")
+        self._report_progress('features')
+        self.feature_version = FEATURE_VERSION
         
-        # Calcular características adicionales
-        current_year = pd.Timestamp.now().year
-        
-        # Años desde el lanzamiento
-        self.movies_df['years_since_release'] = current_year - pd.to_datetime(
-            self.movies_df['release_date'], errors='coerce'
-        ).dt.year.fillna(current_year)
-        
-        # Diversidad de géneros (número de géneros únicos) - ROBUSTO Y LOG DE EJEMPLOS
-        def count_genres(genre_val):
-            try:
-                if pd.isna(genre_val) or genre_val is None:
-                    return 1
-                if isinstance(genre_val, str):
-                    return len([g.strip() for g in genre_val.split(',') if g.strip()])
-                if isinstance(genre_val, (list, tuple)):
-                    return len(genre_val)
-                if hasattr(genre_val, 'tolist'):
-                    # numpy array u objeto similar
-                    return len(genre_val.tolist())
-                # Si es un número o cualquier otro tipo
-                return 1
-            except Exception as e:
-                logger.warning(f"[KNN] Valor inesperado en genre_ids: {repr(genre_val)} - {e}")
-                return 1
-        
-        # Log de ejemplos de genre_ids
-        logger.info(f"Ejemplo de genre_ids: {self.movies_df['genre_ids'].head(5).tolist()}")
-        self.movies_df['genre_diversity'] = self.movies_df['genre_ids'].apply(count_genres)
+        # Los offsets CSR del load en streaming dan el número de géneros sin recorrer listas
+        genre_offsets = self.genre_offsets
+        if genre_offsets is not None and len(genre_offsets) != len(self.movies_df) + 1:
+            genre_offsets = None
+        self._add_derived_features(self.movies_df, genre_offsets)
         
         # Obtener estadísticas de usuarios para cada película
         self._add_user_statistics()
         
         # Rellenar valores faltantes
-        for col in self.feature_columns:
-            if col in self.movies_df.columns:
-                self.movies_df[col] = self.movies_df[col].fillna(self.movies_df[col].median())
+        self._impute_feature_medians(self.movies_df)
+        
+        # Títulos al buffer internado y columnas numéricas a float32/int32
+        self.movies_df = self._compact_catalog(self.movies_df)
         
         logger.info("✅ Características preparadas desde BD")
     
+    def _compact_catalog(self, movies_df: pd.DataFrame) -> pd.DataFrame:
+        """Catálogo en forma compacta para entrenar, servir y guardar (ver knn_catalog.py)"""
+        return knn_catalog.compact_catalog(self, movies_df)
+    
+    def _titles(self, positions) -> List[str]:
+        """Títulos de un lote de filas, decodificados del buffer internado"""
+        if self.title_offsets is None:
+            return [''] * len(positions)
+        return decode_strings(self.title_bytes, self.title_offsets, positions)
+    
+    def _catalog_column(self, column: str) -> np.ndarray:
+        """Columna del catálogo como array (SegmentedArray si hay altas)"""
+        return knn_catalog.catalog_column(self, column)
+    
+    def catalog_frame(self) -> Optional[pd.DataFrame]:
+        """Catálogo completo (base + altas) como DataFrame; con altas es una copia"""
+        return knn_catalog.catalog_frame(self)
+    
+    def _display_column(self, column: str, positions: np.ndarray) -> np.ndarray:
+        """Columna del catálogo redondeada a sus decimales de origen"""
+        return knn_catalog.display_column(self, column, positions)
+    
+    def _add_derived_features(self, movies_df: pd.DataFrame, genre_offsets: np.ndarray = None) -> pd.DataFrame:
+        """
+        Calcular años desde el lanzamiento y diversidad de géneros de forma vectorizada
+        (entrenamiento y altas incrementales).
+        
+        El año sale de un array datetime64 sin pasar por objetos fecha, y el número de
+        géneros de los offsets CSR del cargador (o de un kernel de longitudes si no los hay).
+        """
+        current_year = pd.Timestamp.now().year
+        
+        # Años desde el lanzamiento (fechas desconocidas -> 0, como fillna(current_year))
+        release_dates = movies_df['release_date']
+        if not pd.api.types.is_datetime64_any_dtype(release_dates):
+            release_dates = pd.to_datetime(release_dates, errors='coerce')
+        release_dates = release_dates.to_numpy(dtype='datetime64[ns]')
+        release_years = release_dates.astype('datetime64[Y]').astype(np.int64) + 1970
+        movies_df['years_since_release'] = np.where(
+            np.isnat(release_dates), 0, current_year - release_years
+        ).astype(np.float64)
+        
+        # Diversidad de géneros: número de géneros, 1 si la película no tiene ninguno
+        if self.feature_version < 2:
+            movies_df['genre_diversity'] = 1
+        else:
+            if genre_offsets is not None:
+                genre_counts = np.diff(genre_offsets)
+            else:
+                genre_counts = self._genre_lengths(movies_df['genre_ids'])
+            movies_df['genre_diversity'] = np.maximum(genre_counts, 1)
+        return movies_df
+    
+    @staticmethod
+    def _genre_lengths(genre_column) -> np.ndarray:
+        """Número de géneros por película para listas/arrays de PostgreSQL o strings 'a,b,c'"""
+        def genre_length(genres) -> int:
+            if isinstance(genres, (list, tuple, np.ndarray)):
+                return len(genres)
+            if isinstance(genres, str):
+                return sum(1 for genre in genres.split(',') if genre.strip())
+            return 0
+        return np.fromiter(map(genre_length, genre_column), dtype=np.int64, count=len(genre_column))
+    
+    def _impute_feature_medians(self, movies_df: pd.DataFrame):
+        """Rellenar los huecos de todas las columnas de características con su mediana en una sola pasada"""
+        columns = [col for col in self.feature_columns if col in movies_df.columns]
+        if not columns:
+            return
+        features = movies_df[columns].to_numpy(dtype=np.float64)
+        missing = np.isnan(features)
+        if missing.any():
+            medians = np.nanmedian(np.where(missing.all(axis=0), 0.0, features), axis=0)
+            rows, cols = np.nonzero(missing)
+            features[rows, cols] = medians[cols]
+            movies_df[columns] = features
+    
     def _add_user_statistics(self):
         """Agregar estadísticas de usuarios para cada película"""
-        if not self.db_connection:
+        if not self.db_pool:
             return
         
         try:
-            with self.db_connection.cursor(cursor_factory=RealDictCursor) as cursor:
+            user_stats_df = self._load_user_statistics()
+            
+            if len(user_stats_df) > 0:
+                # Merge con películas
+                self.movies_df = self.movies_df.merge(
+                    user_stats_df, 
+                    left_on='id', 
+                    right_on='movie_id', 
+                    how='left'
+                )
+                # Forzar conversión de tipos para evitar errores con Decimals (NaN = película sin valoraciones)
+                self.movies_df['avg_user_rating'] = self.movies_df['avg_user_rating'].astype(float).fillna(5.0)
+                self.movies_df['user_rating_count'] = self.movies_df['user_rating_count'].fillna(0).astype(int)
+                
+                logger.info(f"✅ Estadísticas de usuarios agregadas para {len(user_stats_df)} películas")
+            else:
+                # Si no hay estadísticas, crear columnas por defecto
+                self.movies_df['avg_user_rating'] = 5.0
+                self.movies_df['user_rating_count'] = 0
+                logger.warning("⚠️ No hay estadísticas de usuarios disponibles")
+                    
+        except Exception as e:
+            logger.error(f"❌ Error agregando estadísticas de usuarios: {e}")
+            # Crear columnas por defecto
+            self.movies_df['avg_user_rating'] = 5.0
+            self.movies_df['user_rating_count'] = 0
+    
+    def _user_stats_path(self) -> str:
+        """Acumulador de estadísticas: KNN_USER_STATS_PATH, o junto al artefacto del modelo (no al CWD)"""
+        if self.USER_STATS_PATH:
+            return self.USER_STATS_PATH
+        model_path = self.model_path or self.default_model_path()
+        return os.path.join(os.path.dirname(os.path.abspath(model_path)), 'knn_user_stats.npz')
+    
+    def _load_user_statistics(self) -> pd.DataFrame:
+        """
+        Estadísticas por película desde el acumulador incremental (knn_user_stats.py).
+        
+        La primera vez (o con KNN_USER_STATS_FULL_REFRESH) se agrega user_movies completo;
+        después solo se leen los eventos de valoración posteriores a la marca de agua.
+        """
+        stats_path = self._user_stats_path()
+        accumulator = None if self.USER_STATS_FULL_REFRESH \
+            else UserStatsAccumulator.load(stats_path, self.USER_STATS_LAG_SECONDS)
+        with self.db_pool.connection() as conn:
+            try:
+                if accumulator is None:
+                    accumulator = UserStatsAccumulator(stats_path, self.USER_STATS_LAG_SECONDS)
+                    accumulator.bootstrap(conn)
+                else:
+                    changed = accumulator.refresh(conn)
+                    logger.info(f"🔄 Estadísticas de usuarios: {changed} películas con valoraciones nuevas "
+                                f"(marca de agua {accumulator.watermark})")
+                accumulator.save()
+                return accumulator.to_frame()
+            except psycopg2.Error as e:
+                # Sin tabla de eventos (BD sin database/migrate_user_movie_rating_events.sql): GROUP BY completo
+                conn.rollback()
+                logger.warning(f"⚠️ Estadísticas incrementales no disponibles, agregando user_movies completo: {e}")
+            
+            with conn.cursor(cursor_factory=RealDictCursor) as cursor:
                 # Obtener estadísticas de usuarios por película
                 cursor.execute("""
                     SELECT 
@@ -193,34 +490,7 @@ class EfficientKNNService:
                     WHERE rating IS NOT NULL
                     GROUP BY movie_id
                 """)
-                
-                user_stats = cursor.fetchall()
-                user_stats_df = pd.DataFrame(user_stats)
-                
-                if len(user_stats_df) > 0:
-                    # Merge con películas
-                    self.movies_df = self.movies_df.merge(
-                        user_stats_df, 
-                        left_on='id', 
-                        right_on='movie_id', 
-                        how='left'
-                    )
-                    # Forzar conversión de tipos para evitar errores con Decimals
-                    self.movies_df['avg_user_rating'] = self.movies_df['avg_user_rating'].astype(float).fillna(5.0)
-                    self.movies_df['user_rating_count'] = self.movies_df['user_rating_count'].astype(int).fillna(0)
-                    
-                    logger.info(f"✅ Estadísticas de usuarios agregadas para {len(user_stats_df)} películas")
-                else:
-                    # Si no hay estadísticas, crear columnas por defecto
-                    self.movies_df['avg_user_rating'] = 5.0
-                    self.movies_df['user_rating_count'] = 0
-                    logger.warning("⚠️ No hay estadísticas de usuarios disponibles")
-                    
-        except Exception as e:
-            logger.error(f"❌ Error agregando estadísticas de usuarios: {e}")
-            # Crear columnas por defecto
-            self.movies_df['avg_user_rating'] = 5.0
-            self.movies_df['user_rating_count'] = 0
+                return pd.DataFrame(cursor.fetchall())
     
     def train_knn_model(self):
         """Entrenar modelo KNN con los datos de la base de datos"""
@@ -236,10 +506,16 @@ class EfficientKNNService:
                 logger.warning(f"⚠️ Pocas características disponibles: {available_features}")
                 return
             
-            # Preparar datos para entrenamiento
-            X = self.movies_df[available_features].values
+            # Preparar datos para entrenamiento (filas posicionales alineadas con el índice de ids)
+            self.movies_df = self.catalog_frame().reset_index(drop=True)
+            self._catalog_tail = None
+            self.tombstoned = None
+            self.similar_cache.clear()  # Mismo model_version, vecinos nuevos
+            self._build_id_index()
+            X = self.movies_df[available_features].to_numpy(dtype=np.float64)
             
             # Escalar características
+            self._report_progress('fit')
             X_scaled = self.scaler.fit_transform(X)
             
             # Entrenar modelo KNN
@@ -249,49 +525,363 @@ class EfficientKNNService:
                 metric='cosine'
             )
             self.knn_model.fit(X_scaled)
+            self.feature_matrix = X_scaled
+            self._build_search_engine()
+            if self.uses_ann_index(len(X_scaled)):
+                self.build_ann_index()
             
             logger.info(f"✅ Modelo KNN entrenado con {len(available_features)} características")
             logger.info(f"📊 Datos de entrenamiento: {len(X_scaled)} películas")
             
+            # Precalcular la tabla de vecinos para responder /similar con un slice
+            self._build_neighbor_table()
+            
         except Exception as e:
             logger.error(f"❌ Error entrenando modelo KNN: {e}")
             self.knn_model = None
     
+    def _build_neighbor_table(self):
+        """
+        Construir la tabla densa de vecinos (n_movies, K_max) por bloques de filas.
+        
+        Cada bloque consulta K_max + 1 vecinos y descarta la propia película, de modo que
+        la memoria temporal queda acotada por NEIGHBOR_TABLE_CHUNK_SIZE y no por el catálogo.
+        """
+        if self.search_engine is None:
+            return
+        
+        n_movies = len(self.feature_matrix)
+        k_max = min(self.NEIGHBOR_TABLE_K, n_movies - 1)
+        if k_max < 1:
+            logger.warning("⚠️ Catálogo demasiado pequeño para la tabla de vecinos")
+            return
+        
+        self._report_progress('neighbor_table')
+        chunk_size = max(1, self.NEIGHBOR_TABLE_CHUNK_SIZE)
+        neighbor_indices = np.empty((n_movies, k_max), dtype=np.int32)
+        neighbor_similarities = np.empty((n_movies, k_max), dtype=np.float32)
+        
+        for start in range(0, n_movies, chunk_size):
+            stop = min(start + chunk_size, n_movies)
+            distances, indices = self._query_engine().kneighbors(
+                self.feature_matrix[start:stop], n_neighbors=k_max + 1
+            )
+            rows = np.arange(start, stop)
+            
+            # Quitar la propia película; si no aparece (empates), quitar el último vecino
+            keep = indices != rows[:, None]
+            keep[keep.all(axis=1), -1] = False
+            
+            neighbor_indices[start:stop] = indices[keep].reshape(len(rows), k_max)
+            neighbor_similarities[start:stop] = 1.0 / (1.0 + distances[keep].reshape(len(rows), k_max))
+        
+        self._publish_neighbor_table(neighbor_indices, neighbor_similarities)
+        logger.info(f"✅ Tabla de vecinos construida: {n_movies} películas x {k_max} vecinos")
+    
+    def _build_search_engine(self):
+        """Seleccionar el motor de consulta configurado en KNN_ENGINE"""
+        if self.feature_matrix is None:
+            self.search_engine = None
+        elif self.KNN_ENGINE == 'sklearn':
+            if self.knn_model is None:
+                # Los artefactos sin pickle no guardan el estimador: ajustarlo es solo guardar los datos
+                self.knn_model = NearestNeighbors(algorithm='auto', metric='cosine').fit(self.feature_matrix)
+            self.search_engine = self.knn_model
+        else:
+            self.search_engine = ExactCosineEngine(self.feature_matrix, query_buffer_bytes=self.ENGINE_QUERY_BUFFER_BYTES)
+        logger.info(f"🔎 Motor de búsqueda KNN: {self.KNN_ENGINE}")
+    
+    def build_ann_index(self, recall_queries: int = 200):
+        """Construir el índice LSH y medir su recall@K contra la búsqueda exacta"""
+        if self.feature_matrix is None:
+            logger.warning("⚠️ No hay matriz de características para construir el índice aproximado")
+            return
+        
+        self.ann_index = RandomProjectionLSHIndex(
+            self.feature_matrix,
+            n_tables=self.ANN_TABLES,
+            n_bits=self.ANN_BITS,
+            n_probes=self.ANN_PROBES
+        )
+        
+        exact_engine = self.search_engine if isinstance(self.search_engine, ExactCosineEngine) \
+            else ExactCosineEngine(self.feature_matrix, query_buffer_bytes=self.ENGINE_QUERY_BUFFER_BYTES)
+        rng = np.random.default_rng(42)
+        query_rows = rng.choice(len(self.feature_matrix), size=min(recall_queries, len(self.feature_matrix)), replace=False)
+        k = min(self.NEIGHBOR_TABLE_K, len(self.feature_matrix))
+        self.ann_report = recall_at_k(self.ann_index, exact_engine, self.feature_matrix[query_rows], k)
+        self.ann_report.update({
+            'total_movies': len(self.feature_matrix),
+            'n_tables': self.ANN_TABLES,
+            'n_bits': self.ANN_BITS,
+            'n_probes': self.ANN_PROBES,
+            'active': self.uses_ann_index(len(self.feature_matrix))
+        })
+        logger.info(f"✅ Índice aproximado construido - recall@{k}: {self.ann_report['recall_at_k']:.4f} "
+                    f"({self.ann_report['approximate_ms_per_query']} ms vs {self.ann_report['exact_ms_per_query']} ms exacto)")
+    
+    def uses_ann_index(self, n_movies: int) -> bool:
+        """Si un catálogo de n_movies usa el índice aproximado: KNN_ENGINE=ann o n_movies >= ANN_THRESHOLD"""
+        return self.KNN_ENGINE == 'ann' or n_movies >= self.ANN_THRESHOLD
+    
+    def _query_engine(self):
+        """Índice aproximado si el catálogo supera ANN_THRESHOLD (o KNN_ENGINE=ann), si no el motor exacto configurado"""
+        if self.ann_index is not None and self.uses_ann_index(len(self.ann_index)):
+            return self.ann_index
+        return self.search_engine
+    
+    @staticmethod
+    def _ann_index_paths(model_path: str) -> Tuple[str, str]:
+        """Rutas del índice aproximado y su reporte de recall, junto a knn_model.pkl"""
+        model_dir = os.path.dirname(os.path.abspath(model_path))
+        return os.path.join(model_dir, 'knn_ann_index.npz'), os.path.join(model_dir, 'knn_ann_report.json')
+    
+    def _build_id_index(self, movie_ids: np.ndarray = None):
+        """Construir el índice id -> posición a partir de los ids guardados o de movies_df"""
+        if movie_ids is None:
+            if self.movies_df is None:
+                return
+            movie_ids = self.movies_df['id'].to_numpy()
+        
+        self.movie_ids = np.asarray(movie_ids, dtype=np.int64)
+        # Las filas borradas siguen en las matrices hasta compactar, pero no se resuelven por id
+        live_positions = np.arange(len(self.movie_ids))
+        self.n_tombstoned = 0
+        if self.tombstoned is not None:
+            live_positions = live_positions[~self.tombstoned[:len(self.movie_ids)]]
+            self.n_tombstoned = len(self.movie_ids) - len(live_positions)
+        live_ids = self.movie_ids[live_positions]
+        sorted_order = np.argsort(live_ids, kind='stable')
+        self._id_index = (
+            live_ids[sorted_order], live_positions[sorted_order],
+            dict(zip(live_ids.tolist(), live_positions.tolist()))
+        )
+        self._id_delta = None
+    
+    def _lookup_position(self, movie_id: int) -> Optional[int]:
+        """Posición de fila de una película, o None si no está en el catálogo"""
+        if self._id_delta is None:
+            return self.id_to_position.get(int(movie_id))
+        position = int(self.lookup_positions([movie_id])[0])
+        return position if position >= 0 else None
+    
+    @staticmethod
+    def _search_ids(sorted_ids: np.ndarray, sorted_positions: np.ndarray, movie_ids: np.ndarray) -> np.ndarray:
+        """Posiciones de movie_ids en un índice ordenado; -1 si no están"""
+        if len(sorted_ids) == 0:
+            return np.full(len(movie_ids), -1, dtype=np.int64)
+        slots = np.minimum(np.searchsorted(sorted_ids, movie_ids), len(sorted_ids) - 1)
+        return np.where(sorted_ids[slots] == movie_ids, sorted_positions[slots], -1)
+    
+    def lookup_positions(self, movie_ids) -> np.ndarray:
+        """Posiciones de fila para un lote de ids (vectorizado); -1 para ids desconocidos"""
+        movie_ids = np.asarray(movie_ids, dtype=np.int64).ravel()
+        id_index, id_delta = self._id_index, self._id_delta
+        if id_index is None or len(movie_ids) == 0:
+            return np.full(len(movie_ids), -1, dtype=np.int64)
+        
+        positions = self._search_ids(id_index[0], id_index[1], movie_ids)
+        if id_delta is not None:
+            # Filas base borradas después de construir el índice; las altas ganan a la base
+            found = np.flatnonzero(positions >= 0)
+            positions[found[self.tombstoned[positions[found]]]] = -1
+            delta_positions = self._search_ids(id_delta[0], id_delta[1], movie_ids)
+            positions = np.where(delta_positions >= 0, delta_positions, positions)
+        return positions
+    
+    @timed_stage('hydrate_movies')
+    def _hydrate_movies(self, positions, similarities, scores: np.ndarray = None) -> List[Dict]:
+        """
+        Construir los dicts de respuesta para un lote de posiciones en una sola pasada.
+        Con scores, las filas cuyo score no es NaN llevan además 'score'.
+        """
+        positions = np.asarray(positions, dtype=np.int64)
+        ids = self.movie_ids[positions].tolist()
+        titles = self._titles(positions)
+        vote_averages = self._display_column('vote_average', positions).tolist()
+        popularities = self._display_column('popularity', positions).tolist()
+        similarities = np.asarray(similarities, dtype=float).tolist()
+        
+        movies = [
+            {
+                'movie_id': movie_id,
+                'title': title,
+                'similarity': similarity,
+                'vote_average': vote_average,
+                'popularity': popularity
+            }
+            for movie_id, title, similarity, vote_average, popularity
+            in zip(ids, titles, similarities, vote_averages, popularities)
+        ]
+        if scores is not None:
+            scores = np.asarray(scores, dtype=float)
+            for movie, score, has_score in zip(movies, scores.tolist(), (~np.isnan(scores)).tolist()):
+                if has_score:
+                    movie['score'] = score
+        return movies
+    
+    def _materialize_recommendations(self, batch: RecommendationBatch) -> List[Dict]:
+        """Dicts de respuesta de un lote de recomendaciones (una sola hidratación)"""
+        return self._hydrate_movies(batch.positions, batch.similarities, batch.scores)
+    
+    def _live_mask(self) -> Optional[np.ndarray]:
+        """Máscara de filas vivas, o None si no hay tombstones"""
+        if self.tombstoned is None or self.n_tombstoned == 0:
+            return None
+        return ~np.asarray(self.tombstoned)
+    
+    def _query_live_neighbors(self, queries: np.ndarray, k: int,
+                              exclude_rows: np.ndarray = None) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Vecinos de un lote de consultas ignorando las filas borradas (y la propia fila si se indica).
+        
+        Se piden k + 1 + n_borradas vecinos para que siempre queden k válidos; si el catálogo
+        vivo es más pequeño, las posiciones sobrantes se rellenan con -1 y similitud 0.
+        """
+        queries = np.atleast_2d(queries)
+        n_dead = self.n_tombstoned
+        n_fetch = min(k + 1 + n_dead, len(self.feature_matrix))
+        with stage('neighbor_engine_query'):
+            distances, indices = self._query_engine().kneighbors(queries, n_neighbors=n_fetch)
+        
+        valid = np.ones(indices.shape, dtype=bool)
+        if n_dead:
+            valid &= ~self.tombstoned[indices]
+        if exclude_rows is not None:
+            valid &= indices != np.asarray(exclude_rows)[:, None]
+        
+        # Válidos primero conservando el orden por distancia, y quedarse con k
+        order = np.argsort(~valid, axis=1, kind='stable')[:, :k]
+        valid = np.take_along_axis(valid, order, axis=1)
+        neighbor_indices = np.where(valid, np.take_along_axis(indices, order, axis=1), -1)
+        neighbor_similarities = np.where(valid, 1.0 / (1.0 + np.take_along_axis(distances, order, axis=1)), 0.0)
+        if neighbor_indices.shape[1] < k:
+            padding = k - neighbor_indices.shape[1]
+            neighbor_indices = np.pad(neighbor_indices, ((0, 0), (0, padding)), constant_values=-1)
+            neighbor_similarities = np.pad(neighbor_similarities, ((0, 0), (0, padding)))
+        return neighbor_indices.astype(np.int32), neighbor_similarities.astype(np.float32)
+    
+    def upsert_movies(self, movies: List[Dict]) -> Dict:
+        """Alta o modificación incremental de películas sin reentrenar (ver knn_catalog_updates.py)"""
+        return catalog_updates.upsert_movies(self, movies)
+    
+    def delete_movies(self, movie_ids: List[int]) -> Dict:
+        """Marcar películas como borradas hasta la próxima compactación (ver knn_catalog_updates.py)"""
+        return catalog_updates.delete_movies(self, movie_ids)
+    
+    def sync_deleted_movies(self) -> Dict:
+        """Aplicar como tombstones las películas registradas en la tabla deleted_movies"""
+        if not self.db_pool:
+            logger.warning("⚠️ Sin conexión a BD para sincronizar películas borradas")
+            return {'deleted': 0}
+        
+        try:
+            with self.db_pool.connection() as conn, conn.cursor() as cursor:
+                cursor.execute("SELECT id FROM deleted_movies")
+                deleted_ids = [row[0] for row in cursor.fetchall()]
+        except Exception as e:
+            logger.error(f"❌ Error leyendo deleted_movies: {e}")
+            return {'deleted': 0}
+        
+        return self.delete_movies(deleted_ids)
+    
+    def catch_up_catalog_log(self) -> Optional[int]:
+        """Aplicar las entradas del log escritas después de que este servicio lo leyera (None sin log)"""
+        return catalog_updates.catch_up_catalog_log(self)
+    
+    def compacted_copy(self) -> 'EfficientKNNService':
+        """Servicio nuevo reentrenado solo con las filas vivas; este servicio no cambia"""
+        return catalog_updates.compacted_copy(self)
+    
+    @property
+    def delta_rows(self) -> int:
+        """Filas pendientes de compactar: altas más filas de la tabla de vecinos parcheadas"""
+        table = self._neighbor_table
+        array = table[0] if table is not None else self.movie_ids
+        return array.delta_rows if isinstance(array, SegmentedArray) else 0
+    
+    @property
+    def catalog_log_offset(self) -> int:
+        """Bytes del log del catálogo ya aplicados; comparables entre procesos que comparten el artefacto"""
+        return self._catalog_log_offset
+    
     def save_knn_model(self, model_path: str):
-        """Guardar modelo KNN entrenado"""
-        if self.knn_model is None:
+        """
+        Guardar modelo KNN entrenado.
+        
+        Rutas terminadas en .pkl usan el formato joblib heredado; cualquier otra ruta
+        se guarda como directorio de artefacto sin pickle (ver knn_artifact.py).
+        """
+        if not self.is_model_loaded():
             logger.warning("⚠️ No hay modelo KNN para guardar")
             return
         
+        self._report_progress('save')
+        if not model_path.endswith('.pkl'):
+            try:
+                self.model_version = save_knn_artifact(self, model_path)
+                self.model_path = model_path
+            except Exception as e:
+                logger.error(f"❌ Error guardando artefacto KNN: {e}")
+            return
+        
         try:
             model_data = {
                 'knn_model': self.knn_model,
                 'scaler': self.scaler,
                 'feature_columns': self.feature_columns,
-                'movies_df': self.movies_df,
-                'db_connected': self.db_connection is not None
+                'movies_df': self.catalog_frame(),
+                'title_bytes': materialize(self.title_bytes),
+                'title_offsets': materialize(self.title_offsets),
+                'genre_offsets': materialize(self.genre_offsets),
+                'genre_values': materialize(self.genre_values),
+                'feature_matrix': materialize(self.feature_matrix),
+                'neighbor_indices': materialize(self.neighbor_indices),
+                'neighbor_similarities': materialize(self.neighbor_similarities),
+                'movie_ids': materialize(self.movie_ids),
+                'tombstoned': materialize(self.tombstoned),
+                'db_connected': self.db_pool is not None,
+                'feature_version': self.feature_version,
+                'catalog_snapshot_at': self.catalog_snapshot_at
             }
-            joblib.dump(model_data, model_path)
+            # Escritura atómica: un lector nunca abre un .pkl a medio escribir
+            tmp_path = f"{model_path}.tmp-{os.getpid()}"
+            joblib.dump(model_data, tmp_path)
+            os.replace(tmp_path, model_path)
             logger.info(f"✅ Modelo KNN guardado en {model_path}")
             
+            if self.ann_index is not None:
+                ann_path, report_path = self._ann_index_paths(model_path)
+                self.ann_index.save(ann_path)
+                with open(report_path, 'w') as f:
+                    json.dump(self.ann_report, f, indent=2)
+                logger.info(f"✅ Índice aproximado guardado en {ann_path}")
+            
         except Exception as e:
             logger.error(f"❌ Error guardando modelo KNN: {e}")
     
     def load_knn_model(self, model_path: str):
-        """Cargar modelo KNN guardado"""
+        """Cargar modelo KNN guardado (directorio de artefacto memory-mapped o .pkl heredado)"""
         try:
-            model_data = joblib.load(model_path)
-            self.knn_model = model_data['knn_model']
-            self.scaler = model_data['scaler']
-            self.feature_columns = model_data['feature_columns']
-            self.movies_df = model_data['movies_df']
+            if is_artifact_dir(model_path):
+                manifest = load_knn_artifact(self, model_path, mmap=self.MMAP_ARTIFACTS)
+                self.model_version = manifest['version']
+            else:
+                self._load_pickle_model(model_path)
+                self.model_version = f"pkl-{int(os.path.getmtime(model_path))}"
+            self.model_path = model_path
+            self.base_model_version = self.model_version
+            if self.feature_version < FEATURE_VERSION:
+                logger.warning(f"⚠️ Modelo con características v{self.feature_version}: las altas incrementales "
+                               f"se codifican igual; reentrena para usar la versión {FEATURE_VERSION}")
+            catalog_updates.replay_catalog_log(self, model_path)
             
             logger.info(f"✅ Modelo KNN cargado desde {model_path}")
-            logger.info(f"📊 Datos de películas cargados: {len(self.movies_df) if self.movies_df is not None else 0} películas")
+            logger.info(f"📊 Datos de películas cargados: {len(self.movie_ids) if self.movie_ids is not None else 0} películas")
             
             # No reconectar automáticamente a BD en producción
             # Solo conectar si es explícitamente necesario para desarrollo
-            if os.getenv('ENVIRONMENT') == 'development' and not self.db_connection:
+            if os.getenv('ENVIRONMENT') == 'development' and not self.db_pool:
                 logger.info("🔄 Reconectando a la base de datos para desarrollo...")
                 self.connect_database()
             
@@ -305,39 +895,86 @@ class EfficientKNNService:
             else:
                 logger.warning("⚠️ Modelo KNN no disponible en producción")
     
+    def _load_pickle_model(self, model_path: str):
+        """Cargar el formato joblib heredado (knn_model.pkl)"""
+        model_data = joblib.load(model_path)
+        self.knn_model = model_data['knn_model']
+        self.scaler = model_data['scaler']
+        self.feature_columns = model_data['feature_columns']
+        self.feature_version = model_data.get('feature_version', 1)
+        self.catalog_snapshot_at = model_data.get('catalog_snapshot_at')
+        self.title_bytes = model_data.get('title_bytes')
+        self.title_offsets = model_data.get('title_offsets')
+        self.genre_offsets = model_data.get('genre_offsets')
+        self.genre_values = model_data.get('genre_values')
+        # Pickles antiguos traen title/genre_ids/overview/poster_path como columnas: se compactan aquí
+        self.movies_df = self._compact_catalog(model_data['movies_df'])
+        self.feature_matrix = model_data.get('feature_matrix')
+        self._publish_neighbor_table(model_data.get('neighbor_indices'), model_data.get('neighbor_similarities'))
+        self.tombstoned = model_data.get('tombstoned')
+        self._build_id_index(model_data.get('movie_ids'))
+        
+        # Modelos guardados antes de la tabla de vecinos: reconstruirla al cargar
+        if self.feature_matrix is None and self.movies_df is not None:
+            self.feature_matrix = self.scaler.transform(self.movies_df[self.feature_columns].values)
+        self._build_search_engine()
+        ann_path, report_path = self._ann_index_paths(model_path)
+        if os.path.exists(ann_path):
+            self.ann_index = RandomProjectionLSHIndex.load(ann_path, self.feature_matrix)
+            if os.path.exists(report_path):
+                with open(report_path) as f:
+                    self.ann_report = json.load(f)
+        if self.neighbor_indices is None:
+            self._build_neighbor_table()
+    
     def find_similar_movies(self, movie_id: int, top_k: int = 3) -> List[Dict]:
-        """Encontrar películas similares usando KNN"""
-        if self.knn_model is None or self.movies_df is None:
+        """Encontrar películas similares usando la tabla de vecinos precalculada"""
+        if not self.is_model_loaded():
+            logger.warning("⚠️ Modelo KNN no disponible")
+            return []
+        
+        cached = self.similar_cache.get((int(movie_id), top_k), self.similar_cache_generation())
+        if cached is not None:
+            return cached
+        return self.compute_similar_movies(movie_id, top_k)
+
+    def compute_similar_movies(self, movie_id: int, top_k: int = 3) -> List[Dict]:
+        """find_similar_movies sin consultar la caché (sí guarda el resultado en ella)"""
+        if not self.is_model_loaded():
             logger.warning("⚠️ Modelo KNN no disponible")
             return []
+        if top_k <= 0:
+            return []  # Un slice [:0] o [:-n] de la tabla devolvería vecinos
         
+        # Generación leída antes que los arrays del modelo: si un alta/baja llega mientras se
+        # calcula, el resultado se guarda con la generación vieja y la caché lo descarta
+        generation = self.similar_cache_generation()
         try:
             # Encontrar la película en el dataset
-            movie_idx = self.movies_df[self.movies_df['id'] == movie_id].index
-            if len(movie_idx) == 0:
+            movie_idx = self._lookup_position(movie_id)
+            if movie_idx is None:
                 logger.warning(f"⚠️ Película {movie_id} no encontrada en el dataset")
                 return []
             
-            movie_idx = movie_idx[0]
-            
-            # Obtener características de la película
-            movie_features = self.movies_df[self.feature_columns].iloc[movie_idx:movie_idx+1]
+            table = self._neighbor_table
+            if table is not None and top_k <= table[0].shape[1]:
+                # Caso común: slice O(1) sobre la tabla precalculada
+                with stage('neighbor_table_lookup'):
+                    indices = table[0][movie_idx, :top_k]
+                    similarities = table[1][movie_idx, :top_k]
+            else:
+                # top_k mayor que K_max: consulta directa al índice
+                indices, similarities = self._query_live_neighbors(
+                    self.feature_matrix[movie_idx:movie_idx+1], top_k, exclude_rows=np.array([movie_idx])
+                )
+                indices, similarities = indices[0], similarities[0]
             
-            # Encontrar vecinos más cercanos
-            distances, indices = self.knn_model.kneighbors(movie_features)
+            # Huecos (-1) si el catálogo vivo tiene menos de top_k películas
+            valid = indices >= 0
+            indices, similarities = indices[valid], similarities[valid]
             
-            # Obtener películas similares (excluyendo la película original)
-            similar_movies = []
-            for i, (distance, idx) in enumerate(zip(distances[0], indices[0])):
-                if idx != movie_idx and i < top_k:
-                    movie_data = self.movies_df.iloc[idx]
-                    similar_movies.append({
-                        'movie_id': int(movie_data['id']),
-                        'title': movie_data['title'],
-                        'similarity': 1.0 / (1.0 + distance),  # Convertir distancia a similitud
-                        'vote_average': float(movie_data['vote_average']),
-                        'popularity': float(movie_data['popularity'])
-                    })
+            similar_movies = self._hydrate_movies(indices, similarities)
+            self.similar_cache.put((int(movie_id), top_k), similar_movies, generation)
             
             logger.info(f"✅ {len(similar_movies)} películas similares encontradas para {movie_id}")
             return similar_movies
@@ -346,69 +983,203 @@ class EfficientKNNService:
             logger.error(f"❌ Error encontrando películas similares: {e}")
             return []
 
-    def get_user_recommendations(self, user_id: int = None, limit: int = 10, user_watched_movies: list = None) -> list:
-        """Obtener recomendaciones KNN para un usuario específico o una lista de películas vistas"""
-        if self.knn_model is None or self.movies_df is None:
+    def find_similar_movies_batch(self, requests: List[Tuple[int, int]]) -> List[List[Dict]]:
+        """
+        find_similar_movies para varias peticiones (movie_id, top_k) a la vez (micro-batching
+        de /similar): una sola lectura de la tabla de vecinos y una sola hidratación para todas.
+        """
+        if not self.is_model_loaded():
+            logger.warning("⚠️ Modelo KNN no disponible")
+            return [[] for _ in requests]
+        
+        generation = self.similar_cache_generation()  # Antes de leer el modelo (ver compute_similar_movies)
+        results: List[Optional[List[Dict]]] = [None] * len(requests)
+        positions = self.lookup_positions([movie_id for movie_id, _ in requests])
+        top_ks = np.array([top_k for _, top_k in requests], dtype=np.int64)
+        table = self._neighbor_table
+        table_k = table[0].shape[1] if table is not None else 0
+        batched = np.flatnonzero((positions >= 0) & (top_ks <= table_k) & (top_ks > 0))
+        
+        if len(batched) > 0:
+            max_k = int(top_ks[batched].max())
+            with stage('neighbor_table_lookup'):
+                indices = table[0][positions[batched], :max_k]
+                similarities = table[1][positions[batched], :max_k]
+            valid = (indices >= 0) & (np.arange(max_k) < top_ks[batched][:, None])
+            movies = self._hydrate_movies(indices[valid], similarities[valid])
+            
+            start = 0
+            for request_index, count in zip(batched.tolist(), valid.sum(axis=1).tolist()):
+                results[request_index] = movies[start:start + count]
+                start += count
+                movie_id, top_k = requests[request_index]
+                self.similar_cache.put((int(movie_id), top_k), results[request_index], generation)
+            logger.info(f"✅ Lote de similares: {len(batched)} películas")
+        
+        # Películas desconocidas o top_k mayor que la tabla: ruta individual
+        for request_index, result in enumerate(results):
+            if result is None:
+                movie_id, top_k = requests[request_index]
+                results[request_index] = self.compute_similar_movies(movie_id, top_k)
+        return results
+
+    def similar_movies_bulk(self, movie_ids: List[int], top_ks: List[int]) -> Dict:
+        """
+        Vecinos de muchas películas en una respuesta compacta indexada por id (/similar/batch).
+        
+        Una sola lectura de la tabla de vecinos para los top_k que caben en ella y una sola
+        consulta al motor para los que no. Los datos de cada vecino se envían una vez en
+        'movies' aunque aparezca en varias listas.
+        """
+        movie_ids = np.asarray(movie_ids, dtype=np.int64)
+        top_ks = np.asarray(top_ks, dtype=np.int64)
+        if not self.is_model_loaded() or len(movie_ids) == 0:
+            return {'results': {}, 'movies': {}, 'not_found': movie_ids.tolist()}
+        
+        positions = self.lookup_positions(movie_ids)
+        found = np.flatnonzero(positions >= 0)
+        max_k = int(top_ks[found].max()) if len(found) else 0
+        indices = np.full((len(found), max_k), -1, dtype=np.int64)
+        similarities = np.zeros((len(found), max_k), dtype=np.float64)
+        
+        table = self._neighbor_table
+        table_k = table[0].shape[1] if table is not None else 0
+        from_table = top_ks[found] <= table_k
+        if from_table.any():
+            rows = positions[found[from_table]]
+            width = min(max_k, table_k)
+            with stage('neighbor_table_lookup'):
+                indices[from_table, :width] = table[0][rows, :width]
+                similarities[from_table, :width] = table[1][rows, :width]
+        if (~from_table).any():
+            # top_k mayor que la tabla: una consulta conjunta al motor excluyendo la propia fila
+            rows = positions[found[~from_table]]
+            engine_indices, engine_similarities = self._query_live_neighbors(
+                self.feature_matrix[rows], max_k, exclude_rows=rows
+            )
+            indices[~from_table], similarities[~from_table] = engine_indices, engine_similarities
+        
+        valid = (indices >= 0) & (np.arange(max_k) < top_ks[found][:, None])
+        neighbor_ids = np.where(valid, self.movie_ids[np.maximum(indices, 0)], -1)
+        
+        results = {}
+        for movie_id, row_ids, row_similarities, row_valid in zip(
+            movie_ids[found].tolist(), neighbor_ids.tolist(), similarities.tolist(), valid.tolist()
+        ):
+            results[str(movie_id)] = {
+                'movie_ids': [n for n, ok in zip(row_ids, row_valid) if ok],
+                'similarities': [s for s, ok in zip(row_similarities, row_valid) if ok]
+            }
+        
+        neighbor_positions = np.unique(indices[valid])
+        titles = self._titles(neighbor_positions)
+        vote_averages = self._display_column('vote_average', neighbor_positions).tolist()
+        popularities = self._display_column('popularity', neighbor_positions).tolist()
+        movies = {
+            str(movie_id): {'title': title, 'vote_average': vote_average, 'popularity': popularity}
+            for movie_id, title, vote_average, popularity
+            in zip(self.movie_ids[neighbor_positions].tolist(), titles, vote_averages, popularities)
+        }
+        
+        logger.info(f"✅ Similares en bloque: {len(found)} de {len(movie_ids)} películas")
+        return {'results': results, 'movies': movies, 'not_found': movie_ids[positions < 0].tolist()}
+
+    def get_user_recommendations_batch(self, requests: List[Dict]) -> List[list]:
+        """
+        get_user_recommendations para varios historiales ({'user_watched_movies', 'limit', 'mode'})
+        con recommend_batch, agrupando por (limit, mode); micro-batching de /recommendations/knn
+        """
+        if not self.is_model_loaded():
+            logger.warning("⚠️ Modelo KNN no disponible")
+            return [[] for _ in requests]
+        
+        groups: Dict[Tuple[int, str], List[int]] = {}
+        for i, request in enumerate(requests):
+            key = (request['limit'], request.get('mode') or self.USER_RECOMMENDATION_MODE)
+            groups.setdefault(key, []).append(i)
+        
+        results: List[list] = [[] for _ in requests]
+        for (limit, mode), members in groups.items():
+            histories = [requests[i]['user_watched_movies'] for i in members]
+            try:
+                recommendations = self.recommend_batch(histories, limit, mode)
+            except Exception as e:
+                logger.error(f"❌ Error en el lote de recomendaciones, calculando una a una: {e}")
+                recommendations = [
+                    self.get_user_recommendations(limit=limit, user_watched_movies=history, mode=mode)
+                    for history in histories
+                ]
+            for i, recs in zip(members, recommendations):
+                results[i] = recs
+        logger.info(f"✅ Lote de recomendaciones KNN: {len(requests)} historiales")
+        return results
+
+    def similar_cache_generation(self) -> Tuple:
+        """Generación de la caché de similares: cambia con cada recarga o alta/baja del catálogo"""
+        return (self.model_version, self.catalog_revision)
+
+    def cached_similar_movies(self, movie_id: int, top_k: int = 3) -> Optional[List[Dict]]:
+        """Solo la consulta a la caché de find_similar_movies (None si no está; cuenta acierto/fallo)"""
+        return self.similar_cache.get((int(movie_id), top_k), self.similar_cache_generation())
+
+    def store_similar_movies(self, movie_id: int, top_k: int, similar_movies: List[Dict], generation: Tuple = None):
+        """
+        Guardar un resultado calculado fuera de este servicio (p. ej. en un proceso de cómputo).
+        
+        generation debe leerse antes de lanzar el cálculo; sin ella se usa la actual.
+        """
+        if similar_movies:
+            generation = self.similar_cache_generation() if generation is None else generation
+            self.similar_cache.put((int(movie_id), top_k), similar_movies, generation)
+
+    def warm_similar_cache(self, n_movies: int = None, top_k_values: List[int] = None) -> int:
+        """Precargar la caché con las películas más populares; devuelve cuántas entradas se calcularon"""
+        n_movies = self.SIMILAR_CACHE_WARMUP if n_movies is None else n_movies
+        top_k_values = top_k_values or self.SIMILAR_CACHE_WARMUP_TOP_K
+        if n_movies <= 0 or not self.similar_cache.enabled or not self.is_model_loaded():
+            return 0
+        
+        live, catalog = self._live_mask(), self.catalog_frame()
+        movies_df = catalog if live is None else catalog[live]
+        popular_ids = movies_df.nlargest(n_movies, 'popularity')['id'].tolist()
+        
+        start = time.perf_counter()
+        warmed = 0
+        for movie_id in popular_ids:
+            for top_k in top_k_values:
+                if self.find_similar_movies(int(movie_id), top_k=top_k):
+                    warmed += 1
+        logger.info(f"🔥 Caché de similares precargada: {warmed} entradas en {time.perf_counter() - start:.2f}s")
+        return warmed
+
+    def get_user_recommendations(self, user_id: int = None, limit: int = 10, user_watched_movies: list = None,
+                                 mode: str = None) -> list:
+        """
+        Obtener recomendaciones KNN para un usuario específico o una lista de películas vistas.
+        
+        user_watched_movies acepta ids o dicts {'movie_id', 'rating'}; el rating pondera
+        la similitud de los vecinos de cada película semilla (modo 'seeds') o el centroide
+        del perfil del usuario (modo 'profile').
+        """
+        mode = mode or self.USER_RECOMMENDATION_MODE
+        if not self.is_model_loaded():
             logger.warning("⚠️ Modelo KNN no disponible")
             return []
         try:
             # Si se recibe una lista de películas vistas, usarla
             if user_watched_movies and len(user_watched_movies) > 0:
-                recommendations = []
-                for movie_id in user_watched_movies[:5]:  # Usar solo las primeras 5 películas
-                    similar_movies = self.find_similar_movies(movie_id, top_k=limit//2)
-                    recommendations.extend(similar_movies)
-                # Eliminar duplicados y películas ya vistas
-                seen_movie_ids = set(user_watched_movies)
-                unique_recommendations = []
-                seen_recommended = set()
-                for rec in recommendations:
-                    if rec['movie_id'] not in seen_movie_ids and rec['movie_id'] not in seen_recommended:
-                        unique_recommendations.append(rec)
-                        seen_recommended.add(rec['movie_id'])
-                        if len(unique_recommendations) >= limit:
-                            break
-                # Si no hay suficientes recomendaciones, agregar populares
-                if len(unique_recommendations) < limit:
-                    popular_movies = self._get_popular_movies_recommendations(limit - len(unique_recommendations))
-                    for movie in popular_movies:
-                        if movie['movie_id'] not in seen_movie_ids and movie['movie_id'] not in seen_recommended:
-                            unique_recommendations.append(movie)
-                            seen_recommended.add(movie['movie_id'])
-                            if len(unique_recommendations) >= limit:
-                                break
-                logger.info(f"✅ {len(unique_recommendations)} recomendaciones KNN generadas para películas vistas proporcionadas")
-                return unique_recommendations[:limit]
+                recommendations = self._recommend_from_history(user_watched_movies, limit, mode)
+                logger.info(f"✅ {len(recommendations)} recomendaciones KNN generadas para películas vistas proporcionadas")
+                return recommendations
             # Si no se recibe lista, intentar flujo tradicional (solo en desarrollo)
-            if self.db_connection and user_id is not None:
+            if self.db_pool and user_id is not None:
                 user_watched_movies = self._get_user_watched_movies(user_id)
                 if len(user_watched_movies) == 0:
                     logger.info(f"📝 Usuario {user_id} no tiene películas vistas, recomendando películas populares")
                     return self._get_popular_movies_recommendations(limit)
-                # Igual que arriba
-                recommendations = []
-                for movie_id in user_watched_movies[:5]:
-                    similar_movies = self.find_similar_movies(movie_id, top_k=limit//2)
-                    recommendations.extend(similar_movies)
-                seen_movie_ids = set(user_watched_movies)
-                unique_recommendations = []
-                seen_recommended = set()
-                for rec in recommendations:
-                    if rec['movie_id'] not in seen_movie_ids and rec['movie_id'] not in seen_recommended:
-                        unique_recommendations.append(rec)
-                        seen_recommended.add(rec['movie_id'])
-                        if len(unique_recommendations) >= limit:
-                            break
-                if len(unique_recommendations) < limit:
-                    popular_movies = self._get_popular_movies_recommendations(limit - len(unique_recommendations))
-                    for movie in popular_movies:
-                        if movie['movie_id'] not in seen_movie_ids and movie['movie_id'] not in seen_recommended:
-                            unique_recommendations.append(movie)
-                            seen_recommended.add(movie['movie_id'])
-                            if len(unique_recommendations) >= limit:
-                                break
-                logger.info(f"✅ {len(unique_recommendations)} recomendaciones KNN generadas para usuario {user_id}")
-                return unique_recommendations[:limit]
+                recommendations = self._recommend_from_history(user_watched_movies, limit, mode)
+                logger.info(f"✅ {len(recommendations)} recomendaciones KNN generadas para usuario {user_id}")
+                return recommendations
             # Fallback: populares
             logger.info("📊 Recomendando películas populares (sin datos de usuario)")
             return self._get_popular_movies_recommendations(limit)
@@ -416,22 +1187,308 @@ class EfficientKNNService:
             logger.error(f"❌ Error obteniendo recomendaciones: {e}")
             return self._get_popular_movies_recommendations(limit)
 
-    def _get_user_watched_movies(self, user_id: int) -> List[int]:
-        """Obtener películas que el usuario ha visto"""
-        if not self.db_connection:
+    def _normalize_user_history(self, user_watched_movies: list) -> Tuple[np.ndarray, np.ndarray]:
+        """Convertir el historial (ids o dicts con rating) en arrays de ids y pesos"""
+        movie_ids = np.empty(len(user_watched_movies), dtype=np.int64)
+        weights = np.ones(len(user_watched_movies), dtype=np.float32)
+        for i, item in enumerate(user_watched_movies):
+            if isinstance(item, dict):
+                movie_ids[i] = item['movie_id']
+                if item.get('rating') is not None:
+                    weights[i] = float(item['rating']) / 5.0
+            else:
+                movie_ids[i] = item
+        return movie_ids, weights
+
+    @timed_stage('recommend_from_history')
+    def _recommend_from_history(self, user_watched_movies: list, limit: int, mode: str = 'seeds') -> List[Dict]:
+        """
+        Recomendaciones para un historial completo con una sola consulta vectorizada.
+        
+        Los vecinos de todas las semillas se leen de la tabla de una vez, las similitudes
+        ponderadas por rating se agregan por candidato (suma o máximo) y el top-K se
+        selecciona con argpartition tras excluir en bloque las películas ya vistas. El
+        resultado viaja como RecommendationBatch y se hidrata una sola vez al final.
+        """
+        return self._materialize_recommendations(self._history_batch(user_watched_movies, limit, mode))
+    
+    def _history_batch(self, user_watched_movies: list, limit: int, mode: str = 'seeds') -> RecommendationBatch:
+        """Núcleo de _recommend_from_history: candidatos KNN + relleno con populares, sin dicts"""
+        watched_ids, weights = self._normalize_user_history(user_watched_movies)
+        seed_positions = self.lookup_positions(watched_ids)
+        known = seed_positions >= 0
+        seed_positions, weights = seed_positions[known], weights[known]
+        
+        batch = RecommendationBatch.empty()
+        table = self._neighbor_table
+        if mode == 'profile' and len(seed_positions) > 0 and limit > 0:
+            batch = self._profile_batch(seed_positions, weights, limit)
+        elif len(seed_positions) > 0 and table is not None and limit > 0:
+            k = min(self.USER_SEED_NEIGHBORS, table[0].shape[1])
+            with stage('neighbor_table_lookup'):
+                neighbors = table[0][seed_positions, :k]
+                similarities = table[1][seed_positions, :k]
+            weighted = similarities * weights[:, None]
+            
+            # Descartar huecos (-1) de la tabla tras borrados en catálogos pequeños
+            valid = neighbors >= 0
+            neighbors, similarities, weighted = neighbors[valid], similarities[valid], weighted[valid]
+            
+            n_movies = len(self.movie_ids)
+            if self.USER_SCORE_AGGREGATION == 'max':
+                scores = np.zeros(n_movies, dtype=np.float32)
+                np.maximum.at(scores, neighbors, weighted)
+            else:
+                scores = np.bincount(neighbors, weights=weighted, minlength=n_movies)
+            best_similarity = np.zeros(n_movies, dtype=np.float32)
+            np.maximum.at(best_similarity, neighbors, similarities)
+            
+            # Excluir en bloque lo ya visto
+            scores[seed_positions] = 0
+            candidates = np.flatnonzero(scores > 0)
+            if len(candidates) > limit:
+                candidates = candidates[np.argpartition(-scores[candidates], limit - 1)[:limit]]
+            candidates = candidates[np.argsort(-scores[candidates], kind='stable')]
+            
+            batch = RecommendationBatch(candidates, self.movie_ids[candidates], best_similarity[candidates],
+                                        scores[candidates])
+        
+        # Si no hay suficientes recomendaciones, agregar populares (sin lo visto ni lo ya recomendado)
+        if len(batch) < limit:
+            n_seen = len(np.unique(watched_ids)) + len(batch)
+            popular = np.asarray(self._popular_positions(limit - len(batch) + n_seen), dtype=np.int64)
+            popular = popular[~np.isin(popular, np.concatenate([seed_positions, batch.positions]))]
+            popular = popular[:limit - len(batch)]
+            batch = RecommendationBatch.concat([batch, RecommendationBatch(
+                popular, self.movie_ids[popular], np.full(len(popular), 0.5), sources=SOURCE_POPULAR
+            )])
+        
+        return batch.take(slice(0, limit))
+
+    def _build_user_profile_vector(self, seed_positions: np.ndarray, weights: np.ndarray) -> np.ndarray:
+        """Centroide ponderado por rating de las filas escaladas de lo que vio el usuario"""
+        weights = weights.astype(np.float64)
+        if weights.sum() <= 0:
+            weights = np.ones(len(weights))  # Todas las valoraciones a 0: centroide sin ponderar
+        profile = weights @ self.feature_matrix[seed_positions] / weights.sum()
+        return profile.reshape(1, -1)
+
+    def _profile_batch(self, seed_positions: np.ndarray, weights: np.ndarray, limit: int) -> RecommendationBatch:
+        """
+        Modo perfil: una única consulta de vecinos con el centroide del usuario.
+        
+        La latencia no depende de la longitud del historial: solo se piden
+        limit + vistas vecinos para poder descartar lo ya visto.
+        """
+        profile = self._build_user_profile_vector(seed_positions, weights)
+        indices, similarities = self._query_live_neighbors(profile, limit + len(seed_positions))
+        
+        keep = (indices[0] >= 0) & ~np.isin(indices[0], seed_positions)
+        indices = indices[0][keep][:limit]
+        similarities = similarities[0][keep][:limit]
+        # El score del modo perfil es la propia similitud con el centroide
+        return RecommendationBatch(indices, self.movie_ids[indices], similarities, similarities)
+
+    def recommend_positions_batch(self, history_offsets: np.ndarray, history_positions: np.ndarray,
+                                  history_weights: np.ndarray, limit: int, mode: str = None) -> np.ndarray:
+        """
+        Recomendaciones para muchos historiales a la vez (evaluación offline, ver knn_offline_evaluation.py).
+        
+        Los historiales llegan en CSR: posiciones de fila y pesos concatenados con offsets
+        (n_usuarios + 1). Devuelve una matriz (n_usuarios, limit) de posiciones, con -1 donde
+        no hay candidato.
+        """
+        positions, _, _ = self._recommend_batch_arrays(history_offsets, history_positions, history_weights, limit, mode)
+        return positions
+
+    def recommend_batch(self, histories: List[list], limit: int, mode: str = None) -> List[List[Dict]]:
+        """
+        _recommend_from_history para varios historiales con una sola pasada vectorizada
+        (micro-batching de /recommendations/knn). Devuelve los mismos dicts, en el mismo orden.
+        """
+        history_ids, history_weights, history_offsets = [], [], np.zeros(len(histories) + 1, dtype=np.int64)
+        for i, history in enumerate(histories):
+            movie_ids, weights = self._normalize_user_history(history)
+            history_ids.append(movie_ids)
+            history_weights.append(weights)
+            history_offsets[i + 1] = history_offsets[i] + len(movie_ids)
+        movie_ids = np.concatenate(history_ids) if histories else np.empty(0, dtype=np.int64)
+        weights = np.concatenate(history_weights) if histories else np.empty(0, dtype=np.float32)
+        
+        # Películas fuera del catálogo: no son semillas, pero cuentan como vistas para el fallback
+        positions = self.lookup_positions(movie_ids)
+        known = positions >= 0
+        owners = np.repeat(np.arange(len(histories)), np.diff(history_offsets))
+        unknown_counts = None
+        if not known.all():
+            unknown_pairs = np.unique(np.stack([owners[~known], movie_ids[~known]]), axis=1)
+            unknown_counts = np.bincount(unknown_pairs[0], minlength=len(histories))
+        known_offsets = np.zeros(len(histories) + 1, dtype=np.int64)
+        np.cumsum(np.bincount(owners[known], minlength=len(histories)), out=known_offsets[1:])
+        
+        result_positions, scores, similarities = self._recommend_batch_arrays(
+            known_offsets, positions[known], weights[known], limit, mode, unknown_counts
+        )
+        
+        # Hidratación única de todas las filas; los huecos de populares (score NaN) no llevan 'score'
+        filled = result_positions >= 0
+        movies = self._hydrate_movies(result_positions[filled], similarities[filled], scores[filled])
+        
+        recommendations, start = [], 0
+        for count in filled.sum(axis=1).tolist():
+            recommendations.append(movies[start:start + count])
+            start += count
+        return recommendations
+
+    @timed_stage('recommend_batch')
+    def _recommend_batch_arrays(self, history_offsets: np.ndarray, history_positions: np.ndarray,
+                                history_weights: np.ndarray, limit: int, mode: str = None,
+                                unknown_counts: np.ndarray = None) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """
+        Núcleo por lotes: matrices (n_usuarios, limit) de posiciones (-1 = hueco), scores
+        (NaN en los huecos rellenados con populares) y similitudes. La agregación es la de
+        _recommend_from_history, pero sobre claves usuario * n_películas + candidato en
+        lugar de un vector de scores por usuario.
+        """
+        n_users = len(history_offsets) - 1
+        width = max(limit, 0)
+        result = np.full((n_users, width), -1, dtype=np.int64)
+        result_scores = np.full((n_users, width), np.nan, dtype=np.float64)
+        result_similarities = np.zeros((n_users, width), dtype=np.float64)
+        if n_users == 0 or limit <= 0 or not self.is_model_loaded():
+            return result, result_scores, result_similarities
+        
+        mode = mode or self.USER_RECOMMENDATION_MODE
+        history_positions = np.asarray(history_positions, dtype=np.int64)
+        history_weights = np.asarray(history_weights)  # float32 como _normalize_user_history: mismos scores
+        lengths = np.diff(history_offsets)
+        owners = np.repeat(np.arange(n_users, dtype=np.int64), lengths)
+        n_movies = len(self.movie_ids)
+        seen_keys = owners * n_movies + history_positions
+        table = self._neighbor_table
+        
+        if mode == 'profile' and len(history_positions) > 0:
+            owner_ids, candidates, scores = self._batch_profile_candidates(
+                history_offsets, history_positions, history_weights.astype(np.float64), limit
+            )
+            similarities = scores
+        elif table is not None and len(history_positions) > 0:
+            k = min(self.USER_SEED_NEIGHBORS, table[0].shape[1])
+            with stage('neighbor_table_lookup'):
+                neighbors = np.asarray(table[0][history_positions, :k], dtype=np.int64)
+                neighbor_similarities = table[1][history_positions, :k]
+            weighted = neighbor_similarities * history_weights[:, None]
+            valid = neighbors >= 0
+            keys = (owners[:, None] * n_movies + neighbors)[valid]
+            weighted, neighbor_similarities = weighted[valid], neighbor_similarities[valid]
+            
+            # Agregar por (usuario, candidato) y excluir en bloque lo ya visto
+            unique_keys, inverse = np.unique(keys, return_inverse=True)
+            if self.USER_SCORE_AGGREGATION == 'max':
+                scores = np.zeros(len(unique_keys), dtype=np.float64)
+                np.maximum.at(scores, inverse, weighted)
+            else:
+                scores = np.bincount(inverse, weights=weighted, minlength=len(unique_keys))
+            similarities = np.zeros(len(unique_keys), dtype=np.float64)
+            np.maximum.at(similarities, inverse, neighbor_similarities)
+            keep = (scores > 0) & ~np.isin(unique_keys, seen_keys)
+            unique_keys, scores, similarities = unique_keys[keep], scores[keep], similarities[keep]
+            owner_ids, candidates = unique_keys // n_movies, unique_keys % n_movies
+            
+            # Orden por usuario, score descendente y posición (como el argsort estable de la ruta individual)
+            order = np.lexsort((candidates, -scores, owner_ids))
+            owner_ids, candidates, scores, similarities = owner_ids[order], candidates[order], scores[order], similarities[order]
+        else:
+            owner_ids = candidates = np.empty(0, dtype=np.int64)
+            scores = similarities = np.empty(0, dtype=np.float64)
+        
+        # Rango de cada candidato dentro de su usuario; se quedan los `limit` primeros
+        ranks = np.arange(len(owner_ids)) - np.searchsorted(owner_ids, owner_ids, side='left')
+        top = ranks < limit
+        result[owner_ids[top], ranks[top]] = candidates[top]
+        result_scores[owner_ids[top], ranks[top]] = scores[top]
+        result_similarities[owner_ids[top], ranks[top]] = similarities[top]
+        
+        popular_slots = self._fill_with_popular_positions(result, history_offsets, history_positions, unknown_counts)
+        result_similarities[popular_slots] = 0.5  # Similitud neutral, como _get_popular_movies_recommendations
+        return result, result_scores, result_similarities
+
+    def _batch_profile_candidates(self, history_offsets: np.ndarray, history_positions: np.ndarray,
+                                  history_weights: np.ndarray, limit: int) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """Modo perfil por lotes: un centroide por usuario y una sola consulta al motor"""
+        lengths = np.diff(history_offsets)
+        users = np.flatnonzero(lengths > 0)
+        
+        # reduceat sobre los inicios de los usuarios con historial (los vacíos no aportan filas)
+        starts = history_offsets[:-1][users]
+        weighted_rows = self.feature_matrix[history_positions] * history_weights[:, None]
+        weighted_sums = np.add.reduceat(weighted_rows, starts, axis=0)
+        weight_sums = np.add.reduceat(history_weights, starts)
+        # Usuarios con todas las valoraciones a 0: centroide sin ponderar, como _build_user_profile_vector
+        unweighted = weight_sums <= 0
+        if unweighted.any():
+            plain_sums = np.add.reduceat(self.feature_matrix[history_positions], starts, axis=0)
+            weighted_sums[unweighted] = plain_sums[unweighted]
+            weight_sums[unweighted] = lengths[users][unweighted]
+        profiles = weighted_sums / weight_sums[:, None]
+        indices, similarities = self._query_live_neighbors(profiles, limit + int(lengths.max()))
+        
+        n_movies = len(self.movie_ids)
+        owner_ids = np.repeat(users, indices.shape[1])
+        candidates = indices.ravel().astype(np.int64)
+        seen_keys = np.repeat(np.arange(len(lengths), dtype=np.int64), lengths) * n_movies + history_positions
+        keep = (candidates >= 0) & ~np.isin(owner_ids * n_movies + candidates, seen_keys)
+        return owner_ids[keep], candidates[keep], np.asarray(similarities, dtype=np.float64).ravel()[keep]
+
+    def _fill_with_popular_positions(self, result: np.ndarray, history_offsets: np.ndarray,
+                                     history_positions: np.ndarray, unknown_counts: np.ndarray = None) -> np.ndarray:
+        """
+        Completar con populares las filas con huecos, como el fallback de _recommend_from_history;
+        devuelve la máscara de las casillas rellenadas
+        """
+        popular_slots = np.zeros(result.shape, dtype=bool)
+        short_rows = np.flatnonzero((result < 0).any(axis=1))
+        if len(short_rows) == 0:
+            return popular_slots
+        limit = result.shape[1]
+        popular_by_size = {}  # La lista de populares depende de cuántas faltan y cuántas se excluyen
+        for row in short_rows.tolist():
+            seen = set(history_positions[history_offsets[row]:history_offsets[row + 1]].tolist())
+            filled = result[row][result[row] >= 0].tolist()
+            seen.update(filled)
+            size = limit - len(filled) + len(seen) + (int(unknown_counts[row]) if unknown_counts is not None else 0)
+            if size not in popular_by_size:
+                popular_by_size[size] = self._popular_positions(size)
+            first_fill = len(filled)
+            filled.extend(position for position in popular_by_size[size] if position not in seen)
+            filled = filled[:limit]
+            result[row, :len(filled)] = filled
+            popular_slots[row, first_fill:len(filled)] = True
+        return popular_slots
+
+    def _popular_positions(self, limit: int) -> List[int]:
+        """Posiciones de las películas populares (mismo criterio que _get_popular_movies_recommendations)"""
+        live, catalog = self._live_mask(), self.catalog_frame()
+        movies_df = catalog if live is None else catalog[live]
+        popular_movies = movies_df.nlargest(limit * 2, 'popularity').nlargest(limit, 'vote_average')
+        return popular_movies.index.tolist()
+
+    def _get_user_watched_movies(self, user_id: int) -> List[Dict]:
+        """Obtener películas que el usuario ha visto, con su rating"""
+        if not self.db_pool:
             return []
         
         try:
-            with self.db_connection.cursor() as cursor:
+            with self.db_pool.connection() as conn, conn.cursor() as cursor:
                 cursor.execute("""
-                    SELECT movie_id 
+                    SELECT movie_id, rating
                     FROM user_movies 
                     WHERE user_id = %s AND watched = true
                     ORDER BY rating DESC, created_at DESC
                 """, (user_id,))
                 
                 results = cursor.fetchall()
-                return [row[0] for row in results]
+                return [{'movie_id': row[0], 'rating': row[1]} for row in results]
                 
         except Exception as e:
             logger.error(f"❌ Error obteniendo películas vistas del usuario {user_id}: {e}")
@@ -444,17 +1501,21 @@ class EfficientKNNService:
         
         try:
             # Obtener datos de las películas vistas
-            watched_data = self.movies_df[self.movies_df['id'].isin(watched_movies)]
+            positions = self.lookup_positions(watched_movies)
+            positions = positions[positions >= 0]
             
-            if len(watched_data) == 0:
+            if len(positions) == 0:
                 return {}
             
+            def column_mean(column: str) -> float:
+                return float(self._catalog_column(column)[positions].mean(dtype=np.float64))
+            
             # Calcular características promedio del usuario
             user_features = {
-                'avg_vote_average': float(watched_data['vote_average'].mean()),
-                'avg_popularity': float(watched_data['popularity'].mean()),
-                'preferred_genres': self._get_preferred_genres(watched_data),
-                'avg_years_since_release': float(watched_data['years_since_release'].mean())
+                'avg_vote_average': column_mean('vote_average'),
+                'avg_popularity': column_mean('popularity'),
+                'preferred_genres': self._get_preferred_genres(positions),
+                'avg_years_since_release': column_mean('years_since_release')
             }
             
             return user_features
@@ -463,17 +1524,11 @@ class EfficientKNNService:
             logger.error(f"❌ Error calculando características del usuario {user_id}: {e}")
             return {}
 
-    def _get_preferred_genres(self, movies_data: pd.DataFrame) -> List[int]:
-        """Obtener géneros preferidos del usuario"""
+    def _get_preferred_genres(self, positions: np.ndarray) -> List[int]:
+        """Obtener géneros preferidos del usuario (filas de sus películas vistas)"""
         try:
-            all_genres = []
-            for genre_ids in movies_data['genre_ids']:
-                if isinstance(genre_ids, (list, tuple)):
-                    all_genres.extend(genre_ids)
-                elif isinstance(genre_ids, str):
-                    # Convertir string a lista de IDs
-                    genre_list = [int(g.strip()) for g in genre_ids.split(',') if g.strip().isdigit()]
-                    all_genres.extend(genre_list)
+            # Géneros de esas filas, concatenados en el orden de las películas (gather sobre el CSR)
+            all_genres = take_ragged(self.genre_offsets, self.genre_values, positions)['values'].tolist()
             
             # Contar frecuencia de géneros
             from collections import Counter
@@ -492,21 +1547,10 @@ class EfficientKNNService:
             return []
         
         try:
-            # Ordenar por popularidad y calificación
-            popular_movies = self.movies_df.nlargest(limit * 2, 'popularity')
-            popular_movies = popular_movies.nlargest(limit, 'vote_average')
-            
-            recommendations = []
-            for _, movie in popular_movies.iterrows():
-                recommendations.append({
-                    'movie_id': int(movie['id']),
-                    'title': movie['title'],
-                    'similarity': 0.5,  # Similitud neutral para películas populares
-                    'vote_average': float(movie['vote_average']),
-                    'popularity': float(movie['popularity'])
-                })
-            
-            return recommendations[:limit]
+            # Ordenar por popularidad y calificación (sin películas borradas)
+            positions = self._popular_positions(limit)[:limit]
+            # Similitud neutral para películas populares
+            return self._hydrate_movies(positions, np.full(len(positions), 0.5))
             
         except Exception as e:
             logger.error(f"❌ Error obteniendo películas populares: {e}")
@@ -519,58 +1563,150 @@ class EfficientKNNService:
         if not social_recommendations:
             return []
         
+        sorted_social, expansion = self._expand_social_batch(social_recommendations)
+        if expansion is None:
+            return sorted_social
+        return self._materialize_expansion(expansion, sorted_social)
+    
+    @timed_stage('expand_social_recommendations')
+    def _expand_social_batch(self, social_recommendations: List[Dict]) -> Tuple[List[Dict], Optional[RecommendationBatch]]:
+        """
+        Recomendaciones sociales ordenadas por rating y, si son pocas, su expansión como lote:
+        cada social de las MAX_KNN_MOVIES mejores seguida de sus 2 vecinos, sin duplicados.
+        Las filas sociales apuntan a su entrada de sorted_social con 'seeds'. Sin expansión
+        el lote es None.
+        """
         # Ordenar recomendaciones sociales por rating
         sorted_social = sorted(social_recommendations, 
                              key=lambda r: r.get('rating', 0), reverse=True)
         
         # Aplicar KNN solo si hay pocas recomendaciones sociales
-        if len(sorted_social) < self.MIN_SOCIAL_RECS_FOR_KNN:
-            logger.info(f"🔍 Pocas recomendaciones sociales ({len(sorted_social)}), activando KNN")
-            
-            # Tomar solo las mejores para aplicar KNN
-            top_social = sorted_social[:self.MAX_KNN_MOVIES]
-            
-            expanded_recs = []
-            for movie in top_social:
-                # Agregar la película original
-                expanded_recs.append({
-                    'movie_id': movie['movie_id'],
-                    'title': movie['title'],
-                    'source': 'social',
-                    'rating': movie.get('rating', 0),
-                    'recommenders': movie.get('recommenders', [])
-                })
-                
-                # Buscar películas similares
-                similar_movies = self.find_similar_movies(movie['movie_id'], top_k=2)
-                for similar in similar_movies:
-                    expanded_recs.append({
-                        'movie_id': similar['movie_id'],
-                        'title': similar['title'],
-                        'source': 'knn_expansion',
-                        'similarity_score': similar['similarity'],
-                        'original_movie': movie['title'],
-                        'vote_average': similar['vote_average'],
-                        'popularity': similar['popularity'],
-                        'avg_user_rating': similar['vote_average'],
-                        'user_rating_count': 0
-                    })
-            
-            # Eliminar duplicados
-            seen_movies = set()
-            unique_expanded = []
-            for rec in expanded_recs:
-                if rec['movie_id'] not in seen_movies:
-                    seen_movies.add(rec['movie_id'])
-                    unique_expanded.append(rec)
-            
-            logger.info(f"✅ Recomendaciones expandidas: {len(unique_expanded)} (originales: {len(sorted_social)})")
-            return unique_expanded
+        if len(sorted_social) >= self.MIN_SOCIAL_RECS_FOR_KNN:
+            logger.info(f"✅ Suficientes recomendaciones sociales ({len(sorted_social)}), KNN no necesario")
+            return sorted_social, None
+        
+        logger.info(f"🔍 Pocas recomendaciones sociales ({len(sorted_social)}), activando KNN")
+        
+        # Tomar solo las mejores para aplicar KNN; vecinos de todas con una sola lectura
+        top_social = sorted_social[:self.MAX_KNN_MOVIES]
+        social_ids = np.fromiter((movie['movie_id'] for movie in top_social), dtype=np.int64, count=len(top_social))
+        neighbors, similarities = self._neighbor_rows(self.lookup_positions(social_ids), 2)
         
+        # Bloque por social: [social, vecino 1, vecino 2], aplanado sin huecos
+        n_social, width = len(top_social), neighbors.shape[1] + 1
+        found = neighbors >= 0
+        positions = np.full((n_social, width), -1, dtype=np.int64)
+        positions[:, 1:] = neighbors
+        movie_ids = np.full((n_social, width), -1, dtype=np.int64)
+        movie_ids[:, 0] = social_ids
+        if found.any():
+            movie_ids[:, 1:][found] = self.movie_ids[neighbors[found]]
+        row_similarities = np.zeros((n_social, width))
+        row_similarities[:, 1:] = similarities
+        sources = np.full((n_social, width), SOURCE_KNN_EXPANSION, dtype=np.int8)
+        sources[:, 0] = SOURCE_SOCIAL
+        seeds = np.repeat(np.arange(n_social, dtype=np.int64)[:, None], width, axis=1)
+        valid = np.ones((n_social, width), dtype=bool)
+        valid[:, 1:] = found
+        
+        # Eliminar duplicados (se queda la primera aparición)
+        expansion = RecommendationBatch(
+            positions[valid], movie_ids[valid], row_similarities[valid], sources=sources[valid], seeds=seeds[valid]
+        ).first_per_movie()
+        
+        logger.info(f"✅ Recomendaciones expandidas: {len(expansion)} (originales: {len(sorted_social)})")
+        return sorted_social, expansion
+    
+    def _neighbor_rows(self, positions: np.ndarray, k: int) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Vecinos (n, k) de un lote de filas, como find_similar_movies: slice de la tabla o
+        consulta directa si k supera su ancho. Filas desconocidas (-1) y huecos quedan en -1.
+        """
+        indices = np.full((len(positions), k), -1, dtype=np.int64)
+        similarities = np.zeros((len(positions), k))
+        known = np.flatnonzero(positions >= 0)
+        if len(known) == 0 or not self.is_model_loaded():
+            return indices, similarities
+        rows = positions[known]
+        table = self._neighbor_table
+        if table is not None and k <= table[0].shape[1]:
+            with stage('neighbor_table_lookup'):
+                indices[known] = table[0][rows, :k]
+                similarities[known] = table[1][rows, :k]
         else:
-            logger.info(f"✅ Suficientes recomendaciones sociales ({len(sorted_social)}), KNN no necesario")
-            return sorted_social
+            indices[known], similarities[known] = self._query_live_neighbors(
+                self.feature_matrix[rows], k, exclude_rows=rows
+            )
+        return indices, similarities
+    
+    @timed_stage('hydrate_movies')
+    def _materialize_expansion(self, expansion: RecommendationBatch, sorted_social: List[Dict]) -> List[Dict]:
+        """
+        Dicts de /expand-recommendations (y de /efficient-recommendations con 'ml_score' si el
+        lote trae scores) en una sola pasada: las filas sociales salen de su entrada, las de
+        expansión de las columnas del catálogo.
+        """
+        knn_rows = expansion.sources == SOURCE_KNN_EXPANSION
+        positions = expansion.positions[knn_rows]
+        titles = iter(self._titles(positions))
+        vote_averages = iter(self._display_column('vote_average', positions).tolist())
+        popularities = iter(self._display_column('popularity', positions).tolist())
+        
+        with_scores = not np.isnan(expansion.scores).all()
+        recommendations = []
+        for movie_id, is_knn, seed, similarity, score in zip(
+            expansion.movie_ids.tolist(), knn_rows.tolist(), expansion.seeds.tolist(),
+            expansion.similarities.tolist(), expansion.scores.tolist()
+        ):
+            social = sorted_social[seed]
+            if is_knn:
+                vote_average = next(vote_averages)
+                rec = {
+                    'movie_id': movie_id,
+                    'title': next(titles),
+                    'source': 'knn_expansion',
+                    'similarity_score': similarity,
+                    'original_movie': social['title'],
+                    'vote_average': vote_average,
+                    'popularity': next(popularities),
+                    'avg_user_rating': vote_average,
+                    'user_rating_count': 0
+                }
+            else:
+                rec = {
+                    'movie_id': social['movie_id'],
+                    'title': social['title'],
+                    'source': 'social',
+                    'rating': social.get('rating', 0),
+                    'recommenders': social.get('recommenders', [])
+                }
+            if with_scores:
+                rec['ml_score'] = score
+            recommendations.append(rec)
+        return recommendations
     
+    @staticmethod
+    def _ml_scores(is_social: np.ndarray, is_knn: np.ndarray, ratings: np.ndarray, recommender_counts: np.ndarray,
+                   similarity_scores: np.ndarray, vote_averages: np.ndarray, popularities: np.ndarray,
+                   avg_user_ratings: np.ndarray, user_rating_counts: np.ndarray) -> np.ndarray:
+        """
+        Score de ranking de un lote en columnas (simula el RandomForest; aquí usarías tu modelo real).
+        Las sumas van en el mismo orden que el cálculo por fila original: mismos scores y empates.
+        """
+        # Scoring basado en fuente: rating social y recomendadores, o similitud KNN
+        scores = np.where(is_social, ratings * 0.4 + recommender_counts * 0.1,
+                          np.where(is_knn, similarity_scores * 0.3, 0.0))
+        
+        # Scoring basado en características de la película
+        scores += (vote_averages / 10) * 0.2
+        scores += np.minimum(popularities / 200, 1) * 0.1
+        
+        # Scoring basado en estadísticas de usuarios
+        scores += (avg_user_ratings / 5) * 0.1
+        scores += np.minimum(user_rating_counts / 100, 1) * 0.05
+        return scores
+    
+    @timed_stage('rank_recommendations_with_ml')
     def rank_recommendations_with_ml(self, recommendations: List[Dict], 
                                    user_features: Dict) -> List[Dict]:
         """
@@ -580,35 +1716,25 @@ class EfficientKNNService:
             return []
         
         try:
-            # Simular scoring con RandomForest (aquí usarías tu modelo real)
-            scored_recommendations = []
-            
-            for rec in recommendations:
-                score = 0
-                
-                # Scoring basado en fuente
-                if rec.get('source') == 'social':
-                    score += rec.get('rating', 0) * 0.4  # Rating social tiene peso alto
-                    score += len(rec.get('recommenders', [])) * 0.1  # Más recomendadores = mejor
-                elif rec.get('source') == 'knn_expansion':
-                    score += rec.get('similarity_score', 0) * 0.3  # Similitud KNN
-                
-                # Scoring basado en características de la película
-                score += (rec.get('vote_average', 0) / 10) * 0.2
-                score += min(rec.get('popularity', 0) / 200, 1) * 0.1
-                
-                # Scoring basado en estadísticas de usuarios
-                score += (rec.get('avg_user_rating', 5.0) / 5) * 0.1
-                score += min(rec.get('user_rating_count', 0) / 100, 1) * 0.05
-                
-                scored_recommendations.append({
-                    **rec,
-                    'ml_score': score
-                })
+            # Columnas del lote (una lectura por campo) y score vectorizado
+            def column(key: str, default) -> np.ndarray:
+                return np.fromiter((rec.get(key, default) for rec in recommendations), dtype=float,
+                                   count=len(recommendations))
+            sources = [rec.get('source') for rec in recommendations]
+            scores = self._ml_scores(
+                np.array([source == 'social' for source in sources], dtype=bool),
+                np.array([source == 'knn_expansion' for source in sources], dtype=bool),
+                column('rating', 0),
+                np.fromiter((len(rec.get('recommenders', [])) for rec in recommendations), dtype=float,
+                            count=len(recommendations)),
+                column('similarity_score', 0), column('vote_average', 0), column('popularity', 0),
+                column('avg_user_rating', 5.0), column('user_rating_count', 0)
+            )
             
-            # Ordenar por score y tomar top-K
-            final_ranking = sorted(scored_recommendations, 
-                                 key=lambda r: r['ml_score'], reverse=True)[:self.FINAL_TOP_K]
+            # Ordenar por score y tomar top-K (empates en el orden de entrada); solo se copian esas filas
+            top = np.argsort(-scores, kind='stable')[:self.FINAL_TOP_K]
+            final_ranking = [{**recommendations[i], 'ml_score': score}
+                             for i, score in zip(top.tolist(), scores[top].tolist())]
             
             logger.info(f"✅ Ranking final generado: {len(final_ranking)} películas")
             return final_ranking
@@ -619,42 +1745,124 @@ class EfficientKNNService:
             return sorted(recommendations, 
                          key=lambda r: r.get('rating', 0), reverse=True)[:self.FINAL_TOP_K]
     
+    @timed_stage('rank_recommendations_with_ml')
+    def _rank_expansion_batch(self, expansion: RecommendationBatch, sorted_social: List[Dict]) -> RecommendationBatch:
+        """rank_recommendations_with_ml sobre el lote de la expansión: top-K con 'ml_score' en scores"""
+        is_social = expansion.sources == SOURCE_SOCIAL
+        is_knn = ~is_social
+        seeds = expansion.seeds.tolist()
+        
+        # Las filas sociales solo aportan rating y recomendadores; las de expansión, el catálogo
+        ratings = np.array([sorted_social[seed].get('rating', 0) for seed in seeds], dtype=float)
+        recommender_counts = np.array([len(sorted_social[seed].get('recommenders', [])) for seed in seeds], dtype=float)
+        vote_averages, popularities = np.zeros(len(expansion)), np.zeros(len(expansion))
+        vote_averages[is_knn] = self._display_column('vote_average', expansion.positions[is_knn])
+        popularities[is_knn] = self._display_column('popularity', expansion.positions[is_knn])
+        avg_user_ratings = np.where(is_knn, vote_averages, 5.0)
+        
+        scores = self._ml_scores(is_social, is_knn, ratings, recommender_counts, expansion.similarities,
+                                 vote_averages, popularities, avg_user_ratings, np.zeros(len(expansion)))
+        ranked = RecommendationBatch(expansion.positions, expansion.movie_ids, expansion.similarities, scores,
+                                     expansion.sources, expansion.seeds).top_by_score(self.FINAL_TOP_K)
+        logger.info(f"✅ Ranking final generado: {len(ranked)} películas")
+        return ranked
+    
     def get_efficient_recommendations(self, social_recommendations: List[Dict], 
                                     user_features: Dict) -> List[Dict]:
         """
-        Método principal que implementa las 3 estrategias combinadas
+        Método principal que implementa las 3 estrategias combinadas.
+        
+        Con expansión, el lote viaja en columnas de la expansión al ranking y solo se
+        construyen los dicts de las FINAL_TOP_K películas finales.
         """
         logger.info(f"🚀 Iniciando recomendaciones eficientes con KNN")
         logger.info(f"📊 Recomendaciones sociales iniciales: {len(social_recommendations)}")
         
         # Estrategia 1 & 2: Expandir con KNN solo si es necesario
-        expanded_recs = self.expand_social_recommendations(social_recommendations)
+        if not social_recommendations:
+            return []
+        sorted_social, expansion = self._expand_social_batch(social_recommendations)
         
         # Estrategia 3: Ranking final con ML
-        final_recommendations = self.rank_recommendations_with_ml(expanded_recs, user_features)
+        if expansion is None:
+            final_recommendations = self.rank_recommendations_with_ml(sorted_social, user_features)
+        else:
+            try:
+                ranked = self._rank_expansion_batch(expansion, sorted_social)
+            except Exception as e:
+                logger.error(f"❌ Error en ranking con ML: {e}")
+                # Fallback: ordenar por rating social (las filas de expansión no tienen rating)
+                ratings = np.array([sorted_social[seed].get('rating', 0) if source == SOURCE_SOCIAL else 0
+                                    for seed, source in zip(expansion.seeds.tolist(), expansion.sources.tolist())])
+                ranked = expansion.take(np.argsort(-ratings, kind='stable')[:self.FINAL_TOP_K])
+            final_recommendations = self._materialize_expansion(ranked, sorted_social)
         
         logger.info(f"🎉 Recomendaciones finales generadas: {len(final_recommendations)}")
         
         return final_recommendations
     
+    def evaluation_catalog(self) -> Optional[Dict]:
+        """
+        Arrays del catálogo en memoria para calcular métricas sin consultar la BD
+        (ver knn_evaluation.py): popularidad y géneros en CSR alineados con las filas,
+        y tamaño del catálogo vivo. Se recalculan solo si cambia el catálogo.
+        """
+        base_df = self.movies_df
+        if base_df is None:
+            return None
+        
+        cached = self._evaluation_catalog
+        if cached is not None and cached['movies_df'] is base_df and cached['catalog_revision'] == self.catalog_revision:
+            return cached
+        
+        movies_df = self.catalog_frame()
+        # Los offsets del load en streaming o del artefacto valen mientras no haya altas incrementales
+        if self.genre_offsets is not None and len(self.genre_offsets) == len(movies_df) + 1:
+            genre_offsets, genre_values = np.asarray(self.genre_offsets), np.asarray(self.genre_values)
+        elif 'genre_ids' in movies_df.columns:
+            genres = encode_genres(movies_df['genre_ids'])
+            genre_offsets, genre_values = genres['offsets'], genres['values']
+        else:
+            genre_offsets, genre_values = np.zeros(len(movies_df) + 1, dtype=np.int64), np.empty(0, dtype=np.int32)
+        
+        cached = {
+            'movies_df': base_df,
+            'catalog_revision': self.catalog_revision,
+            'popularity': pd.to_numeric(movies_df['popularity'], errors='coerce').to_numpy(dtype=np.float64),
+            'genre_offsets': genre_offsets,
+            'genre_values': genre_values,
+            'catalog_size': self.live_movie_count
+        }
+        self._evaluation_catalog = cached
+        return cached
+    
     def get_model_status(self) -> Dict:
         """Obtener estado del modelo KNN"""
         return {
-            'knn_loaded': self.knn_model is not None,
+            'knn_loaded': self.is_model_loaded(),
+            'model_version': self.model_version,
+            'model_path': self.model_path,
+            'ann_report': self.ann_report,
             'movies_loaded': self.movies_df is not None,
-            'total_movies': len(self.movies_df) if self.movies_df is not None else 0,
-            'db_connected': self.db_connection is not None,
+            'total_movies': self.live_movie_count if self.movies_df is not None else 0,
+            'tombstoned_movies': self.n_tombstoned,
+            'catalog_revision': self.catalog_revision,
+            'db_connected': self.db_pool is not None,
+            'db_pool': self.db_pool.stats() if self.db_pool is not None else None,
+            'similar_cache': self.similar_cache.stats(),
             'feature_columns': self.feature_columns,
             'config': {
                 'max_knn_movies': self.MAX_KNN_MOVIES,
                 'min_social_recs_for_knn': self.MIN_SOCIAL_RECS_FOR_KNN,
                 'final_top_k': self.FINAL_TOP_K,
-                'knn_neighbors': self.KNN_NEIGHBORS
+                'knn_neighbors': self.KNN_NEIGHBORS,
+                'knn_engine': self.KNN_ENGINE,
+                'ann_active': self.ann_index is not None and self._query_engine() is self.ann_index,
+                'ann_threshold': self.ANN_THRESHOLD,
+                'neighbor_table_k': int(self.neighbor_indices.shape[1]) if self.neighbor_indices is not None else 0
             }
         }
     
     def close(self):
-        """Cerrar conexiones"""
-        if self.db_connection:
-            self.db_connection.close()
-            logger.info("✅ Conexión a base de datos cerrada") 
\ No newline at end of file
+        """Soltar el pool; el pool compartido se cierra con db_pool.close_database_pool() al terminar el proceso"""
+        self.db_pool = None 
\ No newline at end of file
@@ -0,0 +1,179 @@
+"""
+Trabajos de entrenamiento KNN en segundo plano.
+
+Cada entrenamiento corre en un proceso aparte (contexto 'spawn'), así el ajuste y la
+construcción de la tabla de vecinos no compiten por el GIL con las peticiones que
+atiende la API. El proceso hijo informa de su fase por una cola y el padre mantiene
+el estado consultable por id de trabajo.
+"""
+
+import logging
+import multiprocessing
+import os
+import sys
+import threading
+import time
+import traceback
+import uuid
+from typing import Callable, Dict, List, Optional
+
+try:
+    import resource  # Solo Unix: en Windows la memoria pico se informa como None
+except ImportError:
+    resource = None
+
+logger = logging.getLogger(__name__)
+
+TRAINING_PHASES = ['loading', 'features', 'fit', 'neighbor_table', 'save']
+
+
+def _peak_memory_mb() -> Optional[float]:
+    """Memoria residente máxima del proceso actual en MB (ru_maxrss: KB en Linux, bytes en macOS)"""
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return round(peak / (1024 * 1024 if sys.platform == 'darwin' else 1024), 1)
+
+
+def _run_training_job(output_path: str, queue):
+    """Punto de entrada del proceso hijo: cargar de BD, entrenar y guardar el artefacto"""
+    try:
+        from knn_service import EfficientKNNService
+        from db_pool import close_database_pool
+
+        service = EfficientKNNService(auto_load=False)
+        service.progress_callback = lambda phase: queue.put(
+            {'event': 'phase', 'phase': phase, 'peak_memory_mb': _peak_memory_mb()}
+        )
+
+        service.connect_database()
+        if not service.db_pool:
+            raise RuntimeError("No se pudo conectar a la base de datos")
+        service.load_movies_from_database()
+        if service.movies_df is None:
+            raise RuntimeError("No se pudieron cargar películas desde la BD")
+        service.train_knn_model()
+        if not service.is_model_loaded():
+            raise RuntimeError("No se pudo entrenar el modelo KNN")
+        # train_knn_model ya construye el índice aproximado cuando el catálogo lo usa (uses_ann_index)
+        service.save_knn_model(output_path)
+        if service.model_path != output_path:
+            raise RuntimeError(f"No se pudo guardar el modelo en {output_path}")
+        service.close()
+        close_database_pool()
+
+        queue.put({
+            'event': 'completed',
+            'model_version': service.model_version,
+            'total_movies': len(service.movies_df),
+            'peak_memory_mb': _peak_memory_mb()
+        })
+    except Exception as e:
+        queue.put({
+            'event': 'failed',
+            'error': str(e),
+            'traceback': traceback.format_exc(),
+            'peak_memory_mb': _peak_memory_mb()
+        })
+
+
+class TrainingJobManager:
+    """Lanza entrenamientos en procesos aparte y expone su progreso por id"""
+
+    def __init__(self, on_complete: Optional[Callable[[str], None]] = None, max_history: int = 20):
+        self.on_complete = on_complete  # Recibe la ruta del artefacto nuevo (p. ej. para recargarlo)
+        self.max_history = max_history
+        self._jobs: Dict[str, Dict] = {}
+        self._lock = threading.Lock()
+        self._context = multiprocessing.get_context('spawn')
+
+    def submit(self, output_path: str) -> Dict:
+        """Crear un trabajo de entrenamiento; falla si ya hay uno en curso"""
+        with self._lock:
+            if any(job['status'] in ('queued', 'running') for job in self._jobs.values()):
+                raise RuntimeError("Ya hay un entrenamiento en curso")
+
+            job_id = uuid.uuid4().hex[:12]
+            job = {
+                'job_id': job_id,
+                'status': 'queued',
+                'phase': None,
+                'phases': {},
+                'output_path': output_path,
+                'submitted_at': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+                'started': time.time(),
+                'finished': None,
+                'peak_memory_mb': None,
+                'model_version': None,
+                'error': None
+            }
+            self._jobs[job_id] = job
+            self._trim_history()
+
+        queue = self._context.Queue()
+        process = self._context.Process(
+            target=_run_training_job, args=(output_path, queue), name=f"knn-train-{job_id}", daemon=True
+        )
+        process.start()
+        job['status'] = 'running'
+        job['pid'] = process.pid
+        threading.Thread(
+            target=self._follow_job, args=(job, process, queue), name=f"knn-train-monitor-{job_id}", daemon=True
+        ).start()
+        logger.info(f"🚀 Entrenamiento KNN {job_id} lanzado (pid {process.pid}) -> {output_path}")
+        return self.get(job_id)
+
+    def _follow_job(self, job: Dict, process, queue):
+        """Leer los eventos del proceso hijo hasta que termine"""
+        while True:
+            try:
+                message = queue.get(timeout=1.0)
+            except Exception:
+                if not process.is_alive():
+                    if job['status'] == 'running':
+                        job.update(status='failed', error=f"El proceso terminó con código {process.exitcode}",
+                                   finished=time.time())
+                    break
+                continue
+
+            job['peak_memory_mb'] = message.get('peak_memory_mb', job['peak_memory_mb'])
+            if message['event'] == 'phase':
+                job['phase'] = message['phase']
+                job['phases'][message['phase']] = round(time.time() - job['started'], 2)
+            elif message['event'] == 'completed':
+                job.update(status='completed', phase='done', model_version=message['model_version'],
+                           total_movies=message['total_movies'], finished=time.time())
+                break
+            elif message['event'] == 'failed':
+                job.update(status='failed', error=message['error'], finished=time.time())
+                logger.error(f"❌ Entrenamiento KNN {job['job_id']} falló: {message['error']}")
+                break
+
+        process.join(timeout=5)
+        if job['status'] == 'completed':
+            logger.info(f"✅ Entrenamiento KNN {job['job_id']} completado: versión {job['model_version']}")
+            if self.on_complete is not None:
+                try:
+                    self.on_complete(job['output_path'])
+                except Exception as e:
+                    logger.error(f"❌ Error entregando el modelo entrenado al servicio: {e}")
+
+    def _trim_history(self):
+        """Olvidar los trabajos terminados más antiguos"""
+        finished = [job_id for job_id, job in self._jobs.items() if job['status'] in ('completed', 'failed')]
+        for job_id in finished[:max(0, len(self._jobs) - self.max_history)]:
+            del self._jobs[job_id]
+
+    def get(self, job_id: str) -> Optional[Dict]:
+        """Estado de un trabajo: fase, tiempo transcurrido y memoria pico"""
+        job = self._jobs.get(job_id)
+        if job is None:
+            return None
+        end = job['finished'] or time.time()
+        status = {k: v for k, v in job.items() if k not in ('started', 'finished')}
+        status['elapsed_seconds'] = round(end - job['started'], 2)
+        return status
+
+    def list(self) -> List[Dict]:
+        """Todos los trabajos recordados, del más reciente al más antiguo"""
+        return [self.get(job_id) for job_id in reversed(list(self._jobs))]
@@ -0,0 +1,187 @@
+"""
+Estadísticas de usuarios por película (avg_user_rating, user_rating_count) incrementales.
+
+En lugar de agrupar toda la tabla user_movies en cada entrenamiento, se guarda junto al
+modelo un acumulador suma/recuento por película con una marca de agua (id del último
+evento agregado). Cada refresco agrega solo los eventos de user_movie_rating_events
+posteriores a la marca. Esa tabla la alimenta un trigger de user_movies (ver
+database/init.sql, o database/migrate_user_movie_rating_events.sql en BDs existentes) con deltas +rating/+1 en altas, -rating/-1 en bajas y ambos en cambios
+de valoración, así que las medias siguen siendo exactas aunque las valoraciones se
+escriban con UPDATE.
+
+Los ids se asignan al insertar pero las transacciones confirman en otro orden: un evento
+con id menor puede hacerse visible después de otro mayor. Por eso el refresco solo agrega
+eventos insertados hace más de lag_seconds (KNN_USER_STATS_LAG_SECONDS); una transacción
+de valoración que tarde más que eso en confirmar sí podría quedar fuera. El agregado inicial
+usa la misma marca retrasada y descuenta los eventos posteriores ya visibles en user_movies,
+que el primer refresco volverá a sumar.
+
+Si la tabla de eventos no existe se vuelve al GROUP BY completo.
+"""
+
+import os
+import logging
+from typing import Optional
+
+import numpy as np
+import pandas as pd
+
+logger = logging.getLogger(__name__)
+
+# Un solo statement: el GROUP BY, la marca de agua y los eventos pendientes salen de la misma snapshot
+BOOTSTRAP_QUERY = """
+    WITH snapshot AS (
+        SELECT MAX(id) AS watermark
+        FROM user_movie_rating_events
+        WHERE created_at < now() - %s * INTERVAL '1 second'
+    ),
+    totals AS (
+        SELECT movie_id, SUM(rating) AS rating_sum, COUNT(rating) AS rating_count
+        FROM user_movies
+        WHERE rating IS NOT NULL
+        GROUP BY movie_id
+    ),
+    pending AS (
+        SELECT movie_id, SUM(rating_sum_delta) AS rating_sum, SUM(rating_count_delta) AS rating_count
+        FROM user_movie_rating_events
+        WHERE id > COALESCE((SELECT watermark FROM snapshot), -1)
+        GROUP BY movie_id
+    )
+    SELECT
+        COALESCE(totals.movie_id, pending.movie_id) AS movie_id,
+        COALESCE(totals.rating_sum, 0) - COALESCE(pending.rating_sum, 0) AS rating_sum,
+        COALESCE(totals.rating_count, 0) - COALESCE(pending.rating_count, 0) AS rating_count,
+        (SELECT watermark FROM snapshot) AS watermark
+    FROM totals
+    FULL OUTER JOIN pending ON pending.movie_id = totals.movie_id
+"""
+
+REFRESH_QUERY = """
+    SELECT
+        movie_id,
+        SUM(rating_sum_delta) AS rating_sum,
+        SUM(rating_count_delta) AS rating_count,
+        MAX(id) AS watermark
+    FROM user_movie_rating_events
+    WHERE id > %s
+      AND created_at < now() - %s * INTERVAL '1 second'
+    GROUP BY movie_id
+"""
+
+WATERMARK_QUERY = """
+    SELECT MAX(id)
+    FROM user_movie_rating_events
+    WHERE created_at < now() - %s * INTERVAL '1 second'
+"""
+
+
+class UserStatsAccumulator:
+    """Suma y recuento de valoraciones por película, ordenados por movie_id"""
+
+    def __init__(self, path: str, lag_seconds: float = 60):
+        self.path = path
+        self.lag_seconds = lag_seconds  # Solo se agregan eventos más antiguos que esto
+        self.movie_ids = np.empty(0, dtype=np.int64)
+        self.rating_sums = np.empty(0, dtype=np.float64)
+        self.rating_counts = np.empty(0, dtype=np.int64)
+        self.watermark = None  # id del último evento agregado
+
+    @classmethod
+    def load(cls, path: str, lag_seconds: float = 60) -> Optional['UserStatsAccumulator']:
+        """Cargar el acumulador guardado, o None si no existe o no se puede leer"""
+        if not path or not os.path.exists(path):
+            return None
+        try:
+            accumulator = cls(path, lag_seconds)
+            with np.load(path) as data:
+                accumulator.movie_ids = data['movie_ids']
+                accumulator.rating_sums = data['rating_sums']
+                accumulator.rating_counts = data['rating_counts']
+                watermark = data['watermark']
+            if watermark.dtype.kind not in 'iu':
+                # Acumuladores con marca de agua por created_at: se vuelven a agregar desde cero
+                logger.warning(f"⚠️ Acumulador de estadísticas {path} con marca de agua antigua, se reconstruye")
+                return None
+            accumulator.watermark = int(watermark) if watermark >= 0 else None
+            return accumulator
+        except Exception as e:
+            logger.warning(f"⚠️ No se pudo leer el acumulador de estadísticas {path}: {e}")
+            return None
+
+    def save(self):
+        """Guardar el acumulador (escritura atómica por renombrado)"""
+        tmp_path = f"{self.path}.tmp-{os.getpid()}.npz"
+        np.savez(
+            tmp_path,
+            movie_ids=self.movie_ids,
+            rating_sums=self.rating_sums,
+            rating_counts=self.rating_counts,
+            watermark=np.array(-1 if self.watermark is None else self.watermark, dtype=np.int64)
+        )
+        os.replace(tmp_path, self.path)
+
+    def bootstrap(self, connection):
+        """Agregado completo de user_movies (primera vez o resincronización)"""
+        with connection.cursor() as cursor:
+            cursor.execute(BOOTSTRAP_QUERY, (self.lag_seconds,))
+            rows = cursor.fetchall()
+            watermark = rows[0][3] if rows else None
+            if watermark is None:
+                cursor.execute(WATERMARK_QUERY, (self.lag_seconds,))
+                watermark = cursor.fetchone()[0]
+
+        # Películas cuyas valoraciones son todas posteriores a la marca: las sumará el refresco
+        movie_ids, rating_sums, rating_counts = self._rows_to_arrays(rows)
+        keep = rating_counts > 0
+        self.movie_ids, self.rating_sums, self.rating_counts = movie_ids[keep], rating_sums[keep], rating_counts[keep]
+        self.watermark = None if watermark is None else int(watermark)  # None = todavía no hay eventos
+        logger.info(f"✅ Estadísticas de usuarios agregadas desde cero: {len(self.movie_ids)} películas")
+
+    def refresh(self, connection) -> int:
+        """Aplicar los eventos posteriores a la marca de agua; devuelve cuántas películas cambiaron"""
+        with connection.cursor() as cursor:
+            cursor.execute(REFRESH_QUERY, (-1 if self.watermark is None else self.watermark, self.lag_seconds))
+            rows = cursor.fetchall()
+        if not rows:
+            return 0
+
+        movie_ids, rating_sums, rating_counts = self._rows_to_arrays(rows)
+        self.apply_deltas(movie_ids, rating_sums, rating_counts)
+        self.watermark = int(max(row[3] for row in rows))
+        return len(movie_ids)
+
+    def apply_deltas(self, movie_ids: np.ndarray, rating_sums: np.ndarray, rating_counts: np.ndarray):
+        """Sumar deltas por película (las películas nuevas se insertan en orden)"""
+        all_ids = np.union1d(self.movie_ids, movie_ids)
+        sums = np.zeros(len(all_ids), dtype=np.float64)
+        counts = np.zeros(len(all_ids), dtype=np.int64)
+        existing = np.searchsorted(all_ids, self.movie_ids)
+        sums[existing], counts[existing] = self.rating_sums, self.rating_counts
+        changed = np.searchsorted(all_ids, movie_ids)
+        np.add.at(sums, changed, rating_sums)
+        np.add.at(counts, changed, rating_counts)
+
+        # Películas sin valoraciones tras las bajas: fuera del acumulador
+        keep = counts > 0
+        self.movie_ids, self.rating_sums, self.rating_counts = all_ids[keep], sums[keep], counts[keep]
+
+    def to_frame(self) -> pd.DataFrame:
+        """Estadísticas en el formato que espera _add_user_statistics"""
+        return pd.DataFrame({
+            'movie_id': self.movie_ids,
+            'avg_user_rating': self.rating_sums / np.maximum(self.rating_counts, 1),
+            'user_rating_count': self.rating_counts
+        })
+
+    @staticmethod
+    def _rows_to_arrays(rows):
+        """Filas (movie_id, suma, recuento, ...) a arrays ordenados por movie_id"""
+        if not rows:
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float64), np.empty(0, dtype=np.int64)
+        movie_ids, rating_sums, rating_counts = (list(column) for column in zip(*(row[:3] for row in rows)))
+        order = np.argsort(np.asarray(movie_ids, dtype=np.int64), kind='stable')
+        return (
+            np.asarray(movie_ids, dtype=np.int64)[order],
+            np.asarray(rating_sums, dtype=np.float64)[order],
+            np.asarray(rating_counts, dtype=np.int64)[order]
+        )
@@ -0,0 +1,232 @@
+"""
+Contabilidad de memoria para /debug/memory de las APIs FastAPI (KNN y ML).
+
+- object_report: tamaño profundo de los atributos grandes de un objeto (el servicio KNN,
+  el dict del modelo ML), con el desglose por columna de los DataFrames.
+- process_memory: RSS actual y pico del proceso.
+- TracemallocDiff: top-N de líneas cuyas asignaciones más han crecido entre dos snapshots.
+
+Los arrays compartidos (p. ej. la matriz de características que también guarda el motor
+de búsqueda) se cuentan una sola vez, en el primer atributo que los referencia. Los
+arrays abiertos con mmap se cuentan aparte como 'mapped_bytes': sus páginas las respalda
+el archivo y solo ocupan RSS las que se han leído.
+
+Los servicios knn/ y models/ se despliegan por separado, así que cada uno lleva una
+copia idéntica de este archivo.
+"""
+
+import os
+import sys
+import threading
+import tracemalloc
+import types
+from typing import Dict, Iterable, Optional
+
+import numpy as np
+import pandas as pd
+
+try:
+    import resource  # Solo Unix
+except ImportError:
+    resource = None
+
+# Objetos que no guardan datos propios: no se recorren
+_OPAQUE_TYPES = (type(threading.Lock()), type(threading.RLock()), types.ModuleType)
+
+
+class _SizeWalker:
+    """Recorrido en profundidad que suma bytes sin contar dos veces el mismo objeto"""
+
+    def __init__(self):
+        self.seen = set()
+        self.mapped = 0
+        self._temporaries = []  # Objetos creados durante el recorrido: vivos para que su id no se reutilice
+
+    def size(self, obj) -> int:
+        if id(obj) in self.seen:
+            return 0
+        self.seen.add(id(obj))
+
+        if isinstance(obj, np.ndarray):
+            return self._array_size(obj)
+        if isinstance(obj, pd.DataFrame):
+            return int(obj.memory_usage(deep=True).sum())
+        if isinstance(obj, (pd.Series, pd.Index)):
+            return int(obj.memory_usage(deep=True))
+        if isinstance(obj, (str, bytes, int, float, bool, type(None))):
+            return sys.getsizeof(obj)
+        if isinstance(obj, dict):
+            return sys.getsizeof(obj) + sum(self.size(key) + self.size(value) for key, value in list(obj.items()))
+        if isinstance(obj, (list, tuple, set, frozenset)):
+            return sys.getsizeof(obj) + sum(self.size(item) for item in list(obj))
+        if isinstance(obj, _OPAQUE_TYPES) or callable(obj):
+            return 0
+        # Árboles de sklearn (Cython, sin __dict__): KDTree/BallTree y Tree de los RandomForest
+        if hasattr(obj, 'get_arrays'):
+            return sys.getsizeof(obj) + self._temporary_size(obj.get_arrays())
+        if type(obj).__name__ == 'Tree' and hasattr(obj, '__getstate__'):
+            return sys.getsizeof(obj) + self._temporary_size(obj.__getstate__())
+        if hasattr(obj, '__dict__'):
+            return sys.getsizeof(obj) + self.size(vars(obj))
+        return sys.getsizeof(obj)
+
+    def _temporary_size(self, obj) -> int:
+        self._temporaries.append(obj)
+        return self.size(obj)
+
+    def _array_size(self, array: np.ndarray) -> int:
+        # Las vistas cuentan el buffer del array base (una vez)
+        root = array
+        while isinstance(root.base, np.ndarray):
+            root = root.base
+        if root is not array:
+            if id(root) in self.seen:
+                return 0
+            self.seen.add(id(root))
+        if isinstance(root, np.memmap) or (root.base is not None and type(root.base).__name__ == 'mmap'):
+            self.mapped += root.nbytes
+            return 0
+        if root.dtype == object:
+            return root.nbytes + sum(self.size(item) for item in root.ravel().tolist())
+        return root.nbytes
+
+
+def _mb(size: int) -> float:
+    return round(size / (1024 * 1024), 3)
+
+
+def object_report(obj, skip: Iterable[str] = (), min_bytes: int = 1024,
+                  overrides: Optional[Dict[str, int]] = None) -> Dict:
+    """
+    Tamaño de cada atributo (o clave, si obj es un dict) de más de min_bytes, de mayor a menor.
+    overrides: tamaños ya contabilizados por el propio objeto (p. ej. la caché LRU) que no
+    se recorren.
+    """
+    walker = _SizeWalker()
+    overrides = overrides or {}
+    items = obj.items() if isinstance(obj, dict) else vars(obj).items()
+    entries = []
+    for name, value in list(items):
+        if name in skip or name in overrides or value is None:
+            continue
+        mapped_before = walker.mapped
+        size = walker.size(value)
+        mapped = walker.mapped - mapped_before
+        if size < min_bytes and mapped < min_bytes:
+            continue
+        entry = {'name': name, 'type': type(value).__name__, 'bytes': size, 'mb': _mb(size)}
+        if mapped:
+            entry['mapped_bytes'] = mapped
+            entry['mapped_mb'] = _mb(mapped)
+        if isinstance(value, pd.DataFrame):
+            entry['columns'] = {
+                str(column): int(column_bytes)
+                for column, column_bytes in value.memory_usage(deep=True).sort_values(ascending=False).items()
+            }
+        if isinstance(value, np.ndarray):
+            entry['shape'] = list(value.shape)
+            entry['dtype'] = str(value.dtype)
+        entries.append(entry)
+    for name, size in overrides.items():
+        entries.append({'name': name, 'type': 'accounted', 'bytes': size, 'mb': _mb(size)})
+
+    entries.sort(key=lambda entry: entry['bytes'] + entry.get('mapped_bytes', 0), reverse=True)
+    total = sum(entry['bytes'] for entry in entries)
+    mapped_total = sum(entry.get('mapped_bytes', 0) for entry in entries)
+    return {'objects': entries, 'total_mb': _mb(total), 'mapped_mb': _mb(mapped_total)}
+
+
+def process_memory() -> Dict:
+    """RSS actual y pico (VmRSS/VmHWM de /proc; fuera de Linux solo el pico de getrusage; None si no hay ninguno)"""
+    memory = {'rss_mb': None, 'peak_rss_mb': None}
+    try:
+        with open('/proc/self/status') as status:
+            for line in status:
+                if line.startswith('VmRSS:'):
+                    memory['rss_mb'] = round(int(line.split()[1]) / 1024, 1)
+                elif line.startswith('VmHWM:'):
+                    memory['peak_rss_mb'] = round(int(line.split()[1]) / 1024, 1)
+    except OSError:
+        pass
+    if memory['peak_rss_mb'] is None and resource is not None:
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        memory['peak_rss_mb'] = round(peak / (1024 * 1024 if sys.platform == 'darwin' else 1024), 1)
+    memory['tracemalloc'] = tracemalloc.is_tracing()
+    return memory
+
+
+class TracemallocDiff:
+    """
+    Diferencia de asignaciones entre snapshots de tracemalloc: start toma la referencia,
+    cada diff compara con la anterior y pasa a ser la nueva referencia, stop lo apaga.
+    tracemalloc ralentiza las asignaciones mientras está activo: solo para diagnosticar.
+    """
+
+    _FILTERS = (
+        tracemalloc.Filter(False, tracemalloc.__file__),
+        tracemalloc.Filter(False, '<frozen importlib._bootstrap>'),
+        tracemalloc.Filter(False, '<frozen importlib._bootstrap_external>'),
+        tracemalloc.Filter(False, '<unknown>'),
+    )
+
+    def __init__(self):
+        self._snapshot = None
+        self._lock = threading.Lock()
+
+    def _take(self):
+        return tracemalloc.take_snapshot().filter_traces(self._FILTERS)
+
+    def start(self, frames: int = 1) -> Dict:
+        with self._lock:
+            if not tracemalloc.is_tracing():
+                tracemalloc.start(frames)
+            self._snapshot = self._take()
+        return {'tracing': True, 'traced_mb': _mb(tracemalloc.get_traced_memory()[0])}
+
+    def diff(self, top: int = 20) -> Dict:
+        with self._lock:
+            if not tracemalloc.is_tracing() or self._snapshot is None:
+                return {'tracing': False, 'top': []}
+            snapshot = self._take()
+            stats = snapshot.compare_to(self._snapshot, 'lineno')
+            self._snapshot = snapshot
+        current, peak = tracemalloc.get_traced_memory()
+        return {
+            'tracing': True,
+            'traced_mb': _mb(current),
+            'traced_peak_mb': _mb(peak),
+            'top': [
+                {
+                    'location': f"{os.path.basename(stat.traceback[0].filename)}:{stat.traceback[0].lineno}",
+                    'size_diff_kb': round(stat.size_diff / 1024, 1),
+                    'size_kb': round(stat.size / 1024, 1),
+                    'count_diff': stat.count_diff
+                }
+                for stat in stats[:top]
+            ]
+        }
+
+    def stop(self) -> Dict:
+        with self._lock:
+            tracemalloc.stop()
+            self._snapshot = None
+        return {'tracing': False}
+
+    def handle(self, action: Optional[str], top: int = 20) -> Optional[Dict]:
+        """Acción del parámetro trace de /debug/memory: start, diff, stop o None"""
+        if action == 'start':
+            return self.start()
+        if action == 'diff':
+            return self.diff(top)
+        if action == 'stop':
+            return self.stop()
+        return None
+
+
+def memory_report(objects: Dict[str, Dict], tracer: Optional[TracemallocDiff] = None,
+                  trace: Optional[str] = None, top: int = 20) -> Dict:
+    """Respuesta de /debug/memory: proceso, objetos residentes y (opcional) diff de tracemalloc"""
+    report = {'process': process_memory(), 'resident': objects}
+    if tracer is not None and trace:
+        report['tracemalloc'] = tracer.handle(trace, top)
+    return report
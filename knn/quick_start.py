@@ -43,27 +43,17 @@ def check_database_connection():
     print("\n📊 Verificando conexión a la base de datos...")
     
     try:
-        import psycopg2
-        
-        # Usar variables de entorno o valores por defecto
-        db_host = os.getenv('DB_HOST', 'localhost')
-        db_name = os.getenv('DB_NAME', 'MovieMatch')
-        db_user = os.getenv('DB_USER', 'postgres')
-        db_password = os.getenv('DB_PASSWORD', 'admin')
-        db_port = os.getenv('DB_PORT', '5432')
+        from db_pool import database_settings, get_database_pool
         
-        print(f"🔌 Conectando a: {db_host}:{db_port}/{db_name}")
+        settings = database_settings()
+        print(f"🔌 Conectando a: {settings['host']}:{settings['port']}/{settings['database']}")
         
-        connection = psycopg2.connect(
-            host=db_host,
-            database=db_name,
-            user=db_user,
-            password=db_password,
-            port=db_port
-        )
+        db_pool = get_database_pool()
+        if db_pool is None:
+            raise RuntimeError("No se pudo crear el pool de conexiones")
         
         # Verificar que hay datos
-        with connection.cursor() as cursor:
+        with db_pool.connection() as connection, connection.cursor() as cursor:
             cursor.execute("SELECT COUNT(*) FROM movies")
             movie_count = cursor.fetchone()[0]
             
@@ -73,8 +63,6 @@ def check_database_connection():
             cursor.execute("SELECT COUNT(*) FROM users")
             user_count = cursor.fetchone()[0]
         
-        connection.close()
-        
         print(f"✅ Conexión exitosa a la base de datos")
         print(f"📊 Datos disponibles:")
         print(f"   - Películas: {movie_count}")
@@ -0,0 +1,165 @@
+"""
+Perfilado bajo demanda de peticiones concretas para las APIs FastAPI (KNN y ML).
+
+Una petición se perfila si:
+- trae X-Profile: 1 (o ?profile=1) junto con un X-Admin-Token válido, o
+- la elige el muestreo aleatorio (<PREFIJO>_PROFILE_SAMPLE_RATE, 0 por defecto).
+
+El perfilador es estadístico: mientras dura la petición, un hilo toma la pila de todos
+los hilos del proceso cada <PREFIJO>_PROFILE_INTERVAL_MS. El trabajo pesado corre en
+los hilos del executor y no en el del handler, así que cProfile en el hilo del handler
+no lo vería. Las pilas se guardan en formato collapsed ("hilo;archivo:función;... N"),
+que leen flamegraph.pl y speedscope, en <PREFIJO>_PROFILE_DIR/<id>.collapsed. La
+respuesta lleva el id en la cabecera X-Profile-Id.
+
+Con el perfilado apagado (sin token de administrador y sin muestreo) el middleware no
+hace nada más que pasar la petición. El muestreo abarca todo el proceso, así que se
+perfila una petición a la vez: las que coinciden con una en curso no se perfilan.
+
+Los servicios knn/ y models/ se despliegan por separado, así que cada uno lleva una
+copia idéntica de este archivo.
+"""
+
+import hmac
+import logging
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+import uuid
+from collections import Counter
+from typing import Optional
+
+logger = logging.getLogger(__name__)
+
+# Hojas de pila de hilos ociosos: worker esperando tarea, event loop en select, esperas de Event/join
+IDLE_LEAVES = {("thread.py", "_worker"), ("selectors.py", "select"), ("threading.py", "wait"),
+               ("threading.py", "_wait_for_tstate_lock")}
+
+
+class StackSampler:
+    """Muestreo periódico de las pilas de todos los hilos del proceso"""
+
+    def __init__(self, interval: float, max_seconds: float):
+        self.interval = interval
+        self.max_seconds = max_seconds
+        self.stacks: Counter = Counter()
+        self.samples = 0
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="request-profiler", daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+    def _run(self):
+        own_ident = threading.get_ident()
+        thread_names = {}
+        deadline = time.monotonic() + self.max_seconds
+        while not self._stop.wait(self.interval) and time.monotonic() < deadline:
+            self.samples += 1
+            for ident, frame in sys._current_frames().items():
+                if ident == own_ident:
+                    continue
+                code = frame.f_code
+                if (os.path.basename(code.co_filename), code.co_name) in IDLE_LEAVES:
+                    continue
+                frames = []
+                while frame is not None:
+                    code = frame.f_code
+                    frames.append(f"{os.path.basename(code.co_filename)}:{code.co_name}")
+                    frame = frame.f_back
+                if ident not in thread_names:
+                    thread_names.update((thread.ident, thread.name) for thread in threading.enumerate())
+                frames.append(thread_names.get(ident, str(ident)))
+                frames.reverse()
+                self.stacks[";".join(frames)] += 1
+
+    def collapsed(self) -> str:
+        return "".join(f"{stack} {count}\n" for stack, count in self.stacks.most_common())
+
+
+class ProfilingMiddleware:
+    """Middleware ASGI que perfila las peticiones que lo piden (o las elegidas por muestreo)"""
+
+    def __init__(self, app, output_dir: str, admin_token: Optional[str] = None, sample_rate: float = 0.0,
+                 interval: float = 0.002, max_seconds: float = 60.0):
+        self.app = app
+        self.output_dir = output_dir
+        self.admin_token = admin_token
+        self.sample_rate = sample_rate
+        self.interval = interval
+        self.max_seconds = max_seconds
+        self.enabled = bool(admin_token) or sample_rate > 0
+        self._busy = threading.Lock()  # Una petición perfilada a la vez
+
+    async def __call__(self, scope, receive, send):
+        if not self.enabled or scope["type"] != "http" or not self._wants_profile(scope):
+            await self.app(scope, receive, send)
+            return
+        if not self._busy.acquire(blocking=False):
+            await self.app(scope, receive, send)
+            return
+
+        profile_id = uuid.uuid4().hex[:12]
+
+        async def send_with_profile_id(message):
+            if message["type"] == "http.response.start":
+                message = dict(message)
+                message["headers"] = list(message.get("headers", [])) + [(b"x-profile-id", profile_id.encode())]
+            await send(message)
+
+        sampler = StackSampler(self.interval, self.max_seconds)
+        start = time.perf_counter()
+        sampler.start()
+        try:
+            await self.app(scope, receive, send_with_profile_id)
+        finally:
+            sampler.stop()
+            elapsed_ms = (time.perf_counter() - start) * 1000
+            self._busy.release()
+            self._write(profile_id, scope, sampler, elapsed_ms)
+
+    def _wants_profile(self, scope) -> bool:
+        if self.sample_rate > 0 and random.random() < self.sample_rate:
+            return True
+        if not self.admin_token:
+            return False
+        requested, token = False, ""
+        for name, value in scope["headers"]:
+            if name == b"x-profile":
+                requested = value in (b"1", b"true")
+            elif name == b"x-admin-token":
+                token = value.decode("latin-1")
+        if not requested:
+            requested = b"profile=1" in scope.get("query_string", b"").split(b"&")
+        return requested and hmac.compare_digest(token, self.admin_token)
+
+    def _write(self, profile_id: str, scope, sampler: StackSampler, elapsed_ms: float):
+        path = os.path.join(self.output_dir, f"{profile_id}.collapsed")
+        try:
+            os.makedirs(self.output_dir, exist_ok=True)
+            with open(path, "w") as profile_file:
+                profile_file.write(sampler.collapsed())
+            logger.info(f"🔥 Perfil {profile_id}: {scope['method']} {scope['path']} {elapsed_ms:.1f} ms, "
+                        f"{sampler.samples} muestras -> {path}")
+        except OSError as e:
+            logger.error(f"❌ Error guardando el perfil {profile_id}: {e}")
+
+
+def add_request_profiling(app, env_prefix: str, admin_token: Optional[str] = None):
+    """Añadir el middleware de perfilado configurado con <env_prefix>_PROFILE_*"""
+    app.add_middleware(
+        ProfilingMiddleware,
+        output_dir=os.getenv(f"{env_prefix}_PROFILE_DIR",
+                             os.path.join(tempfile.gettempdir(), f"{env_prefix.lower()}-profiles")),
+        admin_token=admin_token,
+        sample_rate=float(os.getenv(f"{env_prefix}_PROFILE_SAMPLE_RATE", 0)),
+        interval=float(os.getenv(f"{env_prefix}_PROFILE_INTERVAL_MS", 2)) / 1000,
+        max_seconds=float(os.getenv(f"{env_prefix}_PROFILE_MAX_SECONDS", 60))
+    )
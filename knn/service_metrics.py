@@ -0,0 +1,283 @@
+"""
+Métricas en formato de texto de Prometheus para las APIs FastAPI (KNN y ML).
+
+- Por endpoint (plantilla de la ruta, p. ej. /train-model/{job_id}): histograma de
+  latencia, contador de peticiones por código de estado, contador de errores (5xx o
+  excepción) y peticiones en curso.
+- Por etapa del pipeline: histograma de duración de los bloques marcados con
+  stage('nombre') o @timed_stage('nombre').
+- Colectores: funciones que devuelven valores ya existentes (executor, caché, pool)
+  y se leen solo al pedir /metrics.
+
+Registrar una muestra es un perf_counter, un bisect y una suma bajo un lock (~1 µs),
+sin dependencias externas. Las métricas son del proceso: con KNN_EXECUTOR_KIND=process
+las etapas que corren en los procesos de cómputo no aparecen en /metrics de la API.
+
+Los servicios knn/ y models/ se despliegan por separado, así que cada uno lleva una
+copia idéntica de este archivo.
+"""
+
+import threading
+import time
+from bisect import bisect_left
+from functools import wraps
+from typing import Callable, Dict, List, Tuple
+
+# Desde 100 µs (slice de la tabla de vecinos) hasta 10 s (evaluación, predicción en lote grande)
+LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+                   0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_labels(names: Tuple[str, ...], values: Tuple, extra: str = "") -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    """Contador monótono con etiquetas"""
+
+    kind = "counter"
+
+    def __init__(self, name: str, documentation: str, labels: Tuple[str, ...] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = labels
+        self._values: Dict[Tuple, float] = {}
+        self._lock = threading.Lock()
+
+    def inc(self, *label_values, amount: float = 1):
+        with self._lock:
+            self._values[label_values] = self._values.get(label_values, 0) + amount
+
+    def samples(self, name: str) -> List[str]:
+        with self._lock:
+            values = list(self._values.items())
+        return [f"{name}{_format_labels(self.labels, key)} {_format_value(value)}" for key, value in values]
+
+
+class Gauge(Counter):
+    """Valor que sube y baja (p. ej. peticiones en curso)"""
+
+    kind = "gauge"
+
+    def dec(self, *label_values, amount: float = 1):
+        self.inc(*label_values, amount=-amount)
+
+
+class Histogram:
+    """Histograma de cubetas fijas con etiquetas (cuentas no acumuladas; se acumulan al exportar)"""
+
+    kind = "histogram"
+
+    def __init__(self, name: str, documentation: str, labels: Tuple[str, ...] = (),
+                 buckets: Tuple[float, ...] = LATENCY_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labels = labels
+        self.buckets = tuple(buckets)
+        self._series: Dict[Tuple, list] = {}  # etiquetas -> [cuentas por cubeta (+Inf al final), suma]
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, *label_values):
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(label_values)
+            if series is None:
+                series = self._series[label_values] = [[0] * (len(self.buckets) + 1), 0.0]
+            series[0][index] += 1
+            series[1] += value
+
+    def samples(self, name: str) -> List[str]:
+        with self._lock:
+            series = [(key, list(counts), total) for key, (counts, total) in self._series.items()]
+        lines = []
+        for key, counts, total in series:
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += count
+                le = 'le="' + _format_value(bound) + '"'
+                lines.append(f"{name}_bucket{_format_labels(self.labels, key, le)} {cumulative}")
+            lines.append(f"{name}_sum{_format_labels(self.labels, key)} {_format_value(total)}")
+            lines.append(f"{name}_count{_format_labels(self.labels, key)} {cumulative}")
+        return lines
+
+
+class MetricsRegistry:
+    """Métricas del proceso y su exportación en formato de texto de Prometheus"""
+
+    def __init__(self, namespace: str = ""):
+        self.namespace = namespace
+        self._metrics: List = []
+        self._collectors: List[Callable[[], List[Tuple]]] = []
+        self.requests = self.counter("http_requests_total", "Peticiones HTTP por endpoint y código", ("method", "path", "status"))
+        self.errors = self.counter("http_request_errors_total", "Peticiones con error (5xx o excepción)", ("method", "path"))
+        self.in_flight = self.gauge("http_requests_in_flight", "Peticiones en curso", ("method", "path"))
+        self.latency = self.histogram("http_request_duration_seconds", "Latencia por endpoint", ("method", "path"))
+        self.stages = self.histogram("stage_duration_seconds", "Duración por etapa del pipeline", ("stage",))
+
+    def counter(self, name: str, documentation: str, labels: Tuple[str, ...] = ()) -> Counter:
+        return self._register(Counter(name, documentation, labels))
+
+    def gauge(self, name: str, documentation: str, labels: Tuple[str, ...] = ()) -> Gauge:
+        return self._register(Gauge(name, documentation, labels))
+
+    def histogram(self, name: str, documentation: str, labels: Tuple[str, ...] = (),
+                  buckets: Tuple[float, ...] = LATENCY_BUCKETS) -> Histogram:
+        return self._register(Histogram(name, documentation, labels, buckets))
+
+    def _register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def add_collector(self, collector: Callable[[], List[Tuple]]):
+        """
+        collector() -> [(nombre, 'gauge'|'counter', ayuda, [(etiquetas dict, valor), ...]), ...]
+        Se llama en cada /metrics; un colector que falla no rompe la exportación.
+        """
+        self._collectors.append(collector)
+
+    def _full_name(self, name: str) -> str:
+        return f"{self.namespace}_{name}" if self.namespace else name
+
+    def render(self) -> str:
+        lines = []
+        for metric in self._metrics:
+            name = self._full_name(metric.name)
+            lines.append(f"# HELP {name} {metric.documentation}")
+            lines.append(f"# TYPE {name} {metric.kind}")
+            lines.extend(metric.samples(name))
+        for collector in self._collectors:
+            try:
+                families = collector()
+            except Exception:
+                continue
+            for metric_name, kind, documentation, samples in families:
+                name = self._full_name(metric_name)
+                lines.append(f"# HELP {name} {documentation}")
+                lines.append(f"# TYPE {name} {kind}")
+                for labels, value in samples:
+                    if value is None:
+                        continue
+                    lines.append(f"{name}{_format_labels(tuple(labels), tuple(labels.values()))} {_format_value(value)}")
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = MetricsRegistry()
+
+
+class stage:
+    """
+    Medir un bloque como etapa del pipeline:
+
+        with stage("neighbor_table"):
+            ...
+    """
+
+    __slots__ = ("name", "_start")
+
+    def __init__(self, name: str):
+        self.name = name
+
+    def __enter__(self):
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        REGISTRY.stages.observe(time.perf_counter() - self._start, self.name)
+        return False
+
+
+def timed_stage(name: str):
+    """Decorador equivalente a envolver toda la función en stage(name)"""
+    def decorator(fn):
+        @wraps(fn)
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                REGISTRY.stages.observe(time.perf_counter() - start, name)
+        return wrapper
+    return decorator
+
+
+class MetricsMiddleware:
+    """Middleware ASGI: latencia, código de estado, errores y peticiones en curso por endpoint"""
+
+    def __init__(self, app, registry: MetricsRegistry = REGISTRY, skip_paths: Tuple[str, ...] = ("/metrics",)):
+        self.app = app
+        self.registry = registry
+        self.skip_paths = skip_paths
+        self._static_paths = None
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["path"] in self.skip_paths:
+            await self.app(scope, receive, send)
+            return
+
+        registry = self.registry
+        method = scope["method"]
+        status = [500]
+
+        async def send_with_status(message):
+            if message["type"] == "http.response.start":
+                status[0] = message["status"]
+            await send(message)
+
+        in_flight_path = self._in_flight_path(scope)
+        registry.in_flight.inc(method, in_flight_path)
+        start = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_with_status)
+        except Exception:
+            status[0] = 500
+            raise
+        finally:
+            elapsed = time.perf_counter() - start
+            registry.in_flight.dec(method, in_flight_path)
+            route = scope.get("route")
+            # Plantilla de la ruta para no crear una serie por id; lo que no casa va junto
+            path = getattr(route, "path", None) or "unmatched"
+            registry.latency.observe(elapsed, method, path)
+            registry.requests.inc(method, path, str(status[0]))
+            if status[0] >= 500:
+                registry.errors.inc(method, path)
+
+    def _in_flight_path(self, scope) -> str:
+        """
+        La plantilla de la ruta solo se conoce tras el routing: mientras la petición está en
+        curso se usa la ruta cruda si es una ruta fija y 'dynamic' si lleva parámetros.
+        """
+        if self._static_paths is None:
+            routes = getattr(scope.get("app"), "routes", [])
+            self._static_paths = {route.path for route in routes if "{" not in getattr(route, "path", "{")}
+        path = scope["path"]
+        return path if path in self._static_paths else "dynamic"
+
+
+def instrument_app(app, namespace: str, registry: MetricsRegistry = REGISTRY):
+    """Añadir el middleware de métricas y GET /metrics a una app FastAPI"""
+    from fastapi import Response
+
+    registry.namespace = namespace
+    app.add_middleware(MetricsMiddleware, registry=registry)
+
+    @app.get("/metrics", include_in_schema=False)
+    async def metrics():
+        return Response(content=registry.render(), media_type=CONTENT_TYPE)
+
+    return registry
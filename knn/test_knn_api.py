@@ -0,0 +1,96 @@
+"""
+Pruebas de la API KNN. El servicio activo se sustituye por uno cargado de un artefacto temporal.
+"""
+
+import pytest
+from fastapi.testclient import TestClient
+
+import knn_api
+from conftest import build_synthetic_service, catalog_movie
+from knn_service import EfficientKNNService
+
+
+@pytest.fixture
+def active_service(saved_model, monkeypatch):
+    """Servicio activo de la API cargado desde un artefacto temporal, con log del catálogo"""
+    monkeypatch.setenv('KNN_CATALOG_LOG', 'true')
+    service = EfficientKNNService(model_path=saved_model)
+    monkeypatch.setattr(knn_api, 'knn_service', service)
+    monkeypatch.setattr(knn_api, 'model_state', dict(knn_api.model_state, model_path=saved_model))
+    return service
+
+
+@pytest.fixture
+def client(active_service):
+    return TestClient(knn_api.app)  # Sin 'with': no se lanza el startup que carga el modelo por defecto
+
+
+def test_reload_swaps_active_service(active_service, tmp_path):
+    new_path = str(tmp_path / "knn_model_v2")
+    build_synthetic_service(n_movies=250, seed=11).save_knn_model(new_path)
+
+    result = knn_api.reload_knn_service(new_path)
+    assert result['previous_version'] == active_service.model_version
+    assert knn_api.knn_service is not active_service
+    assert len(knn_api.knn_service.movie_ids) == 250
+    assert knn_api.model_state['model_path'] == new_path
+    assert knn_api.model_state['model_version'] == knn_api.knn_service.model_version
+
+
+def test_failed_reload_keeps_active_service(active_service, tmp_path):
+    broken_path = tmp_path / "knn_model.pkl"
+    broken_path.write_bytes(b"no es un modelo")
+    with pytest.raises(ValueError):
+        knn_api.reload_knn_service(str(broken_path))
+    assert knn_api.knn_service is active_service
+    assert knn_api.model_state['last_reload_error']
+
+
+def test_reload_keeps_catalog_updates(active_service, saved_model):
+    knn_api._apply_catalog_update('upsert_movies', [catalog_movie(1)])
+    knn_api._apply_catalog_update('delete_movies', [int(active_service.movie_ids[0])])
+
+    knn_api.reload_knn_service(saved_model)
+    reloaded = knn_api.knn_service
+    assert reloaded is not active_service
+    assert reloaded.movie_ids.tolist() == active_service.movie_ids.tolist()
+    assert reloaded.compute_similar_movies(1, 5) == active_service.compute_similar_movies(1, 5)
+    assert reloaded.compute_similar_movies(int(active_service.movie_ids[0]), 5) == []
+
+
+def test_compaction_keeps_updates_made_during_retraining(active_service, monkeypatch):
+    knn_api._apply_catalog_update('delete_movies', active_service.movie_ids[[5, 6]].tolist())
+    compacted_copy = active_service.compacted_copy
+
+    def copy_with_concurrent_write():
+        copy = compacted_copy()
+        # Alta que llega mientras se reentrena: queda en el servicio viejo y en el log
+        active_service.upsert_movies([catalog_movie(2)])
+        return copy
+
+    monkeypatch.setattr(active_service, 'compacted_copy', copy_with_concurrent_write)
+    result = knn_api.compact_knn_service()
+
+    assert result['compacted'] is True
+    compacted = knn_api.knn_service
+    assert compacted is not active_service
+    assert len(compacted.movie_ids) == len(active_service.movie_ids) - 2
+    assert 2 in compacted.movie_ids.tolist()
+    assert compacted.compute_similar_movies(int(active_service.movie_ids[5]), 5) == []
+
+
+def test_similar_endpoint(client, active_service):
+    movie_id = int(active_service.movie_ids[0])
+    response = client.post("/similar", json={"movie_id": movie_id, "limit": 5})
+    assert response.status_code == 200
+    assert response.json()['similar_movies'] == active_service.compute_similar_movies(movie_id, 5)
+    # Segunda llamada: camino rápido de la caché, misma respuesta
+    assert client.post("/similar", json={"movie_id": movie_id, "limit": 5}).json() == response.json()
+
+
+def test_user_recommendations_endpoint(client, active_service):
+    watched = active_service.movie_ids[[1, 2, 3]].tolist()
+    response = client.post("/recommendations/knn", json={"user_watched_movies": watched, "limit": 7})
+    assert response.status_code == 200
+    assert response.json()['recommendations'] == active_service.get_user_recommendations(
+        limit=7, user_watched_movies=watched)
@@ -0,0 +1,127 @@
+"""
+Pruebas de ida y vuelta del artefacto sin pickle (knn_artifact.py) y del .pkl heredado.
+"""
+
+import shutil
+
+import numpy as np
+import pytest
+
+from conftest import build_synthetic_service, catalog_movie
+from knn_artifact import is_artifact_dir
+from knn_catalog import decode_strings, encode_genres, encode_strings, take_ragged
+from knn_engines import RandomProjectionLSHIndex
+from knn_service import EfficientKNNService
+
+
+def load_service(model_path: str, mmap: bool = True) -> EfficientKNNService:
+    service = EfficientKNNService(auto_load=False)
+    service.MMAP_ARTIFACTS = mmap
+    service.CATALOG_LOG_ENABLED = False
+    service.load_knn_model(model_path)
+    assert service.is_model_loaded()
+    return service
+
+
+def assert_same_service(loaded, original):
+    np.testing.assert_array_equal(loaded.movie_ids, original.movie_ids)
+    np.testing.assert_array_equal(loaded.feature_matrix, original.feature_matrix)
+    np.testing.assert_array_equal(loaded.neighbor_indices, original.neighbor_indices)
+    np.testing.assert_array_equal(loaded.neighbor_similarities, original.neighbor_similarities)
+    np.testing.assert_array_equal(loaded.genre_offsets, original.genre_offsets)
+    np.testing.assert_array_equal(loaded.genre_values, original.genre_values)
+    positions = np.arange(len(original.movie_ids))
+    assert loaded._titles(positions) == original._titles(positions)
+    assert loaded.feature_columns == original.feature_columns
+    np.testing.assert_allclose(loaded.scaler.mean_, original.scaler.mean_)
+
+    for movie_id in original.movie_ids[[0, 50, -1]].tolist():
+        assert loaded.compute_similar_movies(movie_id, 10) == original.compute_similar_movies(movie_id, 10)
+        assert loaded.compute_similar_movies(movie_id, 80) == original.compute_similar_movies(movie_id, 80)
+    history = original.movie_ids[[2, 9, 33]].tolist()
+    for mode in ('seeds', 'profile'):
+        assert (loaded.get_user_recommendations(limit=10, user_watched_movies=history, mode=mode)
+                == original.get_user_recommendations(limit=10, user_watched_movies=history, mode=mode))
+
+
+@pytest.mark.parametrize("mmap", [True, False])
+def test_artifact_round_trip(knn_service, tmp_path, mmap):
+    model_path = str(tmp_path / "knn_model")
+    knn_service.save_knn_model(model_path)
+    assert is_artifact_dir(model_path)
+
+    loaded = load_service(model_path, mmap)
+    assert loaded.model_version == knn_service.model_version
+    assert_same_service(loaded, knn_service)
+
+
+def test_artifact_round_trip_with_tombstones_and_ann(tmp_path):
+    service = build_synthetic_service(ANN_THRESHOLD=100)
+    service.upsert_movies([catalog_movie(1), catalog_movie(2, genre_ids=[])])
+    service.delete_movies(service.movie_ids[[10, 11]].tolist())
+    model_path = str(tmp_path / "knn_model")
+    service.save_knn_model(model_path)
+
+    loaded = load_service(model_path)
+    np.testing.assert_array_equal(loaded.tombstoned, service.tombstoned)
+    assert isinstance(loaded.ann_index, RandomProjectionLSHIndex)
+    np.testing.assert_array_equal(loaded.ann_index.sorted_rows, service.ann_index.to_arrays()['sorted_rows'])
+    assert loaded.ann_report == service.ann_report
+    assert_same_service(loaded, service)
+
+    # El artefacto cargado (mmap de solo lectura) admite nuevas altas
+    loaded.upsert_movies([catalog_movie(3)])
+    assert loaded.compute_similar_movies(3, 5)
+
+
+def test_artifact_publishes_versions_through_pointer(knn_service, tmp_path):
+    model_path = tmp_path / "knn_model"
+    versions = []
+    for _ in range(3):
+        knn_service.save_knn_model(str(model_path))
+        versions.append(knn_service.model_version)
+
+    assert (model_path / "CURRENT").read_text() == versions[-1]
+    assert sorted(path.name for path in (model_path / "versions").iterdir()) == sorted(versions[1:])
+    assert load_service(str(model_path)).model_version == versions[-1]
+
+
+def test_legacy_artifact_layout_is_read_and_migrated(knn_service, tmp_path):
+    model_path = tmp_path / "knn_model"
+    knn_service.save_knn_model(str(model_path))
+    version_dir = model_path / "versions" / knn_service.model_version
+    for path in version_dir.iterdir():
+        path.rename(model_path / path.name)
+    (model_path / "CURRENT").unlink()
+    shutil.rmtree(model_path / "versions")
+
+    assert_same_service(load_service(str(model_path)), knn_service)
+    knn_service.save_knn_model(str(model_path))
+    assert sorted(path.name for path in model_path.iterdir()) == ["CURRENT", "versions"]
+    assert load_service(str(model_path)).model_version == knn_service.model_version
+
+
+def test_pickle_round_trip(knn_service, tmp_path):
+    model_path = str(tmp_path / "knn_model.pkl")
+    knn_service.save_knn_model(model_path)
+    assert not is_artifact_dir(model_path)
+    assert_same_service(load_service(model_path), knn_service)
+
+
+def test_ragged_buffers():
+    titles = encode_strings(["Amélie", None, "", "Ran"])
+    assert decode_strings(titles['bytes'], titles['offsets']) == ["Amélie", "", "", "Ran"]
+    assert decode_strings(titles['bytes'], titles['offsets'], [3, 0]) == ["Ran", "Amélie"]
+
+    genres = encode_genres([[1, 2], None, [], (5,)])
+    taken = take_ragged(genres['offsets'], genres['values'], [3, 1, 0])
+    assert taken['offsets'].tolist() == [0, 1, 1, 3]
+    assert taken['values'].tolist() == [5, 1, 2]
+
+
+def test_display_columns_round_float32_to_source_decimals(knn_service):
+    knn_service.upsert_movies([catalog_movie(1, vote_average=8.051, popularity=1179.7021)])
+    position = knn_service.lookup_positions([1])
+    assert knn_service._catalog_column('vote_average').dtype == np.float32
+    assert knn_service._display_column('vote_average', position).tolist() == [8.051]
+    assert knn_service._display_column('popularity', position).tolist() == [1179.7021]
@@ -0,0 +1,72 @@
+"""
+Pruebas de la caché LRU de similares y de su invalidación por generación
+(versión del modelo + revisión del catálogo).
+"""
+
+from conftest import catalog_movie
+from knn_cache import LRUResultCache, estimate_result_bytes
+
+
+def result(movie_id: int, n: int = 3):
+    return [{'movie_id': movie_id * 10 + i, 'title': f"Película {i}", 'similarity': 0.5} for i in range(n)]
+
+
+def test_lru_eviction_by_entries_and_bytes():
+    cache = LRUResultCache(max_entries=2, max_bytes=10 ** 6)
+    cache.put(1, result(1), 'g')
+    cache.put(2, result(2), 'g')
+    assert cache.get(1, 'g') == result(1)  # 1 pasa a ser la más reciente
+    cache.put(3, result(3), 'g')
+    assert cache.get(2, 'g') is None
+    assert cache.stats()['evictions'] == 1
+
+    small = LRUResultCache(max_entries=100, max_bytes=estimate_result_bytes(result(1)) + 10)
+    small.put(1, result(1))
+    small.put(2, result(2))
+    assert small.get(1) is None and small.get(2) == result(2)
+    small.put(3, result(3, n=50))  # Mayor que el límite: no se guarda
+    assert small.get(3) is None and small.get(2) == result(2)
+
+
+def test_results_are_copies():
+    cache = LRUResultCache(max_entries=10, max_bytes=10 ** 6)
+    stored = result(1)
+    cache.put(1, stored)
+    stored[0]['title'] = "Modificada"
+    returned = cache.get(1)
+    returned[0]['score'] = 1.0
+    assert cache.get(1) == result(1)
+
+
+def test_new_generation_clears_and_stale_generation_is_ignored():
+    cache = LRUResultCache(max_entries=10, max_bytes=10 ** 6)
+    cache.put(1, result(1), ('v1', 0))
+    assert cache.get(1, ('v1', 1)) is None  # Generación nueva: caché vacía
+    cache.put(2, result(2), ('v1', 1))
+
+    # Un cálculo que empezó antes del cambio no vuelve a meter resultados ni vacía la caché
+    cache.put(1, result(1), ('v1', 0))
+    assert cache.get(1, ('v1', 0)) is None
+    assert cache.get(1, ('v1', 1)) is None
+    assert cache.get(2, ('v1', 1)) == result(2)
+
+    cache.put(3, result(3), ('v2', 0))
+    assert cache.stats()['entries'] == 1
+    assert cache.get(3, ('v2', 0)) == result(3)
+
+
+def test_catalog_update_invalidates_service_cache(knn_service):
+    movie_id = int(knn_service.movie_ids[0])
+    knn_service.find_similar_movies(movie_id, top_k=5)
+    assert knn_service.cached_similar_movies(movie_id, 5) is not None
+
+    knn_service.upsert_movies([catalog_movie(1)])
+    assert knn_service.cached_similar_movies(movie_id, 5) is None
+    assert knn_service.find_similar_movies(movie_id, 5) == knn_service.compute_similar_movies(movie_id, 5)
+
+    generation = knn_service.similar_cache_generation()
+    knn_service.delete_movies([1])
+    # Resultado calculado con la generación anterior que llega después del borrado
+    knn_service.store_similar_movies(movie_id, 7, result(1), generation=generation)
+    assert knn_service.cached_similar_movies(movie_id, 7) is None
+    assert 1 not in [movie['movie_id'] for movie in knn_service.find_similar_movies(movie_id, knn_service.NEIGHBOR_TABLE_K)]
@@ -0,0 +1,200 @@
+"""
+Pruebas de las altas/bajas incrementales del catálogo: parcheo de la tabla de vecinos,
+compactación y log de cambios reaplicado al cargar.
+"""
+
+import time
+
+import numpy as np
+import pytest
+
+from conftest import catalog_movie
+from knn_service import EfficientKNNService
+
+
+def assert_table_matches_live_query(service):
+    """Cada fila viva de la tabla parcheada coincide con una consulta completa al motor"""
+    live_rows = np.flatnonzero(service._live_mask()) if service._live_mask() is not None \
+        else np.arange(len(service.movie_ids))
+    k_max = service.neighbor_indices.shape[1]
+    indices, similarities = service._query_live_neighbors(service.feature_matrix[live_rows], k_max,
+                                                          exclude_rows=live_rows)
+    np.testing.assert_array_equal(service.neighbor_indices[live_rows], indices)
+    np.testing.assert_allclose(service.neighbor_similarities[live_rows], similarities, rtol=1e-6)
+
+
+def similar_ids(service, movie_id, top_k=10):
+    return [movie['movie_id'] for movie in service.compute_similar_movies(movie_id, top_k)]
+
+
+@pytest.fixture
+def logged_model(saved_model, monkeypatch):
+    """Artefacto en disco con el log del catálogo activado"""
+    monkeypatch.setenv('KNN_CATALOG_LOG', 'true')
+    return saved_model
+
+
+def test_upsert_adds_movies_and_patches_table(knn_service):
+    new_movies = [catalog_movie(1), catalog_movie(2, vote_count=40, popularity=3.0), catalog_movie(3, genre_ids=[])]
+    result = knn_service.upsert_movies(new_movies)
+
+    assert result == {'upserted': 3, 'replaced': 0, 'catalog_revision': 1}
+    assert len(knn_service.movie_ids) == 303
+    assert [movie['title'] for movie in knn_service.compute_similar_movies(2, 5)]
+    assert_table_matches_live_query(knn_service)
+
+
+def test_upserted_twin_is_nearest_neighbor(knn_service):
+    knn_service.upsert_movies([catalog_movie(1)])
+    knn_service.upsert_movies([catalog_movie(4)])
+    assert knn_service.find_similar_movies(4, top_k=1)[0]['movie_id'] == 1
+    nearest = knn_service.find_similar_movies(1, top_k=1)[0]
+    assert (nearest['movie_id'], nearest['title']) == (4, "Nueva 4")
+
+
+def test_upsert_existing_id_replaces_row(knn_service):
+    movie_id = int(knn_service.movie_ids[20])
+    result = knn_service.upsert_movies([catalog_movie(movie_id, title="Reeditada", vote_average=2.0)])
+
+    assert result['replaced'] == 1
+    assert knn_service.tombstoned[20]
+    assert knn_service.lookup_positions([movie_id])[0] == len(knn_service.movie_ids) - 1
+    neighbors = knn_service.compute_similar_movies(int(knn_service.movie_ids[0]), top_k=299)
+    assert [movie['title'] for movie in neighbors if movie['movie_id'] == movie_id] in ([], ["Reeditada"])
+    assert_table_matches_live_query(knn_service)
+
+
+def test_delete_hides_movies_everywhere(knn_service):
+    deleted = knn_service.movie_ids[[4, 5, 6]].tolist()
+    neighbor_id = int(knn_service.movie_ids[knn_service.neighbor_indices[4, 0]])
+
+    assert knn_service.delete_movies(deleted + [-1])['deleted'] == 3
+    assert knn_service.delete_movies(deleted)['deleted'] == 0
+
+    assert knn_service.compute_similar_movies(deleted[0], 5) == []
+    for movie_id in knn_service.movie_ids[:50].tolist():
+        assert not set(deleted) & set(similar_ids(knn_service, movie_id, knn_service.NEIGHBOR_TABLE_K + 5))
+    recommendations = knn_service.get_user_recommendations(limit=20, user_watched_movies=[neighbor_id])
+    assert not set(deleted) & {movie['movie_id'] for movie in recommendations}
+    assert_table_matches_live_query(knn_service)
+
+
+def test_writes_leave_mapped_arrays_untouched(logged_model):
+    """Altas y bajas van al delta: los arrays mapeados del artefacto no se copian ni se modifican"""
+    service = EfficientKNNService(model_path=logged_model)
+    features, table, movie_ids = service.feature_matrix, service.neighbor_indices, service.movie_ids
+    assert isinstance(features, np.memmap) and isinstance(table, np.memmap)
+    table_before = np.array(table)
+
+    service.upsert_movies([catalog_movie(1), catalog_movie(int(movie_ids[20]), title="Reeditada")])
+    service.delete_movies(movie_ids[[4, 5]].tolist())
+
+    assert service.feature_matrix.base is features and service.neighbor_indices.base is table
+    np.testing.assert_array_equal(table, table_before)
+    assert service.lookup_positions(movie_ids[[3, 4, 20]]).tolist() == [3, -1, 301]
+    assert service.live_movie_count == 299 and 0 < service.delta_rows < len(movie_ids)
+    assert service.compute_similar_movies(int(movie_ids[20]), 3)
+    assert_table_matches_live_query(service)
+
+
+def test_compacted_copy_keeps_live_catalog(knn_service):
+    knn_service.upsert_movies([catalog_movie(1), catalog_movie(2, vote_average=3.5)])
+    knn_service.delete_movies(knn_service.movie_ids[[7, 8]].tolist())
+    live = knn_service._live_mask()
+
+    compacted = knn_service.compacted_copy()
+    assert compacted.movie_ids.tolist() == knn_service.movie_ids[live].tolist()
+    assert compacted._live_mask() is None
+    assert compacted.model_version == f"{knn_service.model_version}-compacted-2"
+    assert knn_service.tombstoned[7] and len(knn_service.movie_ids) == 302  # El original no cambia
+
+    # Títulos y géneros siguen alineados con sus ids tras descartar las filas borradas
+    titles = dict(zip(knn_service.movie_ids.tolist(), knn_service._titles(np.arange(len(knn_service.movie_ids)))))
+    for movie in compacted.compute_similar_movies(1, 20) + compacted.compute_similar_movies(int(compacted.movie_ids[0]), 20):
+        assert movie['title'] == titles[movie['movie_id']]
+    assert_table_matches_live_query(compacted)
+
+
+def test_catalog_log_is_replayed_on_load(logged_model):
+    service = EfficientKNNService(model_path=logged_model)
+    service.upsert_movies([catalog_movie(1), catalog_movie(2)])
+    service.delete_movies([int(service.movie_ids[3])])
+
+    reloaded = EfficientKNNService(model_path=logged_model)
+    assert reloaded.model_version == service.model_version
+    assert reloaded.catalog_revision == service.catalog_revision == 2
+    assert reloaded.movie_ids.tolist() == service.movie_ids.tolist()
+    np.testing.assert_array_equal(reloaded.tombstoned, service.tombstoned)
+    for movie_id in (1, 2, int(service.movie_ids[0])):
+        assert reloaded.compute_similar_movies(movie_id, 10) == service.compute_similar_movies(movie_id, 10)
+
+
+def test_catalog_log_ignores_entries_of_other_versions(logged_model):
+    service = EfficientKNNService(model_path=logged_model)
+    service.upsert_movies([catalog_movie(1)])
+
+    # Un entrenamiento nuevo en la misma ruta cambia la versión: el log anterior ya no aplica
+    service.save_knn_model(logged_model)
+    reloaded = EfficientKNNService(model_path=logged_model)
+    assert reloaded.catalog_revision == 0
+    assert reloaded.movie_ids.tolist() == service.movie_ids.tolist()
+
+
+def test_retrain_keeps_entries_written_after_its_snapshot(logged_model):
+    service = EfficientKNNService(model_path=logged_model)
+    service.upsert_movies([catalog_movie(1)])
+
+    # Reentrenamiento con un catálogo leído de la BD antes del alta 2, que llega mientras entrena
+    retrained = EfficientKNNService(model_path=logged_model)
+    retrained.catalog_snapshot_at = time.time()
+    service.upsert_movies([catalog_movie(2)])
+    retrained.save_knn_model(logged_model)
+
+    reloaded = EfficientKNNService(model_path=logged_model)
+    assert reloaded.model_version != service.model_version
+    assert reloaded.catalog_revision == 1
+    assert reloaded.compute_similar_movies(2, 10) == service.compute_similar_movies(2, 10)
+
+
+def test_catch_up_applies_writes_made_after_load(logged_model):
+    writer = EfficientKNNService(model_path=logged_model)
+    candidate = EfficientKNNService(model_path=logged_model)
+    writer.upsert_movies([catalog_movie(1)])
+    writer.delete_movies([int(writer.movie_ids[0])])
+
+    assert candidate.catch_up_catalog_log() == 2
+    assert candidate.catch_up_catalog_log() == 0
+    assert candidate.movie_ids.tolist() == writer.movie_ids.tolist()
+    assert candidate.compute_similar_movies(1, 10) == writer.compute_similar_movies(1, 10)
+
+    compacted = writer.compacted_copy()
+    writer.upsert_movies([catalog_movie(2)])
+    assert compacted.catch_up_catalog_log() == 1
+    assert 2 in compacted.movie_ids.tolist()
+
+
+def test_catalog_log_disabled(saved_model, monkeypatch):
+    monkeypatch.setenv('KNN_CATALOG_LOG', 'false')
+    service = EfficientKNNService(model_path=saved_model)
+    service.upsert_movies([catalog_movie(1)])
+    assert service.catch_up_catalog_log() is None
+    assert EfficientKNNService(model_path=saved_model).catalog_revision == 0
+
+
+def test_compute_processes_catch_up_instead_of_respawning(logged_model, monkeypatch):
+    import knn_executor
+    service = EfficientKNNService(model_path=logged_model)
+    # Servicio de un proceso de cómputo que cargó el artefacto antes del alta
+    monkeypatch.setattr(knn_executor, '_worker_service', EfficientKNNService(model_path=logged_model))
+    executor = knn_executor.KNNExecutor(kind='process', workers=1, io_workers=1)
+    try:
+        pool = executor._process_pool(service)
+        service.upsert_movies([catalog_movie(1)])
+        assert executor._process_pool(service) is pool
+
+        result = knn_executor._call_worker_service('compute_similar_movies', {'movie_id': 1, 'top_k': 10},
+                                                   service.catalog_log_offset)
+        assert result == service.compute_similar_movies(1, 10)
+        assert knn_executor._worker_service.catalog_revision == 1
+    finally:
+        executor.shutdown()
@@ -0,0 +1,87 @@
+"""
+Pruebas de los motores de búsqueda de vecinos (knn_engines.py).
+"""
+
+import numpy as np
+from sklearn.neighbors import NearestNeighbors
+
+from conftest import build_synthetic_service
+from knn_engines import ExactCosineEngine, RandomProjectionLSHIndex, recall_at_k
+
+
+def test_exact_engine_matches_sklearn_cosine():
+    rng = np.random.default_rng(3)
+    features = rng.standard_normal((2000, 7))
+    queries = features[rng.choice(2000, 50, replace=False)]
+
+    distances, indices = ExactCosineEngine(features).kneighbors(queries, n_neighbors=20)
+    expected_distances, expected_indices = NearestNeighbors(metric='cosine').fit(features).kneighbors(queries, 20)
+
+    np.testing.assert_allclose(distances, expected_distances, atol=1e-5)
+    # Mismo conjunto de vecinos (el orden entre distancias casi iguales puede variar en float32)
+    for row, expected_row in zip(indices, expected_indices):
+        assert set(row[:-1]) <= set(expected_row)
+
+
+def test_exact_engine_chunking_follows_byte_budget():
+    rng = np.random.default_rng(4)
+    features = rng.standard_normal((5000, 7))
+    features[:50] = features[50:100]  # Empates exactos
+    queries = features[:300]
+
+    small = ExactCosineEngine(features, query_buffer_bytes=200 * 1024)
+    large = ExactCosineEngine(features)
+    assert small.query_chunk_size == 200 * 1024 // (5000 * ExactCosineEngine.BYTES_PER_CELL)
+    assert small.query_chunk_size < len(queries) <= large.query_chunk_size
+
+    small_result, large_result = small.kneighbors(queries, 25), large.kneighbors(queries, 25)
+    np.testing.assert_array_equal(small_result[0], large_result[0])
+    np.testing.assert_array_equal(small_result[1], large_result[1])
+    # Los empates se resuelven por índice ascendente
+    assert (small_result[1][50:100, 0] == np.arange(50)).all()
+
+
+def test_lsh_recall_on_clustered_catalog():
+    rng = np.random.default_rng(5)
+    centers = rng.standard_normal((40, 16))
+    features = centers[rng.integers(0, 40, 20000)] + 0.3 * rng.standard_normal((20000, 16))
+    queries = features[rng.choice(len(features), 200, replace=False)]
+
+    index = RandomProjectionLSHIndex(features, n_tables=12, n_bits=10, n_probes=3)
+    report = recall_at_k(index, ExactCosineEngine(features), queries, 10)
+    assert report['recall_at_k'] >= 0.9
+
+
+def test_lsh_falls_back_to_full_scan_for_sparse_buckets():
+    rng = np.random.default_rng(6)
+    features = rng.standard_normal((300, 8))
+    index = RandomProjectionLSHIndex(features, n_tables=1, n_bits=16, n_probes=0)
+    distances, indices = index.kneighbors(features[:5], n_neighbors=20)
+    exact_distances, exact_indices = ExactCosineEngine(features).kneighbors(features[:5], 20)
+    np.testing.assert_array_equal(indices, exact_indices)
+
+
+def test_ann_index_only_built_when_used():
+    assert build_synthetic_service(n_movies=200).ann_index is None
+    assert build_synthetic_service(n_movies=200, ANN_THRESHOLD=100).ann_index is not None
+    ann_service = build_synthetic_service(n_movies=200, KNN_ENGINE='ann')
+    assert isinstance(ann_service._query_engine(), RandomProjectionLSHIndex)
+
+
+def test_appended_rows_match_a_rebuilt_engine():
+    rng = np.random.default_rng(7)
+    features = rng.standard_normal((3000, 8))
+    base, tail = features[:2900], features[2900:]
+
+    exact = ExactCosineEngine(base)
+    lsh = RandomProjectionLSHIndex(base, n_tables=8, n_bits=10, n_probes=2)
+    exact.append(tail)
+    lsh.append(tail)
+    assert len(exact) == len(lsh) == 3000
+
+    expected = ExactCosineEngine(features).kneighbors(tail[:20], 10)
+    np.testing.assert_array_equal(exact.kneighbors(tail[:20], 10)[1], expected[1])
+    # Las filas añadidas no están en las tablas del LSH pero se encuentran igual
+    assert (lsh.kneighbors(tail[:20], 1)[1][:, 0] == np.arange(2900, 2920)).all()
+    rebuilt = RandomProjectionLSHIndex.from_arrays(lsh.to_arrays(), ExactCosineEngine._normalize(features))
+    assert rebuilt.sorted_rows.shape == (8, 3000)
@@ -0,0 +1,20 @@
+"""
+Pruebas del evaluador de calidad sobre el catálogo en memoria del servicio, sin BD.
+"""
+
+from knn_evaluation import KNNEvaluator
+
+
+def test_evaluator_uses_service_catalog(knn_service):
+    evaluator = KNNEvaluator(knn_service, connect=False)
+    recommended = knn_service.movie_ids[[0, 1, 2, 3]].tolist() + [987654]  # La última no está en el catálogo
+    history = [{'movie_id': recommended[0], 'rating': 5, 'watched': True},
+               {'movie_id': recommended[2], 'rating': 2, 'watched': True},
+               {'movie_id': int(knn_service.movie_ids[50]), 'rating': 4, 'watched': True}]
+
+    metrics = evaluator.evaluate_user_recommendations(7, [{'movie_id': movie_id} for movie_id in recommended],
+                                                      top_k=5, user_history=history)
+    assert metrics['liked_recommended'] == 1
+    assert metrics['precision_at_k'] == 20.0 and metrics['recall_at_k'] == 50.0
+    assert 0 < metrics['diversity_score'] <= 100 and 0 < metrics['novelty_score'] <= 100
+    assert knn_service.lookup_positions(recommended).tolist() == [0, 1, 2, 3, -1]
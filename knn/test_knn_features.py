@@ -0,0 +1,36 @@
+"""
+Pruebas de la preparación de características y de su codificación en modelos antiguos.
+"""
+
+import joblib
+import numpy as np
+
+from conftest import build_synthetic_service, catalog_movie
+from knn_service import FEATURE_VERSION, EfficientKNNService
+
+
+def test_genre_diversity_counts_genres_with_minimum_one(knn_service):
+    lengths = np.diff(knn_service.genre_offsets)
+    assert knn_service.feature_version == FEATURE_VERSION
+    assert (lengths == 0).any() and (lengths > 1).any()
+    np.testing.assert_array_equal(knn_service.movies_df['genre_diversity'], np.maximum(lengths, 1))
+
+
+def test_legacy_pickle_keeps_its_genre_encoding(tmp_path):
+    """Un .pkl sin feature_version (como knn_model.pkl) codifica las altas con genre_diversity = 1"""
+    model_path = str(tmp_path / "knn_model.pkl")
+    build_synthetic_service().save_knn_model(model_path)
+    model_data = joblib.load(model_path)
+    del model_data['feature_version']
+    joblib.dump(model_data, model_path)
+
+    service = EfficientKNNService(auto_load=False)
+    service.CATALOG_LOG_ENABLED = False
+    service.load_knn_model(model_path)
+    assert service.feature_version == 1
+
+    service.upsert_movies([catalog_movie(1, genre_ids=[3, 7, 9]), catalog_movie(2, genre_ids=[])])
+    assert service.catalog_frame()['genre_diversity'].tolist()[-2:] == [1, 1]
+
+    # La copia compactada conserva la codificación del modelo del que sale
+    assert service.compacted_copy().feature_version == 1
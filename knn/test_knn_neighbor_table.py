@@ -0,0 +1,42 @@
+"""
+Pruebas de la tabla de vecinos precalculada frente a consultar el motor en el momento.
+"""
+
+import numpy as np
+import pytest
+
+
+def test_neighbor_table_slice_matches_live_query(knn_service):
+    """El slice de la tabla devuelve lo mismo que consultar el motor en ese momento"""
+    for position in (0, 17, 150, 299):
+        movie_id = int(knn_service.movie_ids[position])
+        table_result = knn_service.compute_similar_movies(movie_id, top_k=10)
+        live_indices, live_similarities = knn_service._query_live_neighbors(
+            knn_service.feature_matrix[position:position + 1], 10, exclude_rows=np.array([position])
+        )
+        assert [movie['movie_id'] for movie in table_result] == knn_service.movie_ids[live_indices[0]].tolist()
+        assert [movie['similarity'] for movie in table_result] == pytest.approx(live_similarities[0].tolist(), rel=1e-5)
+
+
+def test_top_k_beyond_table_queries_engine(knn_service):
+    movie_id = int(knn_service.movie_ids[3])
+    wide = knn_service.compute_similar_movies(movie_id, top_k=knn_service.NEIGHBOR_TABLE_K + 10)
+    narrow = knn_service.compute_similar_movies(movie_id, top_k=knn_service.NEIGHBOR_TABLE_K)
+    assert len(wide) == knn_service.NEIGHBOR_TABLE_K + 10
+    assert [movie['movie_id'] for movie in wide[:len(narrow)]] == [movie['movie_id'] for movie in narrow]
+    assert movie_id not in [movie['movie_id'] for movie in wide]
+
+
+@pytest.mark.parametrize("top_k", [0, -1, -5])
+def test_non_positive_top_k_returns_nothing(knn_service, top_k):
+    movie_id = int(knn_service.movie_ids[0])
+    assert knn_service.compute_similar_movies(movie_id, top_k) == []
+    assert knn_service.find_similar_movies_batch([(movie_id, top_k)]) == [[]]
+
+
+def test_similar_batch_matches_single_queries(knn_service):
+    requests = [(int(knn_service.movie_ids[i]), top_k) for i, top_k in ((1, 3), (2, 10), (1, 5), (4, 60))]
+    requests.append((-1, 3))  # Película desconocida
+    knn_service.similar_cache.clear()
+    batch = knn_service.find_similar_movies_batch(requests)
+    assert batch == [knn_service.compute_similar_movies(movie_id, top_k) for movie_id, top_k in requests]
@@ -0,0 +1,89 @@
+"""
+Pruebas de RecommendationBatch y de la ruta en columnas de expansión social + ranking.
+"""
+
+import numpy as np
+import pytest
+
+from knn_results import SOURCE_KNN, SOURCE_POPULAR, RecommendationBatch
+
+
+def social_recommendations(service, n=6):
+    ids = service.movie_ids[[3, 90, 91, 150, 220, 299][:n]].tolist() + [987654]  # La última no está en el catálogo
+    return [
+        {'movie_id': movie_id, 'title': f"Social {movie_id}", 'rating': 3 + (i % 3) * 0.5,
+         'recommenders': list(range(i % 4))}
+        for i, movie_id in enumerate(ids)
+    ]
+
+
+def test_batch_operations_keep_columns_aligned():
+    batch = RecommendationBatch([4, 7, 4, 9, 7], [40, 70, 40, 90, 70], [0.1, 0.9, 0.5, 0.3, 0.2],
+                                scores=[1.0, 3.0, 2.0, 3.0, np.nan], sources=[0, 0, 1, 0, 1])
+
+    first = batch.first_per_movie()
+    assert first.movie_ids.tolist() == [40, 70, 90]
+    assert first.similarities.tolist() == [0.1, 0.9, 0.3]
+
+    top = batch.top_by_score(3)
+    assert top.movie_ids.tolist() == [70, 90, 40]  # Empate 3.0: orden del lote
+    assert top.positions.tolist() == [7, 9, 4]
+    assert top.sources.tolist() == [SOURCE_KNN, SOURCE_KNN, SOURCE_POPULAR]
+
+    joined = RecommendationBatch.concat([RecommendationBatch.empty(), batch.take(slice(0, 2)), first])
+    assert len(joined) == 5
+    assert joined.movie_ids.tolist() == [40, 70, 40, 70, 90]
+    assert np.isnan(RecommendationBatch([1], [10], [0.5]).scores).all()
+    assert RecommendationBatch([1], [10], [0.5]).seeds.tolist() == [-1]
+
+
+def test_expansion_matches_neighbor_lookup(knn_service):
+    social = social_recommendations(knn_service)
+    expanded = knn_service.expand_social_recommendations(social)
+
+    sorted_social = sorted(social, key=lambda r: r.get('rating', 0), reverse=True)
+    expected_ids = []
+    for movie in sorted_social:
+        for movie_id in [movie['movie_id']] + [n['movie_id'] for n in knn_service.compute_similar_movies(movie['movie_id'], 2)]:
+            if movie_id not in expected_ids:
+                expected_ids.append(movie_id)
+
+    assert [rec['movie_id'] for rec in expanded] == expected_ids
+    for rec in expanded:
+        if rec['source'] == 'knn_expansion':
+            assert rec['title'] == f"Película {rec['movie_id']}"
+            assert rec['original_movie'].startswith("Social") and 0 < rec['similarity_score'] <= 1
+        else:
+            assert rec['title'] == f"Social {rec['movie_id']}"
+
+
+def test_efficient_recommendations_match_dict_pipeline(knn_service):
+    """El lote en columnas da el mismo top-K y scores que expandir en dicts y rankear"""
+    social = social_recommendations(knn_service)
+    expected = knn_service.rank_recommendations_with_ml(knn_service.expand_social_recommendations(social), {})
+    result = knn_service.get_efficient_recommendations(social, {})
+
+    assert len(result) == knn_service.FINAL_TOP_K
+    assert [rec['movie_id'] for rec in result] == [rec['movie_id'] for rec in expected]
+    assert [rec['ml_score'] for rec in result] == pytest.approx([rec['ml_score'] for rec in expected], rel=1e-9)
+    assert [set(rec) for rec in result] == [set(rec) for rec in expected]
+
+
+def test_efficient_recommendations_without_expansion(knn_service):
+    social = [{'movie_id': i, 'title': f"Social {i}", 'rating': i % 5} for i in range(knn_service.MIN_SOCIAL_RECS_FOR_KNN)]
+    result = knn_service.get_efficient_recommendations(social, {})
+    assert len(result) == knn_service.FINAL_TOP_K
+    assert {rec['movie_id'] for rec in result} <= {rec['movie_id'] for rec in social}
+    assert [rec['ml_score'] for rec in result] == sorted((rec['ml_score'] for rec in result), reverse=True)
+    assert knn_service.get_efficient_recommendations([], {}) == []
+
+
+def test_hydrated_recommendations_carry_scores_only_when_present(knn_service):
+    history = knn_service.movie_ids[[1, 2]].tolist()
+    recommendations = knn_service.get_user_recommendations(limit=knn_service.USER_SEED_NEIGHBORS * 2 + 10,
+                                                            user_watched_movies=history)
+    scored = [rec for rec in recommendations if 'score' in rec]
+    assert scored and len(scored) < len(recommendations)  # Relleno con populares sin score
+    assert recommendations[:len(scored)] == scored
+    assert all(rec['similarity'] == 0.5 for rec in recommendations[len(scored):])
+    assert len({rec['movie_id'] for rec in recommendations}) == len(recommendations)
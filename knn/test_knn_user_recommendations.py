@@ -0,0 +1,53 @@
+"""
+Pruebas de las recomendaciones por historial de usuario (modos 'seeds' y 'profile', y lotes).
+"""
+
+import numpy as np
+import pytest
+
+
+def test_seed_recommendations_aggregate_weighted_neighbors(knn_service):
+    """Modo 'seeds': suma de similitudes de los vecinos ponderadas por rating, sin lo visto"""
+    watched = knn_service.movie_ids[[5, 40, 41, 200]].tolist()
+    history = [{'movie_id': movie_id, 'rating': rating} for movie_id, rating in zip(watched, (5, 4, 2, 1))]
+
+    expected = {}
+    for item in history:
+        for neighbor in knn_service.compute_similar_movies(item['movie_id'], knn_service.USER_SEED_NEIGHBORS):
+            weight = np.float32(item['rating']) / np.float32(5.0)
+            expected[neighbor['movie_id']] = expected.get(neighbor['movie_id'], 0.0) + neighbor['similarity'] * weight
+    for movie_id in watched:
+        expected.pop(movie_id, None)
+
+    recommendations = knn_service.get_user_recommendations(limit=10, user_watched_movies=history, mode='seeds')
+    assert len(recommendations) == 10
+    assert not set(watched) & {movie['movie_id'] for movie in recommendations}
+    assert [movie['score'] for movie in recommendations] == pytest.approx(sorted(expected.values(), reverse=True)[:10], rel=1e-5)
+    for movie in recommendations:
+        assert movie['score'] == pytest.approx(expected[movie['movie_id']], rel=1e-5)
+
+
+@pytest.mark.parametrize("mode", ['seeds', 'profile'])
+def test_recommend_batch_matches_single_user_path(knn_service, mode):
+    ids = knn_service.movie_ids.tolist()
+    histories = [
+        [ids[0], {'movie_id': ids[9], 'rating': 2}],
+        [{'movie_id': ids[i], 'rating': 3 + i % 3} for i in range(20, 32)],
+        [123456789],  # Solo películas fuera del catálogo: populares
+        [],
+    ]
+    batch = knn_service.recommend_batch(histories, 15, mode)
+    single = [knn_service._recommend_from_history(history, 15, mode) for history in histories]
+    assert batch == single
+
+
+def test_profile_with_zero_ratings_uses_unweighted_centroid(knn_service):
+    ids = knn_service.movie_ids[[3, 70, 120]].tolist()
+    zero_rated = [{'movie_id': movie_id, 'rating': 0} for movie_id in ids]
+    unrated = [{'movie_id': movie_id} for movie_id in ids]
+    with np.errstate(all='raise'):
+        recommendations = knn_service.get_user_recommendations(limit=8, user_watched_movies=zero_rated, mode='profile')
+        batch = knn_service.recommend_batch([zero_rated], 8, 'profile')[0]
+    expected = knn_service.get_user_recommendations(limit=8, user_watched_movies=unrated, mode='profile')
+    assert [movie['movie_id'] for movie in recommendations] == [movie['movie_id'] for movie in expected]
+    assert [movie['movie_id'] for movie in batch] == [movie['movie_id'] for movie in expected]
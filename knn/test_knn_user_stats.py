@@ -0,0 +1,133 @@
+"""
+Pruebas del acumulador incremental de estadísticas de usuarios (knn_user_stats.py)
+con una conexión simulada que devuelve filas fijas.
+"""
+
+from contextlib import contextmanager
+
+import numpy as np
+
+from knn_service import EfficientKNNService
+from knn_user_stats import BOOTSTRAP_QUERY, REFRESH_QUERY, WATERMARK_QUERY, UserStatsAccumulator
+
+
+class FakeCursor:
+    def __init__(self, results):
+        self.results = results  # Una lista de filas por cada execute
+        self.executed = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def execute(self, query, params=None):
+        self.executed.append((query, params))
+
+    def fetchall(self):
+        return self.results.pop(0)
+
+    def fetchone(self):
+        return self.results.pop(0)[0]
+
+
+class FakeConnection:
+    def __init__(self, *results):
+        self.cursor_instance = FakeCursor(list(results))
+
+    def cursor(self, **kwargs):
+        return self.cursor_instance
+
+
+class FakePool:
+    def __init__(self, *connections):
+        self.connections = list(connections)
+
+    @contextmanager
+    def connection(self):
+        yield self.connections.pop(0)
+
+
+def test_bootstrap_then_refresh_applies_deltas(tmp_path):
+    accumulator = UserStatsAccumulator(str(tmp_path / "stats.npz"), lag_seconds=30)
+    bootstrap = FakeConnection([(20, 9.0, 2, 41), (10, 4.0, 1, 41), (40, 0.0, 0, 41)])
+    accumulator.bootstrap(bootstrap)
+    assert bootstrap.cursor_instance.executed == [(BOOTSTRAP_QUERY, (30,))]
+    assert accumulator.movie_ids.tolist() == [10, 20]  # La 40 solo tiene valoraciones posteriores a la marca
+    assert accumulator.watermark == 41
+
+    connection = FakeConnection([(10, 2.0, 1, 45), (30, 7.0, 1, 44), (20, -9.0, -2, 43)])
+    assert accumulator.refresh(connection) == 3
+    assert connection.cursor_instance.executed == [(REFRESH_QUERY, (41, 30))]
+    assert accumulator.watermark == 45
+
+    stats = accumulator.to_frame()
+    assert stats['movie_id'].tolist() == [10, 30]  # La película 20 se queda sin valoraciones
+    assert stats['avg_user_rating'].tolist() == [3.0, 7.0]
+    assert stats['user_rating_count'].tolist() == [2, 1]
+
+
+def test_refresh_without_new_events_keeps_watermark(tmp_path):
+    accumulator = UserStatsAccumulator(str(tmp_path / "stats.npz"))
+    accumulator.bootstrap(FakeConnection([(10, 4.0, 1, 7)]))
+    assert accumulator.refresh(FakeConnection([])) == 0
+    assert accumulator.watermark == 7
+
+
+def test_bootstrap_without_ratings_reads_event_watermark(tmp_path):
+    accumulator = UserStatsAccumulator(str(tmp_path / "stats.npz"))
+    connection = FakeConnection([], [(None,)])
+    accumulator.bootstrap(connection)
+    assert connection.cursor_instance.executed[1] == (WATERMARK_QUERY, (accumulator.lag_seconds,))
+    assert accumulator.watermark is None
+    assert len(accumulator.movie_ids) == 0
+
+    # Sin eventos todavía: el refresh parte de -1 y no pierde el primer evento
+    refresh = FakeConnection([(10, 5.0, 1, 1)])
+    accumulator.refresh(refresh)
+    assert refresh.cursor_instance.executed[0][1][0] == -1
+    assert accumulator.watermark == 1
+
+
+def test_save_load_round_trip(tmp_path):
+    path = str(tmp_path / "stats.npz")
+    accumulator = UserStatsAccumulator(path)
+    accumulator.bootstrap(FakeConnection([(10, 4.0, 1, 12), (11, 8.0, 2, 12)]))
+    accumulator.save()
+
+    loaded = UserStatsAccumulator.load(path, lag_seconds=5)
+    assert loaded.watermark == 12
+    assert loaded.lag_seconds == 5
+    np.testing.assert_array_equal(loaded.movie_ids, accumulator.movie_ids)
+    np.testing.assert_array_equal(loaded.rating_sums, accumulator.rating_sums)
+
+    empty = UserStatsAccumulator(str(tmp_path / "empty.npz"))
+    empty.save()
+    assert UserStatsAccumulator.load(empty.path).watermark is None
+
+
+def test_load_rejects_missing_and_legacy_files(tmp_path):
+    assert UserStatsAccumulator.load(str(tmp_path / "missing.npz")) is None
+
+    legacy = str(tmp_path / "legacy.npz")
+    np.savez(legacy, movie_ids=np.array([1]), rating_sums=np.array([3.0]), rating_counts=np.array([1]),
+             watermark=np.array('2024-01-01T00:00:00'))
+    assert UserStatsAccumulator.load(legacy) is None
+
+
+def test_service_bootstraps_once_and_refreshes_next_to_model(tmp_path):
+    service = EfficientKNNService(auto_load=False)
+    service.model_path = str(tmp_path / "knn_model")
+    bootstrap, refresh = FakeConnection([(10, 8.0, 2, 100)]), FakeConnection([(10, 2.0, 1, 105)])
+    service.db_pool = FakePool(bootstrap, refresh)
+
+    first = service._load_user_statistics()
+    assert service._user_stats_path() == str(tmp_path / "knn_user_stats.npz")
+    assert first['avg_user_rating'].tolist() == [4.0]
+
+    second = service._load_user_statistics()
+    assert second['user_rating_count'].tolist() == [3]
+    assert UserStatsAccumulator.load(service._user_stats_path()).watermark == 105
+    assert bootstrap.cursor_instance.executed == [(BOOTSTRAP_QUERY, (service.USER_STATS_LAG_SECONDS,))]
+    assert refresh.cursor_instance.executed == [(REFRESH_QUERY, (100, service.USER_STATS_LAG_SECONDS))]
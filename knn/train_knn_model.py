@@ -15,6 +15,7 @@ from pathlib import Path
 sys.path.append(str(Path(__file__).parent))
 
 from knn_service import EfficientKNNService
+from db_pool import close_database_pool
 import logging
 
 # Configurar logging
@@ -24,27 +25,18 @@ logger = logging.getLogger(__name__)
 def check_database_connection():
     """Verificar conexión a la base de datos"""
     try:
-        import psycopg2
+        from db_pool import database_settings, get_database_pool
         
-        # Usar variables de entorno o valores por defecto
-        db_host = os.getenv('DB_HOST', 'localhost')
-        db_name = os.getenv('DB_NAME', 'MovieMatch')
-        db_user = os.getenv('DB_USER', 'postgres')
-        db_password = os.getenv('DB_PASSWORD', 'admin')
-        db_port = os.getenv('DB_PORT', '5432')
+        settings = database_settings()
+        logger.info(f"🔌 Verificando conexión a: {settings['host']}:{settings['port']}/{settings['database']}")
         
-        logger.info(f"🔌 Verificando conexión a: {db_host}:{db_port}/{db_name}")
-        
-        connection = psycopg2.connect(
-            host=db_host,
-            database=db_name,
-            user=db_user,
-            password=db_password,
-            port=db_port
-        )
+        # El mismo pool que usará el servicio al entrenar
+        db_pool = get_database_pool()
+        if db_pool is None:
+            raise RuntimeError("No se pudo crear el pool de conexiones")
         
         # Verificar que hay datos
-        with connection.cursor() as cursor:
+        with db_pool.connection() as connection, connection.cursor() as cursor:
             cursor.execute("SELECT COUNT(*) FROM movies")
             movie_count = cursor.fetchone()[0]
             
@@ -54,8 +46,6 @@ def check_database_connection():
             cursor.execute("SELECT COUNT(*) FROM users")
             user_count = cursor.fetchone()[0]
         
-        connection.close()
-        
         logger.info(f"✅ Conexión exitosa a la base de datos")
         logger.info(f"📊 Datos disponibles:")
         logger.info(f"   - Películas: {movie_count}")
@@ -119,16 +109,15 @@ def train_knn_model():
         logger.info(f"   - Películas cargadas: {status['total_movies']}")
         logger.info(f"   - Características: {len(status['feature_columns'])}")
         logger.info(f"   - Configuración: {status['config']}")
-        # Guardar modelo, scaler y DataFrame de películas en un solo archivo
-        model_data = {
-            'knn_model': knn_service.knn_model,
-            'scaler': knn_service.scaler,
-            'feature_columns': knn_service.feature_columns,
-            'movies_df': knn_service.movies_df
-        }
-        import joblib
-        joblib.dump(model_data, "knn_model.pkl")
-        logger.info("✅ Modelo KNN guardado como knn_model.pkl")
+        logger.info(f"   - Vecinos precalculados por película: {status['config']['neighbor_table_k']}")
+        # Índice aproximado (y su reporte de recall@K contra el exacto): el entrenamiento solo lo
+        # construye a partir de KNN_ANN_THRESHOLD películas o con KNN_ENGINE=ann
+        if knn_service.ann_report:
+            logger.info(f"   - Índice aproximado: recall@{knn_service.ann_report['k']} = "
+                        f"{knn_service.ann_report['recall_at_k']} (activo: {knn_service.ann_report['active']})")
+        # Guardar artefacto sin pickle: manifest + arrays .npy memory-mappeables (ver knn_artifact.py)
+        knn_service.save_knn_model("knn_model")
+        logger.info(f"✅ Modelo KNN guardado en knn_model/ (versión {knn_service.model_version})")
         knn_service.close()
         return True
     except Exception as e:
@@ -143,7 +132,7 @@ def test_knn_model():
     
     try:
         # Cargar modelo entrenado
-        knn_service = EfficientKNNService(model_path="knn_model.pkl")
+        knn_service = EfficientKNNService(model_path=EfficientKNNService.default_model_path())
         
         # Verificar estado
         status = knn_service.get_model_status()
@@ -179,12 +168,15 @@ def test_knn_model():
 def main():
     logger.info("🚀 Entrenamiento del modelo KNN SOLO en desarrollo/local")
     logger.info("=" * 60)
-    if not check_database_connection():
-        return False
-    if not train_knn_model():
-        return False
-    logger.info("🎉 Entrenamiento y guardado del modelo KNN completado")
-    return True
+    try:
+        if not check_database_connection():
+            return False
+        if not train_knn_model():
+            return False
+        logger.info("🎉 Entrenamiento y guardado del modelo KNN completado")
+        return True
+    finally:
+        close_database_pool()
 
 if __name__ == "__main__":
     main() 
\ No newline at end of file
@@ -1,6 +1,11 @@
 import psycopg2
 from psycopg2.extras import RealDictCursor
 import os
+import sys
+
+# Parámetros de conexión compartidos con el servicio KNN (knn/db_pool.py)
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'knn'))
+from db_pool import database_settings
 
 # Cargar variables de entorno
 try:
@@ -11,20 +16,9 @@ except ImportError:
 
 def check_database_schema():
     try:
-        db_host = os.getenv('DB_HOST', 'localhost')
-        db_name = os.getenv('DB_NAME', 'MovieMatch')
-        db_user = os.getenv('DB_USER', 'postgres')
-        db_password = os.getenv('DB_PASSWORD', 'admin')
-        db_port = os.getenv('DB_PORT', '5432')
-        
-        print(f"🔌 Conectando a: {db_host}:{db_port}/{db_name}")
-        connection = psycopg2.connect(
-            host=db_host,
-            database=db_name,
-            user=db_user,
-            password=db_password,
-            port=db_port
-        )
+        settings = database_settings()
+        print(f"🔌 Conectando a: {settings['host']}:{settings['port']}/{settings['database']}")
+        connection = psycopg2.connect(**settings)
         
         with connection.cursor(cursor_factory=RealDictCursor) as cursor:
             # Verificar estructura de la tabla users
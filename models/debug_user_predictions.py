@@ -4,6 +4,11 @@ import numpy as np
 import psycopg2
 from psycopg2.extras import RealDictCursor
 import os
+import sys
+
+# Parámetros de conexión compartidos con el servicio KNN (knn/db_pool.py)
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'knn'))
+from db_pool import database_settings
 
 # Cargar variables de entorno (opcional)
 try:
@@ -38,22 +43,9 @@ class UserPredictionDebugger:
     def connect_db(self):
         """Conectar a la base de datos"""
         try:
-            # Usar variables de entorno o valores por defecto
-            db_host = os.getenv('DB_HOST', 'localhost')
-            db_name = os.getenv('DB_NAME', 'MovieMatch')
-            db_user = os.getenv('DB_USER', 'postgres')
-            db_password = os.getenv('DB_PASSWORD', 'admin')
-            db_port = os.getenv('DB_PORT', '5432')
-            
-            print(f"🔌 Conectando a: {db_host}:{db_port}/{db_name}")
-            
-            self.db_connection = psycopg2.connect(
-                host=db_host,
-                database=db_name,
-                user=db_user,
-                password=db_password,
-                port=db_port
-            )
+            settings = database_settings()
+            print(f"🔌 Conectando a: {settings['host']}:{settings['port']}/{settings['database']}")
+            self.db_connection = psycopg2.connect(**settings)
             print("✅ Conexión a base de datos establecida")
         except Exception as e:
             print(f"❌ Error conectando a la base de datos: {e}")
@@ -2,9 +2,14 @@ import psycopg2
 from psycopg2.extras import RealDictCursor
 import pandas as pd
 import os
+import sys
 import numpy as np
 from datetime import datetime
 
+# Parámetros de conexión compartidos con el servicio KNN (knn/db_pool.py)
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'knn'))
+from db_pool import database_settings
+
 # Cargar variables de entorno
 try:
     from dotenv import load_dotenv
@@ -19,19 +24,7 @@ class TrainingDataExplainer:
         
     def connect_db(self):
         try:
-            db_host = os.getenv('DB_HOST', 'localhost')
-            db_name = os.getenv('DB_NAME', 'MovieMatch')
-            db_user = os.getenv('DB_USER', 'postgres')
-            db_password = os.getenv('DB_PASSWORD', 'admin')
-            db_port = os.getenv('DB_PORT', '5432')
-            
-            self.db_connection = psycopg2.connect(
-                host=db_host,
-                database=db_name,
-                user=db_user,
-                password=db_password,
-                port=db_port
-            )
+            self.db_connection = psycopg2.connect(**database_settings())
             print("✅ Conexión a base de datos establecida")
         except Exception as e:
             print(f"❌ Error conectando a la base de datos: {e}")
@@ -1,11 +1,16 @@
 import psycopg2
 from psycopg2.extras import RealDictCursor
 import os
+import sys
 import random
 import numpy as np
 from datetime import datetime
 import hashlib
 
+# Parámetros de conexión compartidos con el servicio KNN (knn/db_pool.py)
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'knn'))
+from db_pool import database_settings
+
 # Listas de nombres y apellidos realistas
 FIRST_NAMES = [
     "Sofía", "Mateo", "Valentina", "Santiago", "Isabella", "Sebastián", "Camila", "Emiliano", "Victoria", "Martín",
@@ -118,19 +123,9 @@ class RealisticUserGenerator:
         ]
     def connect_db(self):
         try:
-            db_host = os.getenv('DB_HOST', 'switchyard.proxy.rlwy.net')
-            db_name = os.getenv('DB_NAME', 'railway')
-            db_user = os.getenv('DB_USER', 'postgres')
-            db_password = os.getenv('DB_PASSWORD', 'vdphatjluNLYdQuzOIofuSMYQvxGnQgx')
-            db_port = os.getenv('DB_PORT', '43162')
-            print(f"🔌 Conectando a: {db_host}:{db_port}/{db_name}")
-            self.db_connection = psycopg2.connect(
-                host=db_host,
-                database=db_name,
-                user=db_user,
-                password=db_password,
-                port=db_port
-            )
+            settings = database_settings()
+            print(f"🔌 Conectando a: {settings['host']}:{settings['port']}/{settings['database']}")
+            self.db_connection = psycopg2.connect(**settings)
             print("✅ Conexión a base de datos establecida")
         except Exception as e:
             print(f"❌ Error conectando a la base de datos: {e}")
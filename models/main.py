@@ -1,12 +1,19 @@
-from fastapi import FastAPI, HTTPException
+from fastapi import FastAPI, HTTPException, Depends, Header
 from fastapi.middleware.cors import CORSMiddleware
 from pydantic import BaseModel
 import pandas as pd
 import joblib
-from typing import List
+from typing import List, Optional
 import os
+import sys
 import logging
 
+# Métricas, perfilado y reporte de memoria: los mismos módulos que el servicio KNN (knn/)
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'knn'))
+from service_metrics import instrument_app, stage
+from request_profiler import add_request_profiling
+from memory_report import TracemallocDiff, memory_report, object_report
+
 # Configurar logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
@@ -27,6 +34,19 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# Métricas Prometheus en /metrics: latencia por endpoint y etapas de la predicción
+instrument_app(app, "ml")
+
+ADMIN_TOKEN = os.getenv("ML_ADMIN_TOKEN")
+
+# Perfilado bajo demanda (X-Profile: 1 + X-Admin-Token = ML_ADMIN_TOKEN) o por muestreo
+add_request_profiling(app, "ML", admin_token=ADMIN_TOKEN)
+
+def require_admin(x_admin_token: Optional[str] = Header(None)):
+    """Dependency para endpoints de administración (cabecera X-Admin-Token = ML_ADMIN_TOKEN)"""
+    if not ADMIN_TOKEN or x_admin_token != ADMIN_TOKEN:
+        raise HTTPException(status_code=403, detail="Acceso de administrador requerido")
+
 # Cargar el modelo balanceado de forma segura
 model_data = None
 try:
@@ -172,20 +192,24 @@ def predict_with_model(features_list):
     
     try:
         # Preparar datos
-        input_df = pd.DataFrame(features_list)
+        with stage("dataframe_build"):
+            input_df = pd.DataFrame(features_list)
         
         # Obtener el modelo de la estructura
         model = model_data['model']
         
         # Escalar características si el modelo tiene scaler
         if 'scaler' in model_data:
-            input_df_scaled = model_data['scaler'].transform(input_df)
+            with stage("scaler_transform"):
+                input_df_scaled = model_data['scaler'].transform(input_df)
         else:
             input_df_scaled = input_df
         
         # Hacer predicciones
-        predictions = model.predict(input_df_scaled)
-        probabilities = model.predict_proba(input_df_scaled)
+        with stage("predict"):
+            predictions = model.predict(input_df_scaled)
+        with stage("predict_proba"):
+            probabilities = model.predict_proba(input_df_scaled)
         
         return predictions, probabilities
     except Exception as e:
@@ -215,6 +239,16 @@ def health_check():
         "timestamp": pd.Timestamp.now().isoformat()
     }
 
+# Memoria del proceso y del modelo cargado (árboles del RandomForest, scaler)
+memory_tracer = TracemallocDiff()
+
+@app.get("/debug/memory", dependencies=[Depends(require_admin)])
+def debug_memory(trace: Optional[str] = None, top: int = 20):
+    if trace not in (None, "start", "diff", "stop"):
+        raise HTTPException(status_code=400, detail="trace debe ser start, diff o stop")
+    resident = {"model_data": object_report(model_data) if model_data is not None else None}
+    return memory_report(resident, memory_tracer, trace, top)
+
 # Endpoint de predicción individual
 @app.post("/predict")
 def predict_rating(request: PredictionRequest):
@@ -297,15 +331,16 @@ def predict_batch_ratings(request: BatchPredictionRequest):
             else:
                 model_used = "enhanced"
             
-            for i, movie_id in enumerate(movie_ids):
-                results.append({
-                    "movie_id": movie_id,
-                    "prediction": int(predictions[i]),
-                    "probability_like": round(probabilities[i][1]*100, 2),
-                    "probability_dislike": round(probabilities[i][0]*100, 2),
-                    "model_used": model_used,
-                    "liked": bool(predictions[i])
-                })
+            with stage("build_response"):
+                for i, movie_id in enumerate(movie_ids):
+                    results.append({
+                        "movie_id": movie_id,
+                        "prediction": int(predictions[i]),
+                        "probability_like": round(probabilities[i][1]*100, 2),
+                        "probability_dislike": round(probabilities[i][0]*100, 2),
+                        "model_used": model_used,
+                        "liked": bool(predictions[i])
+                    })
         else:
             # Usar predicción simple
             for i, movie_id in enumerate(movie_ids):
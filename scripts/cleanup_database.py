@@ -1,5 +1,10 @@
 import psycopg2
 import os
+import sys
+
+# Parámetros de conexión compartidos con el servicio KNN (knn/db_pool.py)
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'knn'))
+from db_pool import database_settings
 
 # Cargar variables de entorno (opcional)
 try:
@@ -11,23 +16,13 @@ except ImportError:
 def cleanup_database():
     """Limpiar toda la base de datos de usuarios y sus datos relacionados"""
     
-    # Configuración de la base de datos
-    db_host = os.getenv('DB_HOST', 'switchyard.proxy.rlwy.net')
-    db_name = os.getenv('DB_NAME', 'railway')
-    db_user = os.getenv('DB_USER', 'postgres')
-    db_password = os.getenv('DB_PASSWORD', 'vdphatjluNLYdQuzOIofuSMYQvxGnQgx')
-    db_port = os.getenv('DB_PORT', '43162')
+    # Configuración de la base de datos (DB_* del entorno o .env)
+    settings = database_settings()
     
     try:
         # Conectar a la base de datos
-        print(f"🔌 Conectando a: {db_host}:{db_port}/{db_name}")
-        connection = psycopg2.connect(
-            host=db_host,
-            database=db_name,
-            user=db_user,
-            password=db_password,
-            port=db_port
-        )
+        print(f"🔌 Conectando a: {settings['host']}:{settings['port']}/{settings['database']}")
+        connection = psycopg2.connect(**settings)
         
         with connection.cursor() as cursor:
             print("🧹 Iniciando limpieza de la base de datos...")
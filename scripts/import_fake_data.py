@@ -1,12 +1,11 @@
 import psycopg2
 import csv
+import os
+import sys
 
-# Configuración de conexión
-DB_HOST = 'localhost'
-DB_PORT = 5432
-DB_NAME = 'MovieMatch'
-DB_USER = 'postgres'
-DB_PASSWORD = 'admin'
+# Configuración de conexión: DB_* del entorno, con los valores por defecto de knn/db_pool.py
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'knn'))
+from db_pool import database_settings
 
 # Archivos CSV generados por generate_realistic_test_data.py
 USERS_CSV = 'real_users.csv'
@@ -16,13 +15,7 @@ USER_CONNECTIONS_CSV = 'real_user_connections.csv'
 RECOMMENDATIONS_CSV = 'real_movie_recommendations.csv'
 
 # Conexión a la base de datos
-conn = psycopg2.connect(
-    host=DB_HOST,
-    port=DB_PORT,
-    dbname=DB_NAME,
-    user=DB_USER,
-    password=DB_PASSWORD
-)
+conn = psycopg2.connect(**database_settings())
 conn.autocommit = True
 cur = conn.cursor()
 
@@ -1,5 +1,6 @@
 import { MovieService, UserMovieService } from '../services/MovieService.js';
 import { pool } from "../db.js";
+import { knnService } from "../services/knnService.js";
 
 // Inyección de dependencias a través del constructor
 class MovieController {
@@ -35,6 +36,7 @@ class MovieController {
     createMovie = async (req, res) => {
         try {
             const movie = await this.movieService.createMovie(req.body);
+            knnService.upsertCatalogMovie(movie); // Sin await: el índice KNN se actualiza en segundo plano
             return res.status(201).json(movie);
         } catch (error) {
             return res.status(500).json({
@@ -47,6 +49,7 @@ class MovieController {
         try {
             const { id } = req.params;
             const movie = await this.movieService.updateMovie(id, req.body);
+            knnService.upsertCatalogMovie(movie);
             return res.json(movie);
         } catch (error) {
             return res.status(500).json({
@@ -60,6 +63,7 @@ class MovieController {
         try {
             const { id } = req.params;
             await this.movieService.deleteMovie(id);
+            knnService.deleteCatalogMovie(id);
             return res.json({ message: "Película eliminada exitosamente" });
         } catch (error) {
             return res.status(500).json({
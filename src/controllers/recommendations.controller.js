@@ -422,6 +422,68 @@ export const getSimilarMoviesKNN = async (req, res) => {
     }
 };
 
+export const getSimilarMoviesKNNBatch = async (req, res) => {
+    try {
+        const { movieIds, limit = 5, limits = null } = req.body;
+
+        if (!Array.isArray(movieIds) || movieIds.length === 0) {
+            return res.status(400).json({
+                error: "Se requiere una lista de películas (movieIds)"
+            });
+        }
+
+        console.log(`🔍 [KNN] Buscando películas similares para ${movieIds.length} películas`);
+
+        // Una sola llamada al servicio KNN para todas las películas
+        const similar = await knnService.getSimilarMoviesBatch(movieIds, limit, limits);
+
+        // Una sola consulta de detalles para todos los vecinos (sin repetir los compartidos)
+        const neighborIds = Object.keys(similar.movies).map(Number);
+        const moviesQuery = neighborIds.length === 0 ? { rows: [] } : await pool.query(`
+            SELECT 
+                m.id,
+                m.title,
+                m.overview,
+                m.genre_ids,
+                m.release_date,
+                CASE 
+                    WHEN m.poster_path IS NOT NULL AND m.poster_path != '' 
+                    THEN CONCAT('https://image.tmdb.org/t/p/w500', m.poster_path)
+                    ELSE NULL
+                END as poster_path,
+                m.vote_average,
+                m.popularity
+            FROM movies m
+            WHERE m.id = ANY($1)
+        `, [neighborIds]);
+
+        const movies = {};
+        for (const movie of moviesQuery.rows) {
+            movies[movie.id] = movie;
+        }
+
+        console.log(`✅ [KNN] Similares en bloque: ${Object.keys(similar.results).length} películas, ${moviesQuery.rows.length} vecinos`);
+
+        return res.json({
+            results: similar.results,
+            movies,
+            not_found: similar.not_found,
+            knn_info: {
+                model_status: "active",
+                algorithm: "K-Nearest Neighbors",
+                neighbors_used: similar.neighbors_used || 3
+            }
+        });
+
+    } catch (error) {
+        console.error('❌ [KNN] Error en getSimilarMoviesKNNBatch:', error);
+        return res.status(500).json({
+            error: "Error al obtener películas similares",
+            details: error.message
+        });
+    }
+};
+
 export const getKNNStatus = async (req, res) => {
     try {
         // Agregar headers para evitar caché
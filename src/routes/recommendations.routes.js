@@ -4,6 +4,7 @@ import {
     getUserRecommendations,
     getKNNRecommendations,
     getSimilarMoviesKNN,
+    getSimilarMoviesKNNBatch,
     getKNNStatus
 } from "../controllers/recommendations.controller.js";
 import { isAuth } from "../middlewares/auth.middleware.js";
@@ -19,5 +20,6 @@ router.get("/knn/status", getKNNStatus);
 // Rutas protegidas
 router.get("/recommendations/knn", isAuth, getKNNRecommendations);
 router.get("/movies/:movieId/similar-knn", isAuth, getSimilarMoviesKNN);
+router.post("/movies/similar-knn/batch", isAuth, getSimilarMoviesKNNBatch);
 
 export default router;
\ No newline at end of file
@@ -7,6 +7,48 @@ class KNNService {
             baseURL: this.baseURL,
             timeout: 30000, // 30 segundos
         });
+        this.adminToken = process.env.KNN_ADMIN_TOKEN;
+    }
+
+    _adminHeaders() {
+        return { 'X-Admin-Token': this.adminToken };
+    }
+
+    // Alta/modificación incremental en el índice KNN (visible en segundos, sin reentrenar)
+    async upsertCatalogMovie(movie) {
+        if (!this.adminToken || !movie) return null;
+        try {
+            const response = await this.api.post('/catalog/movies', {
+                movies: [{
+                    id: movie.id,
+                    title: movie.title,
+                    genre_ids: movie.genre_ids || [],
+                    vote_average: movie.vote_average ?? null,
+                    vote_count: movie.vote_count ?? null,
+                    popularity: movie.popularity ?? null,
+                    release_date: movie.release_date ? new Date(movie.release_date).toISOString().slice(0, 10) : null
+                }]
+            }, { headers: this._adminHeaders() });
+            console.log(`✅ [KNN] Catálogo actualizado con la película ${movie.id} (revisión ${response.data.catalog_revision})`);
+            return response.data;
+        } catch (error) {
+            console.error(`❌ [KNN] Error actualizando el catálogo con la película ${movie.id}:`, error.message);
+            return null;
+        }
+    }
+
+    async deleteCatalogMovie(movieId) {
+        if (!this.adminToken) return null;
+        try {
+            const response = await this.api.post('/catalog/movies/delete', {
+                movie_ids: [Number(movieId)]
+            }, { headers: this._adminHeaders() });
+            console.log(`🗑️ [KNN] Película ${movieId} eliminada del catálogo KNN`);
+            return response.data;
+        } catch (error) {
+            console.error(`❌ [KNN] Error eliminando la película ${movieId} del catálogo:`, error.message);
+            return null;
+        }
     }
 
     async getKNNRecommendations(userId, limit = 10, userWatchedMovies = null) {
@@ -56,6 +98,29 @@ class KNNService {
         }
     }
 
+    async getSimilarMoviesBatch(movieIds, limit = 5, limits = null) {
+        try {
+            console.log(`🔍 [KNN] Buscando películas similares para ${movieIds.length} películas`);
+            
+            const response = await this.api.post('/similar/batch', {
+                movie_ids: movieIds,
+                limit: limit,
+                limits: limits
+            });
+
+            console.log(`✅ [KNN] Similares en bloque: ${Object.keys(response.data.results).length} películas`);
+            return response.data;
+        } catch (error) {
+            console.error(`❌ [KNN] Error buscando películas similares en bloque:`, error.message);
+            
+            if (error.response) {
+                throw new Error(`Error del servicio KNN: ${error.response.data.detail || error.response.statusText}`);
+            }
+            
+            throw new Error(`Error de conexión con KNN: ${error.message}`);
+        }
+    }
+
     async getKNNStatus() {
         try {
             const response = await this.api.get('/health');